@@ -0,0 +1,101 @@
+'''
+File: bench_encoder.py
+Description: records per second encoded by CouchDBDocumentEncoder compared
+    with the json.dumps formatting of couchdblogger 0.1.3, and formatted by
+    the handler to the documents it ships (ids included)
+
+    python benchmarks/bench_encoder.py [--records N] [--json]
+'''
+import argparse
+import json
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+import couchdblogger
+
+
+def legacy_format(record):
+    return json.dumps(dict(
+        message=record.getMessage(),
+        level=record.levelname,
+        created=record.created,
+        logger=record.name
+    ))
+
+
+def legacy_static_format(record):
+    return json.dumps(dict(
+        host='web-1.example.com',
+        app='api',
+        env='production',
+        message=record.getMessage(),
+        level=record.levelname,
+        created=record.created,
+        logger=record.name,
+        lineno=record.lineno
+    ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[2])
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as json')
+    args = parser.parse_args(argv)
+
+    records = [logging.makeLogRecord(dict(
+        msg='request %s took %d ms', args=('/api/items/%d' % i, i % 250),
+        name='api.requests', levelno=logging.INFO, levelname='INFO',
+        lineno=i)) for i in range(args.records)]
+
+    default = couchdblogger.CouchDBDocumentEncoder()
+    static = couchdblogger.CouchDBDocumentEncoder(
+        fields=couchdblogger.CouchDBDocumentEncoder.DEFAULT_FIELDS +
+        (('lineno', 'lineno'),),
+        static_fields={'host': 'web-1.example.com', 'app': 'api',
+                       'env': 'production'})
+
+    # lazy: no request to couchdb
+    handler = couchdblogger.CouchDBLogHandler(lazy=True)
+    static_handler = couchdblogger.CouchDBLogHandler(
+        lazy=True, fields=static.fields, static_fields=static.static_fields)
+
+    cases = [
+        ('legacy format', lambda: [legacy_format(r) for r in records]),
+        ('encoder.encode', lambda: [default.encode(r) for r in records]),
+        ('encoder.encode_batch', lambda: default.encode_batch(records)),
+        ('handler._documents', lambda: [handler._documents(r)
+                                        for r in records]),
+        ('legacy format + static fields',
+         lambda: [legacy_static_format(r) for r in records]),
+        ('encoder.encode + static fields',
+         lambda: [static.encode(r) for r in records]),
+        ('encoder.encode_batch + static fields',
+         lambda: static.encode_batch(records)),
+        ('handler._documents + static fields',
+         lambda: [static_handler._documents(r) for r in records]),
+    ]
+
+    results = []
+    for name, case in cases:
+        best = min(timeit.repeat(case, number=1, repeat=args.repeat))
+        results.append({'benchmark': name,
+                        'records_per_second': int(args.records / best)})
+
+    if args.json:
+        print(json.dumps({'orjson': couchdblogger.orjson is not None,
+                          'results': results}, indent=2))
+    else:
+        for result in results:
+            print('%-40s %12d records/s' % (result['benchmark'],
+                                            result['records_per_second']))
+
+
+if __name__ == '__main__':
+    main()
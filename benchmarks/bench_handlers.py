@@ -0,0 +1,184 @@
+'''
+File: bench_handlers.py
+Description: records per second, emit latency and memory of every handler
+    mode against a local fake couchdb, with many logging threads
+
+    python benchmarks/bench_handlers.py [--records N] [--threads N]
+        [--latency S] [--failure-rate R] [--mode NAME] [--json]
+
+The fake couchdb runs in its own process so it does not compete with the
+logging threads for the GIL. Memory is measured by a second run under
+tracemalloc, which would distort the timings of the first one.
+'''
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+import couchdblogger
+import requests
+
+FAKECOUCHDB = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'fakecouchdb.py')
+
+
+MODES = {
+    'single': (couchdblogger.CouchDBLogHandler, {}),
+    'bulk': (couchdblogger.CouchDBBulkLogHandler, {}),
+    'bulk+gzip': (couchdblogger.CouchDBBulkLogHandler, {'compress': True}),
+    'bulk+dedup': (couchdblogger.CouchDBBulkLogHandler,
+                   {'deduplicate': True}),
+    'single+httpclient': (couchdblogger.CouchDBLogHandler,
+                          {'transport': 'http.client'}),
+    'bulk+httpclient': (couchdblogger.CouchDBBulkLogHandler,
+                        {'transport': 'http.client'}),
+}
+
+
+def percentile(latencies, percent):
+    if not latencies:
+        return 0.0
+    return latencies[min(len(latencies) - 1,
+                         int(len(latencies) * percent / 100.0))]
+
+
+def start_couchdb(latency, failure_rate):
+    """
+        Start a fake couchdb process, return (process, url)
+    """
+    process = subprocess.Popen(
+        [sys.executable, FAKECOUCHDB, '--port', '0', '--ids-only',
+         '--latency', str(latency), '--failure-rate', str(failure_rate)],
+        stdout=subprocess.PIPE, universal_newlines=True)
+    return process, process.stdout.readline().split()[-1]
+
+
+def count_documents(url, database):
+    return requests.get('%s/%s' % (url, database)).json()['doc_count']
+
+
+def run(mode, url, records, threads, trace_memory=False):
+    """
+        Log records from many threads through a handler and measure it
+
+    :param mode: name of the handler mode (MODES)
+    :param url: url of the fake couchdb
+    :param records: number of records logged by every thread
+    :param threads: number of logging threads
+    :param trace_memory: measure the peak memory allocated by the run
+    """
+    handler_class, kwargs = MODES[mode]
+    database = 'bench-%s%s' % (mode.replace('+', '-'),
+                               '-memory' if trace_memory else '')
+    host, port = url.rsplit('/', 1)[-1].split(':')
+    handler = handler_class(host=host, port=int(port),
+                            database=database, create_database=True,
+                            username='bench', password='bench', **kwargs)
+    handler.handleError = lambda record: None
+    logger = logging.Logger('bench.%s' % mode)
+    logger.addHandler(handler)
+    latencies = [[] for _ in range(threads)]
+    barrier = threading.Barrier(threads + 1)
+
+    def log(index):
+        timings = latencies[index]
+        barrier.wait()
+        for i in range(records):
+            start = time.perf_counter()
+            logger.info('request %s took %d ms', '/api/items/%d' % i,
+                        i % 250)
+            timings.append(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=log, args=(index,))
+               for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    if trace_memory:
+        tracemalloc.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    emitted = time.perf_counter() - start
+    handler.close()
+    elapsed = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    latencies = sorted(sum(latencies, []))
+    total = records * threads
+    return {
+        'mode': mode,
+        'threads': threads,
+        'records': total,
+        'delivered': count_documents(url, database),
+        'records_per_second': int(total / elapsed),
+        'emit_records_per_second': int(total / emitted),
+        'emit_p50_us': round(percentile(latencies, 50) * 1e6, 1),
+        'emit_p99_us': round(percentile(latencies, 99) * 1e6, 1),
+        'peak_memory_bytes': peak,
+        'metrics': dict((name, value) for name, value
+                        in handler.metrics.snapshot().items()
+                        if not isinstance(value, dict)),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[2])
+    parser.add_argument('--records', type=int, default=2000,
+                        help='records logged by every thread')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the fake couchdb waits per request')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='fraction of the writes failing with 503')
+    parser.add_argument('--mode', action='append', choices=sorted(MODES),
+                        help='handler mode, every mode by default')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as json')
+    args = parser.parse_args(argv)
+
+    results = []
+    process, url = start_couchdb(args.latency, args.failure_rate)
+    try:
+        for mode in args.mode or sorted(MODES):
+            result = run(mode, url, args.records, args.threads)
+            result['peak_memory_bytes'] = run(
+                mode, url, args.records, args.threads,
+                trace_memory=True)['peak_memory_bytes']
+            results.append(result)
+    finally:
+        process.terminate()
+        process.wait()
+
+    if args.json:
+        print(json.dumps({'version': couchdblogger.__version__,
+                          'python': platform.python_version(),
+                          'orjson': couchdblogger.orjson is not None,
+                          'latency': args.latency,
+                          'failure_rate': args.failure_rate,
+                          'results': results}, indent=2))
+    else:
+        print('%-18s %10s %10s %12s %12s %12s' % (
+            'mode', 'delivered', 'records/s', 'p50 emit us', 'p99 emit us',
+            'peak bytes'))
+        for result in results:
+            print('%-18s %10d %10d %12.1f %12.1f %12d' % (
+                result['mode'], result['delivered'],
+                result['records_per_second'], result['emit_p50_us'],
+                result['emit_p99_us'], result['peak_memory_bytes']))
+
+
+if __name__ == '__main__':
+    main()
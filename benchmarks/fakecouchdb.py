@@ -0,0 +1,457 @@
+'''
+File: fakecouchdb.py
+Description: local HTTP server standing in for CouchDB in benchmarks and
+    tests: /, /_session, /_up, /_all_dbs, database GET/PUT/DELETE, document
+    POST/PUT, _bulk_docs, _all_docs, _changes and the views of the
+    couchdblogger design document, with configurable latency and failures
+
+    python benchmarks/fakecouchdb.py [--port 5984] [--latency 0.002]
+        [--failure-rate 0.01] [--ids-only]
+'''
+import argparse
+import gzip
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+# python versions of the map functions of _design/couchdblogger
+VIEWS = {
+    'by_level': lambda doc: ([doc['level'], doc['created']]
+                             if doc.get('level') and doc.get('created')
+                             else None),
+    'by_logger': lambda doc: ([doc['logger'], doc['created']]
+                              if doc.get('logger') and doc.get('created')
+                              else None),
+    'by_time': lambda doc: doc.get('created') or None,
+}
+
+
+def collate(value):
+    """
+        Sort key following the CouchDB collation: null, booleans, numbers,
+        strings, arrays, objects
+    """
+    if value is None:
+        return (0,)
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    if isinstance(value, list):
+        return (4, [collate(item) for item in value])
+    return (5, sorted(value.items()))
+
+
+class Reversed(object):
+    """
+        Reversed:
+            Wraps a sort key to sort in descending order
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __le__(self, other):
+        return other.value <= self.value
+
+    def __gt__(self, other):
+        return other.value > self.value
+
+    def __ge__(self, other):
+        return other.value >= self.value
+
+
+class FakeCouchDBRequestHandler(BaseHTTPRequestHandler):
+    """
+        FakeCouchDBRequestHandler that inherits from BaseHTTPRequestHandler
+
+        FakeCouchDBRequestHandler:
+            Answers one keep-alive connection like CouchDB would
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # one write per response, no delayed ack stalls
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def _body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = b''.join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def _send(self, status, doc, headers=None):
+        data = json.dumps(doc).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _dispatch(self, method):
+        couchdb = self.server.couchdb
+        body = self._body()
+        couchdb.requests += 1
+        if couchdb.latency:
+            time.sleep(couchdb.latency)
+        path, _, query = self.path.partition('?')
+        path = path.strip('/')
+        status = couchdb.failure(method == 'POST' and path != '_session')
+        if status:
+            self._send(status, {'error': 'injected', 'reason': 'failure'})
+            return
+        parts = path.split('/', 1)
+        try:
+            if path == '':
+                self._send(200, {'couchdb': 'Welcome', 'version': 'fake'})
+            elif path == '_session':
+                self._send(200, {'ok': True}, {
+                    'Set-Cookie': 'AuthSession=%s; Version=1; Path=/; '
+                                  'HttpOnly' % uuid.uuid4().hex})
+            elif path == '_up':
+                self._send(200, {'status': 'ok'})
+            elif path == '_all_dbs':
+                self._send(200, sorted(couchdb.databases))
+            elif len(parts) == 1:
+                self._database(method, parts[0], body)
+            elif parts[1] == '_bulk_docs' and method == 'POST':
+                self._bulk_docs(parts[0], body)
+            elif parts[1] == '_changes':
+                self._changes(parts[0], parse_qs(query))
+            elif parts[1] == '_all_docs':
+                self._rows(parts[0], None, parse_qs(query))
+            elif '/_view/' in parts[1]:
+                self._rows(parts[0], VIEWS[parts[1].rsplit('/', 1)[1]],
+                           parse_qs(query))
+            else:
+                self._document(method, parts[0], parts[1], body)
+        except KeyError:
+            self._send(404, {'error': 'not_found', 'reason': 'missing'})
+
+    def _database(self, method, name, body):
+        couchdb = self.server.couchdb
+        if method == 'PUT':
+            with couchdb.lock:
+                if name in couchdb.databases:
+                    self._send(412, {'error': 'file_exists'})
+                    return
+                couchdb.databases[name] = {}
+                couchdb.changes[name] = []
+            self._send(201, {'ok': True})
+        elif method == 'DELETE':
+            with couchdb.lock:
+                del couchdb.databases[name]
+                del couchdb.changes[name]
+            self._send(200, {'ok': True})
+        elif method == 'POST':
+            self._send(*self._save(name, json.loads(body.decode('utf-8'))))
+        else:
+            self._send(200, {'db_name': name,
+                             'doc_count': len(couchdb.databases[name])})
+
+    def _document(self, method, name, doc_id, body):
+        couchdb = self.server.couchdb
+        docs = couchdb.databases[name]
+        if method == 'GET':
+            self._send(200, docs[doc_id])
+            return
+        doc = json.loads(body.decode('utf-8'))
+        doc['_id'] = doc_id
+        if doc_id.startswith(('_local/', '_design/')):
+            with couchdb.lock:
+                previous = docs.get(doc_id)
+                if previous is not None and doc.get('_rev') != previous['_rev']:
+                    self._send(409, {'error': 'conflict'})
+                    return
+                count = int(previous['_rev'].split('-')[1]) + 1 if previous else 1
+                doc['_rev'] = '%d-%d' % (0 if doc_id[1] == 'l' else count,
+                                         count)
+                docs[doc_id] = doc
+                if doc_id.startswith('_design/'):
+                    couchdb.changes[name].append(doc_id)
+                    couchdb.changed.notify_all()
+            self._send(201, {'ok': True, 'id': doc_id, 'rev': doc['_rev']})
+            return
+        self._send(*self._save(name, doc))
+
+    def _bulk_docs(self, name, body):
+        results = []
+        for doc in json.loads(body.decode('utf-8'))['docs']:
+            status, result = self._save(name, doc)
+            results.append(result)
+        self._send(201, results)
+
+    def _changes(self, name, query):
+        # continuous feed, seqs are opaque strings like CouchDB 2
+        couchdb = self.server.couchdb
+        since = query.get('since', ['0'])[0]
+        with couchdb.lock:
+            changes = couchdb.changes[name]
+            seq = len(changes) if since == 'now' else int(since.split('-')[0])
+        timeout = int(query.get('timeout', ['60000'])[0]) / 1000.0
+        heartbeat = int(query.get('heartbeat', ['60000'])[0]) / 1000.0
+        include_docs = query.get('include_docs', ['false'])[0] == 'true'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        deadline = time.time() + timeout
+        while True:
+            with couchdb.lock:
+                pending = changes[seq:]
+                if not pending and time.time() < deadline:
+                    couchdb.changed.wait(min(heartbeat,
+                                             deadline - time.time()))
+                    pending = changes[seq:]
+                docs = couchdb.databases.get(name, {})
+                lines = []
+                for doc_id in pending:
+                    seq += 1
+                    row = {'seq': '%d-fake' % seq, 'id': doc_id,
+                           'changes': [{'rev': docs[doc_id]['_rev']}]}
+                    if include_docs:
+                        row['doc'] = docs[doc_id]
+                    lines.append(json.dumps(row))
+            if lines:
+                self._chunk('\n'.join(lines) + '\n')
+            elif time.time() >= deadline:
+                break
+            else:
+                self._chunk('\n')
+        self._chunk(json.dumps({'last_seq': '%d-fake' % seq,
+                                'pending': 0}) + '\n')
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+    def _chunk(self, text):
+        data = text.encode('utf-8')
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def _rows(self, name, view, query):
+        # _all_docs (view None) or a view, with the query parameters used
+        # by CouchDBLogReader
+        def param(key, default=None):
+            return json.loads(query[key][0]) if key in query else default
+
+        with self.server.couchdb.lock:
+            docs = list(self.server.couchdb.databases[name].items())
+        rows = []
+        for doc_id, doc in docs:
+            if view is None:
+                if not doc_id.startswith('_local/'):
+                    rows.append((doc_id, doc_id, doc))
+            elif doc is not True and not doc_id.startswith('_'):
+                key = view(doc)
+                if key is not None:
+                    rows.append((key, doc_id, doc))
+        descending = param('descending', False)
+
+        def position(key, doc_id):
+            # position in the requested order
+            if descending:
+                return (Reversed(collate(key)), Reversed(doc_id))
+            return (collate(key), doc_id)
+
+        rows.sort(key=lambda row: position(row[0], row[1]))
+        if 'startkey' in query:
+            start_id = query.get('startkey_docid', [None])[0]
+            if start_id is None:
+                start = (position(param('startkey'), '')[0],)
+                rows = [row for row in rows
+                        if position(row[0], row[1])[:1] >= start]
+            else:
+                start = position(param('startkey'), start_id)
+                rows = [row for row in rows
+                        if position(row[0], row[1]) >= start]
+        if 'endkey' in query:
+            end = (position(param('endkey'), '')[0],)
+            rows = [row for row in rows
+                    if position(row[0], row[1])[:1] <= end]
+        total = len(rows)
+        rows = rows[:param('limit', len(rows))]
+        include_docs = param('include_docs', False)
+        result = []
+        for key, doc_id, doc in rows:
+            row = {'id': doc_id, 'key': key,
+                   'value': {'rev': doc['_rev']} if view is None else None}
+            if include_docs:
+                row['doc'] = doc
+            result.append(row)
+        self._send(200, {'total_rows': total, 'offset': 0, 'rows': result})
+
+    def _save(self, name, doc):
+        couchdb = self.server.couchdb
+        doc_id = doc.setdefault('_id', uuid.uuid4().hex)
+        with couchdb.lock:
+            docs = couchdb.databases[name]
+            if doc_id in docs:
+                return 409, {'id': doc_id, 'error': 'conflict',
+                             'reason': 'Document update conflict.'}
+            doc['_rev'] = '1-%s' % uuid.uuid4().hex
+            docs[doc_id] = doc if couchdb.keep_documents else True
+            couchdb.changes[name].append(doc_id)
+            couchdb.changed.notify_all()
+            couchdb.documents += 1
+        return 201, {'ok': True, 'id': doc_id, 'rev': doc['_rev']}
+
+
+class FakeCouchDB(object):
+    """
+        FakeCouchDB:
+            In-memory CouchDB stand-in served from a background thread
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0,
+                 failure_rate=0.0, failure_status=503, keep_documents=True):
+        """
+            Initialize and bind the server, call start() to serve
+
+        :param host: host to listen on
+        :param port: port to listen on, 0 for a free port
+        :param latency: seconds every request waits before its answer
+        :param failure_rate: fraction (0 to 1) of the document writes
+            answered with failure_status
+        :param failure_status: status of the injected failures
+        :param keep_documents: keep the documents (True) or only their ids
+        """
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.keep_documents = keep_documents
+        # database name: {document id: document}
+        self.databases = {}
+        # database name: [document id of every change]
+        self.changes = {}
+        self.documents = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self._fail_next = []
+        self._random = random.Random(0)
+        self.server = ThreadingHTTPServer((host, port),
+                                          FakeCouchDBRequestHandler)
+        self.server.daemon_threads = True
+        self.server.couchdb = self
+        self.host, self.port = self.server.server_address[:2]
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % (self.host, self.port)
+
+    def fail_next(self, count=1, status=None):
+        """
+            Answer the next requests with an error
+
+        :param count: number of requests
+        :param status: http status, failure_status by default
+        """
+        with self.lock:
+            self._fail_next.extend([status or self.failure_status] * count)
+
+    def failure(self, write):
+        """
+            Return the status of an injected failure for the current
+            request, None to answer it
+
+        :param write: True when the request writes documents
+        """
+        with self.lock:
+            if self._fail_next:
+                return self._fail_next.pop(0)
+            if (write and self.failure_rate and
+                    self._random.random() < self.failure_rate):
+                return self.failure_status
+        return None
+
+    def start(self):
+        """
+            Serve from a background thread
+        """
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        name='FakeCouchDB')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+            Stop serving and close the socket
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[2])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5984)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--ids-only', action='store_true',
+                        help='keep only the ids of the documents')
+    args = parser.parse_args(argv)
+
+    couchdb = FakeCouchDB(args.host, args.port, latency=args.latency,
+                          failure_rate=args.failure_rate,
+                          keep_documents=not args.ids_only)
+    print('fake couchdb on %s' % couchdb.url)
+    sys.stdout.flush()
+    try:
+        couchdb.server.serve_forever()
+    except KeyboardInterrupt:
+        couchdb.server.server_close()
+
+
+if __name__ == '__main__':
+    main()
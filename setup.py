@@ -38,6 +38,9 @@ setup(
         'Topic :: Internet :: WWW/HTTP :: Dynamic Content',
     ],
     install_requires=['requests'],
+    entry_points={
+        'console_scripts': ['couchdblogger = couchdblogger:main'],
+    },
     include_package_data=True,
     zip_safe=False,
     long_description=read('README'),
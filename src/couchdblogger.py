@@ -3,10 +3,85 @@ File: couchdblogger.py
 Author: Rinat F Sabitov, Federico Gonzalez
 Description: simple python logger handler for CouchDB
 '''
+import base64
+import bisect
+import calendar
+import codecs
+import collections
+import datetime
+import hashlib
+import itertools
 import logging
 import json
+import mmap
+import os
+import random
+import re
+import signal
+import socket
+import ssl
+import struct
+import sys
+import threading
+import time
+import zlib
 import requests
 
+try:
+    import socketserver
+except ImportError:  # Python 2
+    import SocketServer as socketserver
+
+try:
+    import http.client as httplib
+    from urllib.parse import unquote, urlencode, urlsplit
+except ImportError:  # Python 2
+    import httplib
+    from urllib import unquote, urlencode
+    from urlparse import urlsplit
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from json.encoder import encode_basestring_ascii as _json_str
+
+if orjson is not None:
+    def _json_any(value):
+        try:
+            data = orjson.dumps(value, default=str)
+            if data.isascii():
+                return data.decode('ascii')
+        except orjson.JSONEncodeError:
+            pass
+        # same output as the stdlib
+        return json.dumps(value, default=str)
+else:
+    def _json_any(value):
+        return json.dumps(value, default=str)
+
+
+def _json_text(value):
+    # a record built by makeLogRecord may carry None (or anything) in its
+    # string attributes, encode_basestring_ascii only takes strings
+    try:
+        return _json_str(value)
+    except TypeError:
+        return _json_any(value)
+
+
+def _json_number(value):
+    # repr is json for int and float only (not for None, bool or long)
+    if value.__class__ is int or value.__class__ is float:
+        return repr(value)
+    return _json_any(value)
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
 __author__ = "Rinat F Sabitov, Federico Gonzalez"
 __credits__ = ["Rinat F Sabitov", "Federico Gonzalez"]
 __license__ = "MIT"
@@ -27,14 +102,88 @@ class CouchDBSession(requests.Session):
             Provides cookie persistence, connection-pooling, and configuration.
     """
 
-    def __init__(self, request_args=None):
+    RENEW_AT = 0.9
+
+    def __init__(self, request_args=None, pool_connections=10,
+                 pool_maxsize=10, session_timeout=600.0, transport=None):
         """
             Initialize the couchdb session
 
         :param request_args; args for request
+        :param pool_connections: number of hosts whose connections are
+            pooled
+        :param pool_maxsize: max number of keep-alive connections kept per
+            host, raise it when many threads log at once
+        :param session_timeout: seconds after which couchdb expires the
+            cookie session ([chttpd_auth] timeout), it is renewed before
+        :param transport: object sending the requests instead of requests
+            (see CouchDBHTTPTransport), 'http.client' for a
+            CouchDBHTTPTransport, None or 'requests' for requests
         """
         super(CouchDBSession, self).__init__()
         self.request_args = request_args or {}
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.session_timeout = session_timeout
+        if transport == 'http.client':
+            transport = CouchDBHTTPTransport(pool_maxsize=pool_maxsize)
+        elif transport == 'requests':
+            transport = None
+        self.transport = transport
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+        self._login_args = None
+        self._login_lock = threading.Lock()
+        self._login_generation = 0
+        self._login_time = 0.0
+
+    def clone(self):
+        """
+            Return a new session with the same settings, without the
+            connections nor the cookie session of this one
+        """
+        transport = self.transport
+        return CouchDBSession(request_args=self.request_args,
+                              pool_connections=self.pool_connections,
+                              pool_maxsize=self.pool_maxsize,
+                              session_timeout=self.session_timeout,
+                              transport=transport and transport.clone())
+
+    def login(self, url, username, password):
+        """
+            Open a cookie session in couchdb. The session is renewed when
+            it is about to expire and when couchdb answers 401.
+
+        :param url: url of couchdb (protocol://host:port)
+        :param username: user's name for logging in the database
+        :param password: password for logging in the database
+        """
+        with self._login_lock:
+            self._login_args = (url, username, password)
+            self._login()
+
+    def _login(self):
+        url, username, password = self._login_args
+        self.post(url + '/_session', data={
+            'name': username,
+            'password': password
+        })
+        self._login_generation += 1
+        self._login_time = time.time()
+
+    def _renew(self, generation):
+        """
+            Log in again unless another thread did it since generation was
+            read: one thread logs in, the others wait for it
+
+        :param generation: login generation seen by the caller
+        """
+        with self._login_lock:
+            if generation == self._login_generation:
+                self._login()
 
     class CouchDBException(Exception):
         """
@@ -46,7 +195,10 @@ class CouchDBSession(requests.Session):
             Exception:
                 Common base class for all non-exit exceptions.
         """
-        pass
+
+        def __init__(self, message='', status_code=None):
+            super(CouchDBSession.CouchDBException, self).__init__(message)
+            self.status_code = status_code
 
     def request(self, *args, **kwargs):
         """
@@ -83,140 +235,3792 @@ class CouchDBSession(requests.Session):
         :param cert: (optional) if String, path to ssl client cert file (.pem).
             If Tuple, ('cert', 'key') pair.
         """
-        kwargs.update(self.request_args)
-        resp = super(CouchDBSession, self).request(*args, **kwargs)
+        if self.request_args:
+            kwargs.update(self.request_args)
+        url = args[1] if len(args) > 1 else kwargs.get('url', '')
+        if self._login_args is None or url.endswith('/_session'):
+            resp = self._send(*args, **kwargs)
+        else:
+            generation = self._login_generation
+            if (time.time() - self._login_time >=
+                    self.session_timeout * self.RENEW_AT):
+                self._renew(generation)
+                generation = self._login_generation
+            resp = self._send(*args, **kwargs)
+            if 'AuthSession=' in resp.headers.get('Set-Cookie', ''):
+                # couchdb refreshed the cookie
+                self._login_time = time.time()
+            if resp.status_code == 401:
+                # expired session: log in again and replay once, streamed
+                # bodies cannot be replayed here, post_body replays them
+                self._renew(generation)
+                if not _streamed(kwargs.get('data')):
+                    resp = self._send(*args, **kwargs)
         if resp.status_code >= 400:
-            raise self.CouchDBException(resp.text)
+            raise self.CouchDBException(resp.text, resp.status_code)
         return resp
 
+    def post_body(self, url, body, **kwargs):
+        """
+            Post the body returned by a function, called again to replay a
+            streamed body once the expired session is opened again
 
-class CouchDBLogHandler(logging.StreamHandler, object):
+        :param url: URL of the request
+        :param body: function returning the request body
+        :param kwargs: other arguments of post
+        """
+        data = body()
+        try:
+            return self.post(url, data=data, **kwargs)
+        except self.CouchDBException as exc:
+            if (exc.status_code != 401 or self._login_args is None or
+                    not _streamed(data)):
+                raise
+            # request logged in again but could not replay the stream
+            return self.post(url, data=body(), **kwargs)
+
+    def _send(self, *args, **kwargs):
+        if self.transport is None:
+            return super(CouchDBSession, self).request(*args, **kwargs)
+        return self.transport.request(*args, **kwargs)
+
+
+class CouchDBHTTPResponse(object):
+    """
+        CouchDBHTTPResponse:
+            Response of CouchDBHTTPTransport, with the part of the
+            interface of requests.Response used by couchdblogger
     """
-        CouchDBLogHandler that inherits from logging.StreamHandler
 
-        logging.StreamHandler:
-            A handler class which writes logging records,
-            appropriately formatted, to a stream.
-            Note that this class does not close the stream, as
-            sys.stdout or sys.stderr may be used.
+    def __init__(self, response, release, stream=False):
+        """
+            Wrap a response, its body is read unless stream is set
+
+        :param response: http.client.HTTPResponse
+        :param release: function(reusable) giving the connection back
+        :param stream: read the body on demand (iter_content)
+        """
+        self.status_code = response.status
+        self.headers = response.msg
+        self._response = response
+        self._release = release
+        self._content = None
+        if not stream:
+            self._content = response.read()
+            self._done(True)
+
+    def _done(self, reusable):
+        release, self._release = self._release, None
+        if release is not None:
+            release(reusable)
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = b''.join(self.iter_content(64 * 1024))
+        return self._content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_content(self, chunk_size=1):
+        """
+            Iterate over the body, in pieces of at most chunk_size bytes
+            yielded as soon as they are received
+
+        :param chunk_size: max bytes of a piece
+        """
+        if self._content is not None:
+            for start in range(0, len(self._content), chunk_size):
+                yield self._content[start:start + chunk_size]
+            return
+        read = getattr(self._response, 'read1', self._response.read)
+        while True:
+            chunk = read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        self._done(True)
+
+    def iter_lines(self, chunk_size=512):
+        """
+            Iterate over the lines of the body, without their end of line
+
+        :param chunk_size: max bytes read at once
+        """
+        pending = b''
+        for chunk in self.iter_content(chunk_size):
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line.rstrip(b'\r')
+        if pending:
+            yield pending
+
+    def close(self):
+        """
+            Close a response whose body was not read, with its connection
+        """
+        if self._release is not None:
+            self._response.close()
+            self._done(False)
+
+
+class _HTTPHost(object):
+    # keep-alive connections and pre-built headers of one server
+
+    def __init__(self, connect, headers, maxsize):
+        self.connect = connect
+        self.headers = headers
+        self.maxsize = maxsize
+        self.cookie = None
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return self.connect(), False
+
+    def release(self, connection, reusable):
+        if reusable:
+            with self.lock:
+                if len(self.idle) < self.maxsize:
+                    self.idle.append(connection)
+                    return
+        connection.close()
+
+
+class CouchDBHTTPTransport(object):
     """
+        CouchDBHTTPTransport:
+            Lean HTTP layer of CouchDBSession on http.client keep-alive
+            connections: no request preparation, environment merging nor
+            hooks. The constant headers of a server (Host, Accept, basic
+            auth, AuthSession cookie) are built once, the pieces of
+            streamed bodies are joined in a buffer of the calling thread
+            reused from one request to the next and sent at once.
 
-    def __init__(self, host='localhost', port=5984, database='logs',
-                 create_database=False, username=None, password=None,
-                 ssl=False, request_args=None):
+            The keyword arguments of requests which are not supported
+            (proxies, hooks, allow_redirects, ...) are ignored.
+    """
+
+    # buffers grown over this size are not kept
+    MAX_BUFFER = 16 * 1024 * 1024
+
+    def __init__(self, pool_maxsize=10, timeout=None):
         """
-            Initialize the couchdb handler
+            Initialize the transport
 
-        :param host: host of couchdb for logging
-        :param port: port of couchdb for logging
-        :param database: database's name for logging
-        :param username: user's name for logging in the database
-        :param password: password for logging in the database
-        :param create_database: bool to create the database if it does not exist
-        :param ssl: bool to use ssl (https)
-        :param request_args; json args for request
+        :param pool_maxsize: max number of keep-alive connections kept per
+            server
+        :param timeout: seconds of the socket operations, None to wait
+            forever, overridden by the timeout of a request
         """
-        super(CouchDBLogHandler, self).__init__()
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self._hosts = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
 
-        self.database = database
-        self.port = port
-        self.ssl = ssl
+    def clone(self):
+        """
+            Return a new transport with the same settings, without the
+            connections nor the cookies of this one
+        """
+        return CouchDBHTTPTransport(self.pool_maxsize, self.timeout)
 
-        if self.ssl:
-            protocol = 'https'
-            if username:
-                host = "%(username)s:%(password)s@%(host)s" % dict(
-                    username=username,
-                    password=password,
-                    host=host
-                )
+    def _host(self, scheme, netloc, verify, cert):
+        key = (scheme, netloc)
+        host = self._hosts.get(key)
+        if host is not None:
+            return host
+        parts = urlsplit('%s://%s' % (scheme, netloc))
+        address = parts.hostname
+        port = parts.port or (443 if scheme == 'https' else 80)
+        headers = [('Host', '%s:%d' % (address, port)),
+                   ('Accept', 'application/json')]
+        if parts.username:
+            credentials = '%s:%s' % (unquote(parts.username),
+                                     unquote(parts.password or ''))
+            headers.append(('Authorization', 'Basic ' + base64.b64encode(
+                credentials.encode('utf-8')).decode('ascii')))
+        if scheme == 'https':
+            context = ssl.create_default_context()
+            if verify is False:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            elif isinstance(verify, str):
+                if os.path.isdir(verify):
+                    context.load_verify_locations(capath=verify)
+                else:
+                    context.load_verify_locations(cafile=verify)
+            if cert:
+                if isinstance(cert, str):
+                    context.load_cert_chain(cert)
+                else:
+                    context.load_cert_chain(*cert)
+            connect = lambda: httplib.HTTPSConnection(
+                address, port, timeout=self.timeout, context=context)
         else:
-            protocol = 'http'
-
-        self.url = "%(protocol)s://%(host)s:%(port)d" % dict(
-            protocol=protocol,
-            host=host,
-            port=port,
-        )
+            connect = lambda: httplib.HTTPConnection(address, port,
+                                                     timeout=self.timeout)
+        with self._lock:
+            return self._hosts.setdefault(
+                key, _HTTPHost(connect, headers, self.pool_maxsize))
 
-        self.db_url = "%(url)s/%(database)s" % dict(
-            url=self.url,
-            database=database
-        )
+    def _body(self, data, json_data):
+        # return (body, content type)
+        if json_data is not None:
+            return json.dumps(json_data).encode('utf-8'), 'application/json'
+        if data is None or isinstance(data, (bytes, bytearray)):
+            return data, None
+        if isinstance(data, dict):
+            return (urlencode(data).encode('utf-8'),
+                    'application/x-www-form-urlencoded')
+        if isinstance(data, str):
+            return data.encode('utf-8'), None
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None or len(buffer) > self.MAX_BUFFER:
+            buffer = self._local.buffer = bytearray()
+        del buffer[:]
+        for piece in data:
+            buffer += piece.encode('utf-8') if isinstance(piece, str) else piece
+        return buffer, None
 
-        self.session = CouchDBSession(request_args=request_args)
-        if username:
-            self.session.post(self.url+'/_session', data={
-                'name': username,
-                'password': password
-            })
+    def request(self, method, url, params=None, data=None, headers=None,
+                json=None, stream=False, timeout=None, verify=True, cert=None,
+                **kwargs):
+        """
+            Send a request, return a CouchDBHTTPResponse. A connection
+            closed by the server while it was idle is replaced once.
 
-        if create_database:
+        :param method: http method
+        :param url: url of the request
+        :param params: dict of the query string parameters
+        :param data: body: str, bytes, dict (form) or iterable of pieces
+        :param headers: dict of headers
+        :param json: object sent as json
+        :param stream: read the body of the response on demand
+        :param timeout: seconds of the socket operations, or a
+            (connect, read) tuple
+        :param verify: verify the certificate of https servers, or the
+            path of the CA bundle
+        :param cert: client certificate file, or (cert, key) tuple
+        """
+        scheme, netloc, path, query, _ = urlsplit(url)
+        host = self._host(scheme, netloc, verify, cert)
+        if params:
+            query = (query + '&' if query else '') + urlencode(params)
+        if query:
+            path = (path or '/') + '?' + query
+        body, content_type = self._body(data, json)
+        if isinstance(timeout, tuple):
+            timeout = timeout[1]
+        headers = headers or {}
+        for attempt in (0, 1):
+            connection, reused = host.acquire()
             try:
-                self.session.get(self.db_url)
-            except CouchDBSession.CouchDBException:
-                self.session.put(self.db_url)
+                if timeout is not None and connection.timeout != timeout:
+                    connection.timeout = timeout
+                    if connection.sock is not None:
+                        connection.sock.settimeout(timeout)
+                connection.putrequest(method, path or '/', skip_host=True,
+                                      skip_accept_encoding=True)
+                for name, value in host.headers:
+                    connection.putheader(name, value)
+                if host.cookie:
+                    connection.putheader('Cookie', host.cookie)
+                if content_type:
+                    connection.putheader('Content-Type', content_type)
+                for name, value in headers.items():
+                    connection.putheader(name, value)
+                if body is not None or method in ('POST', 'PUT'):
+                    connection.putheader('Content-Length',
+                                         str(len(body or b'')))
+                connection.endheaders(body)
+                response = connection.getresponse()
+            except socket.timeout as exc:
+                connection.close()
+                raise requests.Timeout(exc)
+            except (socket.error, httplib.HTTPException) as exc:
+                connection.close()
+                if reused and attempt == 0:
+                    continue  # closed by the server while idle
+                raise requests.ConnectionError(exc)
+            break
+        cookie = response.getheader('Set-Cookie')
+        if cookie and 'AuthSession=' in cookie:
+            host.cookie = cookie.split(';', 1)[0]
+        return CouchDBHTTPResponse(
+            response, lambda reusable: host.release(connection, reusable),
+            stream)
 
-    def new_format(self, format_function):
+
+# length prefix of the documents in spool segments and shipper streams
+_FRAME = struct.Struct('>I')
+
+_exception_formatter = logging.Formatter()
+
+
+def _add_fields(doc, fields):
+    """
+        Add members to a json object (str) without decoding it
+
+    :param doc: json document (str)
+    :param fields: list of (key, value) pairs
+    """
+    members = ','.join('%s:%s' % (_json_str(key), _json_any(value))
+                       for key, value in fields)
+    head = doc[:doc.rindex('}')].rstrip()
+    return head + ('' if head.endswith('{') else ',') + members + '}'
+
+
+def _streamed(data):
+    """
+        Return True when a request body is read once (file or generator)
+
+    :param data: data of the request
+    """
+    return (hasattr(data, 'read') or hasattr(data, '__next__') or
+            hasattr(data, 'next'))
+
+
+def _is_unreachable(exc):
+    """
+        Return True when the exception raised by a request means couchdb
+        could not take the documents right now (connection error, timeout
+        or server error)
+
+    :param exc: exception raised by CouchDBSession
+    """
+    if isinstance(exc, CouchDBSession.CouchDBException):
+        return (exc.status_code or 0) >= 500
+    return isinstance(exc, requests.RequestException)
+
+
+_CROCKFORD = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+# two digits at once, the number of 10 bits
+_CROCKFORD_PAIRS = [first + second for first in _CROCKFORD
+                    for second in _CROCKFORD]
+
+
+def _base32(number, length):
+    """
+        Encode a number to a fixed length Crockford base32 string, which
+        sorts like the number
+
+    :param number: positive integer lower than 32 ** length
+    :param length: number of characters
+    """
+    chars = []
+    for _ in range(length // 2):
+        number, pair = divmod(number, 1024)
+        chars.append(_CROCKFORD_PAIRS[pair])
+    if length % 2:
+        chars.append(_CROCKFORD[number % 32])
+    return ''.join(reversed(chars))
+
+
+class CouchDBIdGenerator(object):
+    """
+        CouchDBIdGenerator:
+            Generates compact document ids sorted by time, ULID style: 10
+            characters for the milliseconds since the epoch, 4 for the host
+            and process, 6 for a sequence starting at random every
+            millisecond and incremented inside it. Ids of one process are
+            strictly increasing, so inserts append to the database b-tree
+            and the documents of a time range can be read from _all_docs.
+    """
+
+    NODE_BITS = 20
+    SEQUENCE_BITS = 30
+
+    def __init__(self, node=None):
         """
-            Change the format logging
+            Initialize the generator
 
-        :param format_function: function to generate couchdb logs from record
+        :param node: integer identifying the writer (lower than 2 ** 20),
+            derived from the host name and the pid by default
+        """
+        self.node = node
+        self._lock = threading.Lock()
+        self._pid = None
+        self._node_key = None
+        self._last = -1
+        # id prefix of the last millisecond: its time and the node key
+        self._prefix = None
+        self._sequence = 0
 
-        REQUIRED: The function must return a json.dumps to post in couchdb
+    @staticmethod
+    def time_key(created):
         """
-        self.format = format_function
+            Return the id prefix of a time, to use as startkey / endkey of
+            _all_docs
 
-    def format(self, record):
+        :param created: time (time.time())
         """
-            Format a logging record to couchdb record
+        return _base32(int(created * 1000), 10)
+
+    def __call__(self, created=None):
+        """
+            Return a new id
+
+        :param created: time of the document (time.time()), now by default
+        """
+        millis = int((time.time() if created is None else created) * 1000)
+        with self._lock:
+            if self._pid != os.getpid():
+                # a forked child must not reuse the ids of its parent
+                self._pid = os.getpid()
+                node = self.node
+                if node is None:
+                    node = zlib.crc32(('%s:%d' % (
+                        socket.gethostname(), self._pid)).encode('utf-8'))
+                self._node_key = _base32(
+                    node & ((1 << self.NODE_BITS) - 1), self.NODE_BITS // 5)
+                self._last = -1
+            if millis > self._last:
+                self._last = millis
+                self._prefix = _base32(millis, 10) + self._node_key
+                self._sequence = random.getrandbits(self.SEQUENCE_BITS - 1)
+            else:
+                # same millisecond or clock going backwards: stay monotonic
+                self._sequence += 1
+                if self._sequence >> self.SEQUENCE_BITS:
+                    self._last += 1
+                    self._prefix = _base32(self._last, 10) + self._node_key
+                    self._sequence = 0
+            sequence = self._sequence
+            # the SEQUENCE_BITS // 5 digits of the sequence, by pairs
+            return (self._prefix + _CROCKFORD_PAIRS[sequence >> 20] +
+                    _CROCKFORD_PAIRS[(sequence >> 10) & 1023] +
+                    _CROCKFORD_PAIRS[sequence & 1023])
+
+
+class CouchDBMetrics(object):
+    """
+        CouchDBMetrics:
+            Counters and latency histograms of a handler. Every thread
+            updates its own shard without locking, snapshot() sums the
+            shards, so the metrics are cheap enough to stay enabled.
+            The shards of the finished threads are folded into one.
+    """
+
+    COUNTERS = ('emitted', 'dropped', 'sampled', 'failed', 'spooled',
+                'requests', 'documents_sent', 'bytes_sent')
+    HISTOGRAMS = ('emit', 'serialize', 'request')
+    # upper bounds (seconds) of the histogram buckets, 10us to 80s
+    BUCKETS = tuple(0.00001 * 2 ** i for i in range(24))
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self):
+        """
+            Initialize the metrics
+        """
+        # name: function, the value is added to the snapshot
+        self.gauges = {}
+        self._local = threading.local()
+        # (thread, shard) of the running threads
+        self._shards = []
+        self._retired = self._new_shard()
+        self._sweep_at = 64
+        self._lock = threading.Lock()
+
+    def _new_shard(self):
+        # every key exists from the start: updates never resize the dicts
+        # read by snapshot()
+        return (dict.fromkeys(self.COUNTERS, 0),
+                dict((name, [0, 0.0, 0.0] + [0] * (len(self.BUCKETS) + 1))
+                     for name in self.HISTOGRAMS))
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._new_shard()
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+                if len(self._shards) >= self._sweep_at:
+                    # thread per request servers: bounded without snapshot()
+                    self._sweep()
+                    self._sweep_at = max(64, 2 * len(self._shards))
+            self._local.shard = shard
+            return shard
+
+    def _sweep(self):
+        # fold the shards of the finished threads, called with the lock
+        running = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                running.append((thread, shard))
+            else:
+                self._add(self._retired, shard)
+        self._shards = running
+
+    def _add(self, total, shard):
+        # add the counters and histograms of a shard to total
+        counters, histograms = total
+        shard_counters, shard_histograms = shard
+        for name in self.COUNTERS:
+            counters[name] += shard_counters[name]
+        for name in self.HISTOGRAMS:
+            histogram, values = histograms[name], list(shard_histograms[name])
+            histogram[0] += values[0]
+            histogram[1] += values[1]
+            histogram[2] = max(histogram[2], values[2])
+            for index in range(3, len(values)):
+                histogram[index] += values[index]
+
+    def incr(self, name, value=1):
+        """
+            Increment a counter of the calling thread
+
+        :param name: name of the counter (COUNTERS)
+        :param value: increment
+        """
+        self._shard()[0][name] += value
+
+    def observe(self, name, seconds):
+        """
+            Add a duration to a histogram of the calling thread
+
+        :param name: name of the histogram (HISTOGRAMS)
+        :param seconds: duration
+        """
+        histogram = self._shard()[1][name]
+        histogram[0] += 1
+        histogram[1] += seconds
+        if seconds > histogram[2]:
+            histogram[2] = seconds
+        histogram[3 + bisect.bisect_left(self.BUCKETS, seconds)] += 1
+
+    def snapshot(self):
+        """
+            Return the counters, the gauges and for every histogram its
+            count, sum, max and approximate percentiles (upper bound of
+            the bucket)
+        """
+        total = self._new_shard()
+        with self._lock:
+            self._sweep()
+            shards = [shard for _, shard in self._shards]
+            self._add(total, self._retired)
+        for shard in shards:
+            self._add(total, shard)
+        counters, histograms = total
+
+        snapshot = counters
+        for name, gauge in self.gauges.items():
+            snapshot[name] = snapshot.get(name, 0) + gauge()
+        for name, histogram in histograms.items():
+            count, seconds, largest = histogram[:3]
+            summary = {'count': count, 'sum': seconds, 'max': largest}
+            for percentile in self.PERCENTILES:
+                rank, seen = count * percentile / 100.0, 0
+                value = 0.0
+                for bound, hits in zip(self.BUCKETS + (largest,),
+                                       histogram[3:]):
+                    seen += hits
+                    if hits and seen >= rank:
+                        value = min(bound, largest)
+                        break
+                summary['p%d' % percentile] = value
+            snapshot[name] = summary
+        return snapshot
+
+
+class CouchDBPayloads(object):
+    """
+        CouchDBPayloads:
+            Keeps the log documents small for indexing and replication:
+            texts (message, exception, stack) longer than the threshold
+            are cut, and in 'attach' mode the whole text is stored gzip
+            compressed as the inline attachment of a payload document
+            whose id is its digest. Identical texts (a traceback logged in
+            a loop) are uploaded once while their digest is in the cache.
+    """
+
+    MODES = ('attach', 'truncate')
+    _PAYLOAD_ID = re.compile(r'"_id": "(payload-[0-9a-f]{40})"')
+
+    def __init__(self, threshold=16 * 1024, mode='attach', cache_size=1024,
+                 compress_level=6):
+        """
+            Initialize the payloads
+
+        :param threshold: max length of a text kept in the log document
+        :param mode: 'attach' the whole text to a payload document or
+            only 'truncate' it
+        :param cache_size: number of digests of uploaded payloads kept
+        :param compress_level: gzip level of the attachments
+        """
+        if mode not in self.MODES:
+            raise ValueError('mode must be one of %s' % ', '.join(self.MODES))
+        self.threshold = threshold
+        self.mode = mode
+        self.cache_size = cache_size
+        self.compress_level = compress_level
+        self._uploaded = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def compact(self, name, text):
+        """
+            Cut a large text
+
+        :param name: name of the field of the text
+        :param text: text longer than the threshold
+        :return: tuple (fields, docs), (key, value) pairs to add to the log
+            document and payload documents (str) to write with it
+        """
+        data = text.encode('utf-8')
+        digest = hashlib.sha1(data).hexdigest()
+        fields = [(name, text[:self.threshold]),
+                  (name + '_size', len(text)),
+                  (name + '_sha1', digest)]
+        if self.mode == 'truncate':
+            return fields, []
+
+        doc_id = 'payload-' + digest
+        fields.append((name + '_payload', doc_id))
+        with self._lock:
+            if doc_id in self._uploaded:
+                self._uploaded[doc_id] = self._uploaded.pop(doc_id)
+                return fields, []
+            self._uploaded[doc_id] = True
+            if len(self._uploaded) > self.cache_size:
+                self._uploaded.popitem(last=False)
+        compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(data) + compressor.flush()
+        doc = json.dumps({
+            '_id': doc_id,
+            'type': 'payload',
+            'size': len(data),
+            '_attachments': {'payload.gz': {
+                'content_type': 'application/gzip',
+                'data': base64.b64encode(compressed).decode('ascii'),
+            }},
+        })
+        # an existing payload document answers 409, nothing is lost
+        return fields, [doc]
+
+    def forget(self, docs):
+        """
+            Forget the payload documents which could not be written, so
+            that the next identical text uploads them again
+
+        :param docs: json documents (str) which were not written
+        """
+        with self._lock:
+            for doc in docs:
+                match = self._PAYLOAD_ID.search(doc)
+                if match is not None:
+                    self._uploaded.pop(match.group(1), None)
+
+
+class CouchDBSampler(object):
+    """
+        CouchDBSampler:
+            Rate limits the records below `level` with one token bucket
+            per (logger, level). The records of a bucket without tokens
+            are dropped, the next kept record carries their count in its
+            sample_weight, so sum(sample_weight) estimates the number of
+            records logged. Records at or above `level` are always kept.
+
+            Under load (delivery latency above latency_target, or queue
+            filled above queue_target) the rates are divided by the load
+            so that fewer low-priority records are kept, down to
+            min_factor of their rate.
+    """
+
+    def __init__(self, rate=100.0, burst=None, level=logging.WARNING,
+                 rates=None, latency_target=1.0, queue_target=0.5,
+                 min_factor=0.01, adapt_interval=1.0, max_keys=10000):
+        """
+            Initialize the sampler
+
+        :param rate: records per second kept for every (logger, level)
+        :param burst: records kept at once after an idle period, the rate
+            of the bucket by default
+        :param level: records at or above this level are always kept
+        :param rates: dict of logger name (or (logger name, level)):
+            records per second overriding rate, None to never drop
+        :param latency_target: seconds of delivery latency above which
+            the rates are lowered
+        :param queue_target: fraction (0 to 1) of the queue filled above
+            which the rates are lowered
+        :param min_factor: lowest fraction of the rates kept under load
+        :param adapt_interval: seconds between two reads of the load
+        :param max_keys: max number of buckets, the least recently used
+            one is forgotten when it is full
+        """
+        self.rate = rate
+        self.burst = burst
+        self.level = level
+        self.rates = rates or {}
+        self.latency_target = latency_target
+        self.queue_target = queue_target
+        self.min_factor = min_factor
+        self.adapt_interval = adapt_interval
+        self.max_keys = max_keys
+        # fraction of the rates currently applied
+        self.factor = 1.0
+        self.sampled = 0
+        self._adapt_at = 0.0
+        # key: [tokens, last refill, records dropped since the last kept]
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _rate(self, name, levelno):
+        rates = self.rates
+        if (name, levelno) in rates:
+            return rates[(name, levelno)]
+        if (name, logging.getLevelName(levelno)) in rates:
+            return rates[(name, logging.getLevelName(levelno))]
+        return rates.get(name, self.rate)
+
+    def adapt(self, latency, fill):
+        """
+            Set the fraction of the rates applied from the load
+
+        :param latency: recent delivery latency in seconds
+        :param fill: fraction (0 to 1) of the queue filled
+        """
+        load = max(latency / self.latency_target if self.latency_target
+                   else 0.0,
+                   fill / self.queue_target if self.queue_target else 0.0)
+        self.factor = max(self.min_factor, 1.0 / load) if load > 1 else 1.0
+
+    def sample(self, record, load=None):
+        """
+            Return the sample weight of a record to keep, None to drop it
 
         :param record: loggging record (LogRecord)
-        The useful attributes in a LogRecord are described by:
+        :param load: function returning (latency, fill), see adapt(),
+            called at most every adapt_interval seconds
+        """
+        if record.levelno >= self.level:
+            return 1
+        rate = self._rate(record.name, record.levelno)
+        if rate is None:
+            return 1
+        now = time.time()
+        if load is not None and now >= self._adapt_at:
+            self._adapt_at = now + self.adapt_interval
+            self.adapt(*load())
+        burst = max(1.0, (self.burst or rate) * self.factor)
+        rate *= self.factor
+        key = (record.name, record.levelno)
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                bucket = [burst, now, 0]
+                if len(self._buckets) >= self.max_keys:
+                    self._buckets.popitem(last=False)
+            self._buckets[key] = bucket
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                self.sampled += 1
+                return None
+            bucket[0] -= 1
+            weight = bucket[2] + 1
+            bucket[2] = 0
+            return weight
 
-        %(name)s            Name of the logger (logging channel)
-        %(levelno)s         Numeric logging level for the message (DEBUG, INFO,
-                            WARNING, ERROR, CRITICAL)
-        %(levelname)s       Text logging level for the message ("DEBUG", "INFO",
-                            "WARNING", "ERROR", "CRITICAL")
-        %(pathname)s        Full pathname of the source file where the logging
-                            call was issued (if available)
-        %(filename)s        Filename portion of pathname
-        %(module)s          Module (name portion of filename)
-        %(lineno)d          Source line number where the logging call was issued
-                            (if available)
-        %(funcName)s        Function name
-        %(created)f         Time when the LogRecord was created (time.time()
-                            return value)
-        %(asctime)s         Textual time when the LogRecord was created
-        %(msecs)d           Millisecond portion of the creation time
-        %(relativeCreated)d Time in milliseconds when the LogRecord was created,
-                            relative to the time the logging module was loaded
-                            (typically at application startup time)
-        %(thread)d          Thread ID (if available)
-        %(threadName)s      Thread name (if available)
-        %(process)d         Process ID (if available)
-        %(message)s         The result of record.getMessage(), computed just as
-                            the record is emitted
+
+class CouchDBRetry(object):
+    """
+        CouchDBRetry:
+            Retry policy of the writes: up to `attempts` tries, waiting
+            between two of them an exponential backoff (backoff, 2 *
+            backoff, ... at most max_backoff seconds) shortened by a
+            random jitter so that many processes do not retry in step.
+            Only the documents which failed are sent again.
+    """
+
+    # errors of _bulk_docs documents which sending again cannot fix,
+    # 'conflict' means the document (same _id) is already written
+    PERMANENT_ERRORS = frozenset(['forbidden', 'unauthorized', 'bad_request',
+                                  'doc_validation', 'illegal_docid',
+                                  'too_large', 'invalid_utf8'])
+
+    def __init__(self, attempts=3, backoff=0.1, max_backoff=10.0, jitter=1.0):
         """
-        return json.dumps(dict(
-            message=record.getMessage(),
-            level=record.levelname,
-            created=record.created,
-            logger=record.name
-        ))
+            Initialize the retry policy
 
-    def emit(self, record):
+        :param attempts: max number of tries of a write, the first included
+        :param backoff: seconds waited before the first retry
+        :param max_backoff: max seconds waited before a retry
+        :param jitter: fraction (0 to 1) of the wait which is random, 1
+            waits uniformly between 0 and the backoff ("full jitter")
         """
-            Emit a logging record
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
 
-        :param record: loggging record
+    def delays(self):
         """
-        headers = {'Content-type': 'application/json'}
-        try:
-            self.session.post(self.db_url, data=self.format(record),
-                              headers=headers)
-        except (KeyboardInterrupt, SystemExit):
-            raise
-        except:
-            self.handleError(record)
+            Iterate over the seconds to wait before every retry
+        """
+        for attempt in range(self.attempts - 1):
+            delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+            yield delay * (1 - self.jitter * random.random())
+
+    @staticmethod
+    def transient(exc):
+        """
+            Return True when a failed request is worth sending again
+
+        :param exc: exception raised by CouchDBSession
+        """
+        if isinstance(exc, CouchDBSession.CouchDBException):
+            return (exc.status_code or 0) >= 500 or exc.status_code in (408,
+                                                                        429)
+        return isinstance(exc, requests.RequestException)
+
+
+class CouchDBCircuitBreaker(object):
+    """
+        CouchDBCircuitBreaker:
+            Stops the writes to a failing couchdb: after `threshold`
+            failures in a row the circuit opens and the writes fail fast
+            (their documents are spooled or dropped) for `reset_timeout`
+            seconds. Then it is half-open: one write probes couchdb, its
+            success closes the circuit, its failure opens it again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold=5, reset_timeout=30.0):
+        """
+            Initialize the circuit breaker, closed
+
+        :param threshold: number of failures in a row opening the circuit
+        :param reset_timeout: seconds the circuit stays open before a probe
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+            Return True when a write may be sent, False to fail fast
+        """
+        if self.state == self.CLOSED:
+            return True
+        with self._lock:
+            if (self.state == self.OPEN and
+                    time.time() - self._opened_at >= self.reset_timeout):
+                # this write is the probe
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def success(self):
+        """
+            Record a write that reached couchdb
+        """
+        if self.state == self.CLOSED and not self.failures:
+            return
+        with self._lock:
+            self.failures = 0
+            self.state = self.CLOSED
+
+    def failure(self):
+        """
+            Record a write that failed because couchdb is unreachable or
+            failing
+        """
+        with self._lock:
+            self.failures += 1
+            if (self.state == self.HALF_OPEN or
+                    (self.state == self.CLOSED and
+                     self.failures >= self.threshold)):
+                self.state = self.OPEN
+                self.opened += 1
+                self._opened_at = time.time()
+
+
+class CouchDBSpool(object):
+    """
+        CouchDBSpool:
+            Durable local spool for documents which could not be delivered
+            to couchdb. Documents are appended to segment files with large
+            sequential writes and read back in order through mmap.
+    """
+
+    SEGMENT_SUFFIX = '.spool'
+    CHECKPOINT = 'checkpoint'
+
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024,
+                 max_bytes=1024 * 1024 * 1024, write_buffer=1024 * 1024,
+                 fsync=False):
+        """
+            Initialize the spool, segments left by a previous run are kept
+            and replayed first
+
+        :param directory: directory of the segment files
+        :param segment_bytes: size after which a new segment is started
+        :param max_bytes: size cap of the spool, the oldest segments are
+            deleted to stay below it
+        :param write_buffer: size of the write buffer of the open segment
+        :param fsync: bool to fsync the segment after every append
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.write_buffer = write_buffer
+        self.fsync = fsync
+        self.dropped_segments = 0
+        self.dropped_bytes = 0
+
+        self._lock = threading.Lock()
+        self._file = None
+        self._file_name = None
+        self._file_bytes = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._segments = sorted(
+            name for name in os.listdir(directory)
+            if name.endswith(self.SEGMENT_SUFFIX))
+        self.size = sum(os.path.getsize(self._path(name))
+                        for name in self._segments)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _next_name(self):
+        last = self._segments[-1] if self._segments else '0'
+        return '%020d%s' % (int(last.split('.')[0]) + 1, self.SEGMENT_SUFFIX)
+
+    def pending(self):
+        """
+            Return True when the spool holds documents to replay
+        """
+        return self.size > 0
+
+    def append(self, docs, database=None):
+        """
+            Append documents to the open segment
+
+        :param docs: list of json documents (str)
+        :param database: database's name of the documents, None for the
+            database of the handler
+        """
+        prefix = b''
+        if database is not None:
+            prefix = b'@' + database.encode('utf-8') + b'\n'
+        data = []
+        for doc in docs:
+            if not isinstance(doc, bytes):
+                doc = doc.encode('utf-8')
+            data.append(_FRAME.pack(len(prefix) + len(doc)))
+            data.append(prefix)
+            data.append(doc)
+        data = b''.join(data)
+
+        with self._lock:
+            self._enforce_cap(len(data))
+            if self._file is None:
+                self._file_name = self._next_name()
+                self._segments.append(self._file_name)
+                self._file = open(self._path(self._file_name), 'ab',
+                                  self.write_buffer)
+                self._file_bytes = 0
+            self._file.write(data)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._file_bytes += len(data)
+            self.size += len(data)
+            if self._file_bytes >= self.segment_bytes:
+                self._close_segment()
+
+    def _enforce_cap(self, incoming):
+        while self._segments and self.size + incoming > self.max_bytes:
+            name = self._segments[0]
+            if name == self._file_name:
+                self._close_segment()
+            self.dropped_bytes += self._delete(name)
+            self.dropped_segments += 1
+
+    def _close_segment(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = self._file_name = None
+
+    def _delete(self, name):
+        path = self._path(name)
+        size = os.path.getsize(path)
+        os.remove(path)
+        self._segments.remove(name)
+        self.size -= size
+        if self._read_checkpoint()[0] == name:
+            os.remove(self._path(self.CHECKPOINT))
+        return size
+
+    def _read_checkpoint(self):
+        try:
+            with open(self._path(self.CHECKPOINT)) as checkpoint:
+                name, offset = checkpoint.read().split()
+            return name, int(offset)
+        except (IOError, OSError, ValueError):
+            return None, 0
+
+    def checkpoint(self, name, offset):
+        """
+            Record that the documents of segment `name` before `offset`
+            were delivered
+
+        :param name: segment name
+        :param offset: byte offset in the segment
+        """
+        path = self._path(self.CHECKPOINT)
+        with open(path + '.tmp', 'w') as checkpoint:
+            checkpoint.write('%s %d' % (name, offset))
+        getattr(os, 'replace', os.rename)(path + '.tmp', path)
+
+    def read(self, name, offset=0):
+        """
+            Iterate over the documents of a segment through mmap
+
+        :param name: segment name
+        :param offset: byte offset to start from
+        :return: iterator of tuples (end offset, database's name or None,
+            json document (str))
+        """
+        with open(self._path(name), 'rb') as segment:
+            try:
+                data = mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file
+                return
+            try:
+                end = len(data)
+                while offset + _FRAME.size <= end:
+                    length, = _FRAME.unpack_from(data, offset)
+                    start = offset + _FRAME.size
+                    if start + length > end:  # torn write
+                        break
+                    offset = start + length
+                    doc = data[start:offset].decode('utf-8')
+                    database = None
+                    if doc.startswith('@'):
+                        database, doc = doc[1:].split('\n', 1)
+                    yield offset, database, doc
+            finally:
+                data.close()
+
+    def replay(self, send, batch_size=500):
+        """
+            Send the spooled documents in order, oldest segment first.
+            A segment is deleted once all its documents were sent, the
+            checkpoint records the progress inside a segment.
+            Exceptions raised by `send` stop the replay, it resumes from
+            the checkpoint on the next call.
+
+        :param send: function called with a list of json documents (str)
+            and their database's name (None for the database of the
+            handler)
+        :param batch_size: max number of documents per call of `send`
+        """
+        while True:
+            with self._lock:
+                if not self._segments:
+                    return
+                if self._segments[0] == self._file_name:
+                    self._close_segment()
+                name = self._segments[0]
+            checkpoint_name, offset = self._read_checkpoint()
+            if checkpoint_name != name:
+                offset = 0
+
+            docs, database = [], None
+            for offset_end, doc_database, doc in self.read(name, offset):
+                if docs and (doc_database != database or
+                             len(docs) >= batch_size):
+                    send(docs, database)
+                    self.checkpoint(name, offset)
+                    docs = []
+                docs.append(doc)
+                database, offset = doc_database, offset_end
+            if docs:
+                send(docs, database)
+
+            with self._lock:
+                if name in self._segments:
+                    self._delete(name)
+
+    def close(self):
+        """
+            Close the open segment
+        """
+        with self._lock:
+            self._close_segment()
+
+
+class CouchDBDocumentEncoder(object):
+    """
+        CouchDBDocumentEncoder:
+            Compiles a declarative field spec once into a specialized
+            function encoding logging records to couchdb documents.
+            Static fields (host, app, env, ...) are serialized at compile
+            time, orjson is used for the other values when installed.
+    """
+
+    DEFAULT_FIELDS = (('message', 'message'), ('level', 'levelname'),
+                      ('created', 'created'), ('logger', 'name'))
+    STRING_ATTRIBUTES = frozenset(['levelname', 'name', 'pathname',
+                                   'filename', 'module'])
+    NUMBER_ATTRIBUTES = frozenset(['levelno', 'lineno', 'created', 'msecs',
+                                   'relativeCreated'])
+    _identifier = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+    def __init__(self, fields=None, static_fields=None):
+        """
+            Initialize and compile the encoder
+
+        :param fields: list of LogRecord attributes (the document key is the
+            attribute name, 'message' is record.getMessage()) or of
+            (key, attribute) pairs, DEFAULT_FIELDS by default
+        :param static_fields: dict of constant fields added to every
+            document
+        """
+        self.fields = tuple(
+            (field, field) if not isinstance(field, (tuple, list))
+            else tuple(field)
+            for field in (self.DEFAULT_FIELDS if fields is None else fields))
+        self.static_fields = dict(static_fields or {})
+        self.encode, self.encode_id, self.encode_batch = self._compile()
+
+    def _value(self, attribute):
+        if attribute == 'message':
+            return '_str(record.getMessage())'
+        if self._identifier.match(attribute):
+            if attribute in self.STRING_ATTRIBUTES:
+                return '_str(record.%s)' % attribute
+            if attribute in self.NUMBER_ATTRIBUTES:
+                return '_num(record.%s)' % attribute
+        return '_any(getattr(record, %r, None))' % attribute
+
+    def _compile(self):
+        namespace = {'_str': _json_text, '_num': _json_number,
+                     '_any': _json_any}
+        constants, values = [], []
+        head = '{'
+        for key in sorted(self.static_fields):
+            head += '%s%s:%s' % ('' if head == '{' else ',', _json_str(key),
+                                 _json_any(self.static_fields[key]))
+        for key, attribute in self.fields:
+            head += '%s%s:' % ('' if head == '{' and not constants else ',',
+                               _json_str(key))
+            constants.append(head)
+            values.append(self._value(attribute))
+            head = ''
+        constants.append(head + '}')
+
+        pieces = []
+        for i, constant in enumerate(constants):
+            namespace['_c%d' % i] = constant
+            pieces.append('_c%d' % i)
+            if i < len(values):
+                pieces.append(values[i])
+        namespace['_end'] = constants[-1] + ','
+        batch_pieces = pieces[:-1] + ['_end']
+        # the _id member first, then the members of encode
+        rest = constants[0][1:]
+        namespace['_id0'] = '{"_id":'
+        namespace['_id1'] = rest if rest.startswith('}') else ',' + rest
+        id_pieces = ['_id0', '_str(_id)', '_id1'] + pieces[1:]
+
+        source = (
+            'def encode(record):\n'
+            '    return %s\n'
+            'def encode_id(record, _id):\n'
+            '    return %s\n'
+            'def encode_batch(records):\n'
+            '    parts = []\n'
+            '    extend = parts.extend\n'
+            '    for record in records:\n'
+            '        extend((%s,))\n'
+            '    if parts:\n'
+            '        parts[-1] = _c%d\n'
+            '    return \'{"docs":[\' + \'\'.join(parts) + \']}\'\n'
+        ) % (' + '.join(pieces), ' + '.join(id_pieces),
+             ', '.join(batch_pieces), len(constants) - 1)
+        exec(compile(source, '<CouchDBDocumentEncoder>', 'exec'), namespace)
+        return namespace['encode'], namespace['encode_id'], \
+            namespace['encode_batch']
+
+
+class CouchDBNode(object):
+    """
+        CouchDBNode:
+            One node of a couchdb cluster with its own session (and so its
+            own keep-alive connection pool)
+    """
+
+    def __init__(self, url, database, request_args=None, **session_args):
+        """
+            Initialize the node
+
+        :param url: url of the node (protocol://host:port)
+        :param database: database's name for logging
+        :param request_args: args for request
+        :param session_args: pool and session settings of CouchDBSession
+        """
+        self.url = url
+        self.db_url = url + '/' + database
+        self.session = CouchDBSession(request_args=request_args,
+                                      **session_args)
+        self.healthy = True
+        self.latency = None
+        self.credentials = None
+        self.logged_in = False
+
+    def login(self):
+        """
+            Open the cookie session of the node, unless it is open or the
+            node has no credentials
+        """
+        if self.credentials is not None and not self.logged_in:
+            self.session.login(self.url, *self.credentials)
+            self.logged_in = True
+
+    def __repr__(self):
+        return '<CouchDBNode %s healthy=%s latency=%s>' % (
+            self.url, self.healthy, self.latency)
+
+
+class CouchDBNodePool(object):
+    """
+        CouchDBNodePool:
+            Spreads the writes over the nodes of a couchdb cluster, round
+            robin or to the node with the lowest latency. A background
+            health check ejects the nodes which fail or are slow and brings
+            them back when they recover.
+    """
+
+    BALANCES = ('round_robin', 'least_latency')
+
+    def __init__(self, nodes, balance='round_robin',
+                 health_check_interval=5.0, health_check_timeout=2.0,
+                 slow_threshold=1.0, latency_decay=0.3):
+        """
+            Initialize the pool and start the health check
+
+        :param nodes: list of CouchDBNode
+        :param balance: 'round_robin' or 'least_latency'
+        :param health_check_interval: seconds between two health checks,
+            None to disable them
+        :param health_check_timeout: timeout of a health check request
+        :param slow_threshold: nodes answering slower than this (seconds)
+            are ejected
+        :param latency_decay: weight of the last request in the moving
+            average of the latency of a node
+        """
+        if balance not in self.BALANCES:
+            raise ValueError('balance must be one of %s' % (self.BALANCES,))
+        self.nodes = list(nodes)
+        self.balance = balance
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self.slow_threshold = slow_threshold
+        self.latency_decay = latency_decay
+        self._counter = itertools.count()
+        self._stop = threading.Event()
+        self._thread = None
+        self.start()
+
+    def start(self):
+        """
+            Start the health check thread
+        """
+        if self.health_check_interval is None:
+            return
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._check,
+                                        name='CouchDBNodePool-health')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+            Stop the health check thread
+        """
+        self._stop.set()
+
+    def reset(self):
+        """
+            New sessions and health check thread, used in a forked child
+        """
+        for node in self.nodes:
+            node.session = node.session.clone()
+            node.logged_in = False
+        self.start()
+
+    def login(self, username, password):
+        """
+            Log in every node. The nodes which cannot be reached are
+            ejected and logged in once they answer again; an error is
+            raised only when no node could be logged in.
+
+        :param username: user's name for logging in the database
+        :param password: password for logging in the database
+        """
+        error = None
+        for node in self.nodes:
+            node.credentials = (username, password)
+            try:
+                node.login()
+            except Exception as exc:
+                if not _is_unreachable(exc):
+                    raise
+                node.healthy = False
+                error = exc
+        if not any(node.logged_in for node in self.nodes):
+            raise error
+
+    def healthy(self):
+        """
+            Return the nodes in service
+        """
+        return [node for node in self.nodes if node.healthy]
+
+    def candidates(self):
+        """
+            Return the nodes in the order they should be tried for the next
+            request, the ejected nodes last
+        """
+        healthy = self.healthy()
+        if self.balance == 'least_latency':
+            healthy.sort(key=lambda node: node.latency or 0)
+        elif healthy:
+            start = next(self._counter) % len(healthy)
+            healthy = healthy[start:] + healthy[:start]
+        return healthy + [node for node in self.nodes if not node.healthy]
+
+    def report(self, node, latency=None):
+        """
+            Record the result of a request sent to a node
+
+        :param node: CouchDBNode
+        :param latency: seconds the request took, None when it failed
+        """
+        if latency is None:
+            node.healthy = False
+            return
+        if node.latency is None:
+            node.latency = latency
+        else:
+            node.latency += self.latency_decay * (latency - node.latency)
+
+    def post(self, path, body, headers):
+        """
+            Post on the first node which answers
+
+        :param path: path of the request ('/logs/_bulk_docs')
+        :param body: function returning the request body
+        :param headers: request headers
+        """
+        error = None
+        for node in self.candidates():
+            start = time.time()
+            try:
+                node.login()
+                resp = node.session.post_body(node.url + path, body,
+                                              headers=headers)
+            except Exception as exc:
+                if not _is_unreachable(exc):
+                    raise
+                self.report(node)
+                error = exc
+                continue
+            self.report(node, time.time() - start)
+            return resp
+        raise error
+
+    def check(self):
+        """
+            Health check every node (GET /_up)
+        """
+        for node in self.nodes:
+            start = time.time()
+            try:
+                node.session.get(node.url + '/_up',
+                                 timeout=self.health_check_timeout)
+                node.login()
+            except Exception:
+                node.healthy = False
+                continue
+            latency = time.time() - start
+            self.report(node, latency)
+            node.healthy = latency <= self.slow_threshold
+
+    def _check(self):
+        stop = self._stop
+        while not stop.wait(self.health_check_interval):
+            self.check()
+
+
+class CouchDBLogHandler(logging.StreamHandler, object):
+    """
+        CouchDBLogHandler that inherits from logging.StreamHandler
+
+        logging.StreamHandler:
+            A handler class which writes logging records,
+            appropriately formatted, to a stream.
+            Note that this class does not close the stream, as
+            sys.stdout or sys.stderr may be used.
+    """
+
+    def __init__(self, host='localhost', port=5984, database='logs',
+                 create_database=False, username=None, password=None,
+                 ssl=False, request_args=None, spool=None,
+                 spool_retry_interval=5.0, fields=None, static_fields=None,
+                 compress=False, compress_level=6, compress_min_size=1024,
+                 nodes=None, balance='round_robin', health_check_interval=5.0,
+                 slow_threshold=1.0, retention=None,
+                 retention_interval=3600.0, id_generator=None,
+                 pool_maxsize=10, session_timeout=600.0, stats_interval=None,
+                 lazy=False, capture_exceptions=True, payloads=None,
+                 install_views=False, sample=None, transport=None,
+                 retry=None, circuit_breaker=None):
+        """
+            Initialize the couchdb handler
+
+        :param host: host of couchdb for logging
+        :param port: port of couchdb for logging
+        :param database: database's name for logging, or a time.strftime
+            pattern ('logs-%Y-%m-%d') of the names of time-partitioned
+            databases, created when first written to
+        :param username: user's name for logging in the database
+        :param password: password for logging in the database
+        :param create_database: bool to create the database if it does not exist
+        :param ssl: bool to use ssl (https)
+        :param request_args; json args for request
+        :param spool: CouchDBSpool (or its directory) keeping the records
+            which could not be delivered while couchdb is unreachable
+        :param spool_retry_interval: seconds between two attempts to
+            replay the spool
+        :param fields: fields of the documents, see CouchDBDocumentEncoder
+        :param static_fields: dict of constant fields added to every
+            document (host, app, env, ...)
+        :param compress: bool to send the request bodies gzip compressed
+            (Content-Encoding: gzip)
+        :param compress_level: zlib compression level (1-9)
+        :param compress_min_size: bodies smaller than this (in bytes) are
+            sent uncompressed
+        :param nodes: list of the nodes of a couchdb cluster ('host',
+            'host:port' or (host, port)) used instead of host and port
+        :param balance: how writes are spread over the nodes,
+            'round_robin' or 'least_latency'
+        :param health_check_interval: seconds between two health checks of
+            the nodes
+        :param slow_threshold: nodes answering the health check slower than
+            this (seconds) are ejected until they recover
+        :param retention: seconds (or datetime.timedelta) after which the
+            time-partitioned databases are deleted
+        :param retention_interval: seconds between two runs of the
+            retention policy
+        :param id_generator: function returning the id of a document from
+            its creation time, CouchDBIdGenerator by default, False to let
+            couchdb assign the ids. Retried or replayed documents keep their
+            id, so they are never written twice.
+        :param pool_maxsize: max number of keep-alive connections per node
+        :param session_timeout: seconds after which couchdb expires the
+            cookie session, it is renewed before
+        :param transport: HTTP layer of the sessions, see CouchDBSession:
+            'http.client' for CouchDBHTTPTransport, requests by default
+        :param stats_interval: seconds between two writes of the metrics
+            to the document _local/couchdblogger-<host>-<pid>, None to not
+            write them
+        :param lazy: do no I/O in the constructor: the login and the
+            creation of the database are done by a background thread, or
+            by the first request if it comes before
+        :param capture_exceptions: add the traceback (exception) and the
+            stack (stack) of the records to their documents
+        :param payloads: CouchDBPayloads cutting the texts longer than its
+            threshold, CouchDBPayloads() by default, False to keep them
+        :param install_views: install the design document of
+            CouchDBLogReader in the database(s), upgraded when outdated
+        :param sample: CouchDBSampler (or its rate in records per second
+            per logger and level) dropping the low-priority records over
+            the rate, the documents get a sample_weight field
+        :param retry: CouchDBRetry (or its number of attempts) sending
+            again the documents whose write failed, None to try once
+        :param circuit_breaker: CouchDBCircuitBreaker (or its threshold of
+            failures in a row) failing the writes fast while couchdb is
+            failing, their documents are spooled or dropped
+        """
+        super(CouchDBLogHandler, self).__init__()
+        self.metrics = CouchDBMetrics()
+
+        self.database = database
+        self.port = port
+        self.ssl = ssl
+
+        self.nodes = None
+        if nodes:
+            urls = [self._server_url(node, port, username, password)
+                    for node in nodes]
+            self.nodes = CouchDBNodePool(
+                [CouchDBNode(url, database, request_args,
+                             pool_maxsize=pool_maxsize,
+                             session_timeout=session_timeout,
+                             transport=transport)
+                 for url in urls],
+                balance=balance, health_check_interval=health_check_interval,
+                slow_threshold=slow_threshold)
+            self.url = urls[0]
+        else:
+            self.url = self._server_url(host, port, username, password)
+
+        self.db_url = "%(url)s/%(database)s" % dict(
+            url=self.url,
+            database=database
+        )
+        self.bulk_url = self.db_url + '/_bulk_docs'
+
+        # names of the databases known to exist
+        self.partitioned = '%' in database
+        self.databases = set()
+        self._databases_lock = threading.Lock()
+
+        self.encoder = CouchDBDocumentEncoder(fields, static_fields)
+        if id_generator is None:
+            id_generator = CouchDBIdGenerator()
+        self.id_generator = id_generator
+        self.capture_exceptions = capture_exceptions
+        if payloads is None:
+            payloads = CouchDBPayloads()
+        self.payloads = payloads
+        self.install_views = install_views
+        if sample is not None and not isinstance(sample, CouchDBSampler):
+            sample = CouchDBSampler(rate=sample)
+        self.sampler = sample
+        if retry is not None and not isinstance(retry, CouchDBRetry):
+            retry = CouchDBRetry(attempts=retry)
+        self.retry = retry
+        if (circuit_breaker is not None and
+                not isinstance(circuit_breaker, CouchDBCircuitBreaker)):
+            circuit_breaker = CouchDBCircuitBreaker(threshold=circuit_breaker)
+        self.circuit_breaker = circuit_breaker
+        if circuit_breaker is not None:
+            self.metrics.gauges['circuit_open'] = lambda: int(
+                circuit_breaker.state != CouchDBCircuitBreaker.CLOSED)
+        # moving average of the request durations, the load of the sampler
+        self._latency = 0.0
+        if sample is not None:
+            self.metrics.gauges['sample_factor'] = lambda: sample.factor
+        self.compress = compress
+        self.compress_level = compress_level
+        self.compress_min_size = compress_min_size
+        self.uncompressed_bytes = 0
+        self.compressed_bytes = 0
+
+        self._pid = os.getpid()
+        self._credentials = (username, password)
+        self._create_database = create_database
+        self._connected = False
+        self._connect_lock = threading.Lock()
+        if self.nodes is not None:
+            self.session = self.nodes.nodes[0].session
+        else:
+            self.session = CouchDBSession(request_args=request_args,
+                                          pool_maxsize=pool_maxsize,
+                                          session_timeout=session_timeout,
+                                          transport=transport)
+        if lazy:
+            thread = threading.Thread(target=self._warm_up,
+                                      name='CouchDBLogHandler-connect')
+            thread.daemon = True
+            thread.start()
+        else:
+            self._ensure_connected()
+
+        if spool is not None and not isinstance(spool, CouchDBSpool):
+            spool = CouchDBSpool(spool)
+        self.spool = spool
+        self.spool_retry_interval = spool_retry_interval
+        self._replay_stop = threading.Event()
+        self._replay_thread = None
+        if self.spool is not None:
+            self._replay_thread = threading.Thread(
+                target=self._replay, name='CouchDBLogHandler-replay')
+            self._replay_thread.daemon = True
+            self._replay_thread.start()
+
+        if isinstance(retention, datetime.timedelta):
+            retention = retention.days * 86400 + retention.seconds
+        self.retention = retention
+        self.retention_interval = retention_interval
+        self._retention_stop = threading.Event()
+        if retention is not None and self.partitioned:
+            thread = threading.Thread(target=self._retain,
+                                      name='CouchDBLogHandler-retention')
+            thread.daemon = True
+            thread.start()
+
+        self.stats_interval = stats_interval
+        self._stats_rev = None
+        self._stats_stop = threading.Event()
+        if stats_interval is not None:
+            thread = threading.Thread(target=self._write_stats_loop,
+                                      name='CouchDBLogHandler-stats')
+            thread.daemon = True
+            thread.start()
+
+    def _server_url(self, host, port, username, password):
+        """
+            Return the url of a couchdb server
+
+        :param host: host of couchdb, 'host:port' or (host, port)
+        :param port: default port of couchdb
+        :param username: user's name for logging in the database
+        :param password: password for logging in the database
+        """
+        if isinstance(host, (tuple, list)):
+            host, port = host
+        elif ':' in host:
+            host, port = host.rsplit(':', 1)
+            port = int(port)
+
+        if self.ssl:
+            protocol = 'https'
+            if username:
+                host = "%(username)s:%(password)s@%(host)s" % dict(
+                    username=username,
+                    password=password,
+                    host=host
+                )
+        else:
+            protocol = 'http'
+
+        return "%(protocol)s://%(host)s:%(port)d" % dict(
+            protocol=protocol,
+            host=host,
+            port=port,
+        )
+
+    def _connect(self, username, password, create_database):
+        """
+            Open the couchdb session and create the database
+
+        :param username: user's name for logging in the database
+        :param password: password for logging in the database
+        :param create_database: bool to create the database if it does not exist
+        """
+        session, db_url = self.session, self.db_url
+        if self.nodes is not None:
+            if username:
+                self.nodes.login(username, password)
+            # the database is created through a node in service
+            node = (self.nodes.healthy() or self.nodes.nodes)[0]
+            session, db_url = node.session, node.db_url
+        elif username:
+            self.session.login(self.url, username, password)
+
+        if create_database and not self.partitioned:
+            try:
+                session.get(db_url)
+            except CouchDBSession.CouchDBException:
+                session.put(db_url)
+            self.databases.add(self.database)
+        if self.install_views and not self.partitioned:
+            CouchDBLogReader.install(session, db_url)
+
+    def _ensure_connected(self):
+        """
+            Log in and create the database, once
+        """
+        if self._connected:
+            return
+        with self._connect_lock:
+            if not self._connected:
+                self._connect(self._credentials[0], self._credentials[1],
+                              self._create_database)
+                self._connected = True
+
+    def _warm_up(self):
+        """
+            Worker thread connecting a lazy handler
+        """
+        try:
+            self._ensure_connected()
+        except Exception:
+            pass  # tried again by the first request
+
+    def _server(self):
+        """
+            Return the session and the url of a couchdb server in service
+        """
+        self._ensure_connected()
+        if self.nodes is None:
+            return self.session, self.url
+        node = self.nodes.candidates()[0]
+        return node.session, node.url
+
+    def _partition(self, created):
+        """
+            Return the name of the time-partitioned database of a record,
+            None when the handler is not partitioned
+
+        :param created: time the record was created (time.time())
+        """
+        if not self.partitioned:
+            return None
+        return time.strftime(self.database, time.gmtime(created))
+
+    def _ensure_database(self, database):
+        """
+            Create a database unless it is known to exist
+
+        :param database: database's name
+        """
+        if database is None or database in self.databases:
+            return
+        session, url = self._server()
+        try:
+            session.get(url + '/' + database)
+        except CouchDBSession.CouchDBException as exc:
+            if exc.status_code != 404:
+                raise
+            try:
+                session.put(url + '/' + database)
+            except CouchDBSession.CouchDBException as exc:
+                if exc.status_code != 412:  # created meanwhile
+                    raise
+        if self.install_views:
+            CouchDBLogReader.install(session, url + '/' + database)
+        with self._databases_lock:
+            self.databases.add(database)
+
+    def _partition_period(self):
+        # seconds covered by one partition, from its finest directive
+        for directive, seconds in (('%S', 1), ('%M', 60), ('%H', 3600),
+                                   ('%d', 86400), ('%j', 86400),
+                                   ('%U', 7 * 86400), ('%W', 7 * 86400),
+                                   ('%m', 31 * 86400)):
+            if directive in self.database:
+                return seconds
+        return 366 * 86400
+
+    def expired_databases(self, names, now=None):
+        """
+            Return the time-partitioned databases older than the retention
+
+        :param names: database's names (from /_all_dbs)
+        :param now: current time (time.time())
+        """
+        cutoff = (now or time.time()) - self.retention
+        period = self._partition_period()
+        pattern, suffix = self.database, ''
+        if (('%U' in pattern or '%W' in pattern) and
+                not any(directive in pattern
+                        for directive in ('%w', '%u', '%a', '%A'))):
+            # strptime ignores a week number without a weekday: the
+            # partition starts on the first day of its week
+            pattern += ' %w'
+            suffix = ' 0' if '%U' in pattern else ' 1'
+        expired = []
+        for name in names:
+            try:
+                start = calendar.timegm(datetime.datetime.strptime(
+                    name + suffix, pattern).timetuple())
+            except ValueError:  # not a partition of this handler
+                continue
+            if start + period <= cutoff:
+                expired.append(name)
+        return expired
+
+    def apply_retention(self):
+        """
+            Delete the time-partitioned databases older than the retention
+        """
+        session, url = self._server()
+        names = session.get(url + '/_all_dbs').json()
+        for name in self.expired_databases(names):
+            session.delete(url + '/' + name)
+            with self._databases_lock:
+                self.databases.discard(name)
+
+    def _retain(self):
+        """
+            Worker thread applying the retention policy
+        """
+        while not self._retention_stop.wait(self.retention_interval):
+            try:
+                self.apply_retention()
+            except Exception:
+                self.handleError(logging.makeLogRecord({
+                    'msg': 'Unable to apply the retention of %s',
+                    'args': (self.database,),
+                }))
+
+    def write_stats(self):
+        """
+            Write the metrics snapshot to the document
+            _local/couchdblogger-<host>-<pid> of the database
+        """
+        database = self._partition(time.time()) or self.database
+        self._ensure_database(database)
+        session, url = self._server()
+        doc_url = '%s/%s/_local/couchdblogger-%s-%d' % (
+            url, database, socket.gethostname(), os.getpid())
+        doc = self.metrics.snapshot()
+        doc['time'] = time.time()
+        for attempt in range(2):
+            if self._stats_rev is not None:
+                doc['_rev'] = self._stats_rev
+            try:
+                resp = session.put(doc_url, data=json.dumps(doc),
+                                   headers={'Content-type': 'application/json'})
+                self._stats_rev = resp.json().get('rev')
+                return
+            except CouchDBSession.CouchDBException as exc:
+                if exc.status_code != 409 or attempt:
+                    raise
+                # written by an earlier process with the same pid
+                self._stats_rev = session.get(doc_url).json().get('_rev')
+
+    def _write_stats_loop(self):
+        """
+            Worker thread writing the metrics
+        """
+        while not self._stats_stop.wait(self.stats_interval):
+            try:
+                self.write_stats()
+            except Exception:
+                self.handleError(logging.makeLogRecord({
+                    'msg': 'Unable to write the metrics to %s',
+                    'args': (self.database,),
+                }))
+
+    def _after_fork(self):
+        """
+            Drop the state inherited from the parent process: the session
+            shares its sockets with the parent, the spool belongs to it and
+            the locks may have been held by its threads
+        """
+        self._pid = os.getpid()
+        if self.nodes is not None:
+            self.nodes.reset()
+            self.session = self.nodes.nodes[0].session
+        else:
+            self.session = self.session.clone()
+        self.spool = None
+        self._replay_thread = None
+        # logged in again by the first request of the child
+        self._create_database = False
+        self._connected = False
+        self._connect_lock = threading.Lock()
+        self._databases_lock = threading.Lock()
+        for owner in (self.id_generator, self.metrics, self.payloads,
+                      self.sampler, self.circuit_breaker):
+            if getattr(owner, '_lock', None) is not None:
+                owner._lock = threading.Lock()
+
+    def new_format(self, format_function):
+        """
+            Change the format logging
+
+        :param format_function: function to generate couchdb logs from record
+
+        REQUIRED: The function must return a json.dumps to post in couchdb
+        """
+        self.format = format_function
+
+    def format(self, record):
+        """
+            Format a logging record to couchdb record
+
+        :param record: loggging record (LogRecord)
+        The useful attributes in a LogRecord are described by:
+
+        %(name)s            Name of the logger (logging channel)
+        %(levelno)s         Numeric logging level for the message (DEBUG, INFO,
+                            WARNING, ERROR, CRITICAL)
+        %(levelname)s       Text logging level for the message ("DEBUG", "INFO",
+                            "WARNING", "ERROR", "CRITICAL")
+        %(pathname)s        Full pathname of the source file where the logging
+                            call was issued (if available)
+        %(filename)s        Filename portion of pathname
+        %(module)s          Module (name portion of filename)
+        %(lineno)d          Source line number where the logging call was issued
+                            (if available)
+        %(funcName)s        Function name
+        %(created)f         Time when the LogRecord was created (time.time()
+                            return value)
+        %(asctime)s         Textual time when the LogRecord was created
+        %(msecs)d           Millisecond portion of the creation time
+        %(relativeCreated)d Time in milliseconds when the LogRecord was created,
+                            relative to the time the logging module was loaded
+                            (typically at application startup time)
+        %(thread)d          Thread ID (if available)
+        %(threadName)s      Thread name (if available)
+        %(process)d         Process ID (if available)
+        %(message)s         The result of record.getMessage(), computed just as
+                            the record is emitted
+
+        The fields of the document are set by the `fields` and
+        `static_fields` arguments of the handler.
+        """
+        return self.encoder.encode(record)
+
+    def emit(self, record):
+        """
+            Emit a logging record
+
+        :param record: loggging record
+        """
+        headers = {'Content-type': 'application/json'}
+        metrics = self.metrics
+        start = time.time()
+        try:
+            if self._pid != os.getpid():
+                # before the metrics, which may take their lock
+                self._after_fork()
+            metrics.incr('emitted')
+            weight = None
+            if self.sampler is not None:
+                weight = self.sampler.sample(record, self._load)
+                if weight is None:
+                    metrics.incr('sampled')
+                    return
+            docs = self._documents(record, weight)
+            metrics.observe('serialize', time.time() - start)
+            database = self._partition(record.created)
+            if self.spool is not None and self.spool.pending():
+                # keep the order and do not wait for a dead server
+                self.spool.append(docs, database)
+                metrics.incr('spooled', len(docs))
+                return
+            # with the payload documents of its large texts, if any
+            rejected = self._deliver(docs, database, bulk=len(docs) > 1)
+            if rejected:
+                raise CouchDBSession.CouchDBException(
+                    'document rejected: %s' % rejected[0][1], 400)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            metrics.incr('failed')
+            self.handleError(record)
+        finally:
+            metrics.observe('emit', time.time() - start)
+
+    def _deliver(self, docs, database=None, bulk=True):
+        """
+            Write documents under the retry policy and the circuit
+            breaker. The documents still failing when couchdb is
+            unreachable go to the spool, or are dropped while the circuit
+            is open; other errors are raised.
+
+        :param docs: list of json documents (str)
+        :param database: database's name, None for the database of the
+            handler
+        :param bulk: post through _bulk_docs, else post the one document
+            to the database
+        :return: list of (document, error) rejected by couchdb
+        """
+        try:
+            rejected = self._write(docs, database, bulk)
+        except Exception:
+            self._forget(docs)
+            raise
+        if rejected:
+            self._forget([doc for doc, _ in rejected])
+        return rejected
+
+    def _write(self, docs, database, bulk=True, fallback=True):
+        # retry loop of _deliver and of the spool replay, which has no
+        # fallback: what cannot be written now raises and is replayed again
+        breaker = self.circuit_breaker
+        delays = iter(()) if self.retry is None else self.retry.delays()
+        rejected = []
+        while True:
+            if breaker is not None and not breaker.allow():
+                if not fallback:
+                    raise CouchDBSession.CouchDBException(
+                        'circuit breaker open', 503)
+                self._fallback(docs, database)
+                return rejected
+            try:
+                self._ensure_database(database)
+                if bulk:
+                    failed = self._rejected(docs,
+                                            self._post_bulk(docs, database))
+                else:
+                    failed = self._post_one(docs[0], database)
+            except Exception as exc:
+                transient = CouchDBRetry.transient(exc)
+                if breaker is not None:
+                    if transient:
+                        breaker.failure()
+                    else:
+                        breaker.success()  # couchdb answered
+                delay = next(delays, None) if transient else None
+                if delay is None:
+                    if (not fallback or self.spool is None or
+                            not _is_unreachable(exc)):
+                        raise
+                    self._fallback(docs, database)
+                    return rejected
+                time.sleep(delay)
+                continue
+            if breaker is not None:
+                breaker.success()
+            retried = []
+            for doc, error in failed:
+                if error in CouchDBRetry.PERMANENT_ERRORS:
+                    rejected.append((doc, error))
+                else:
+                    retried.append((doc, error))
+            if not retried:
+                return rejected
+            docs = [doc for doc, _ in retried]
+            delay = next(delays, None)
+            if delay is None:
+                if not fallback:
+                    raise CouchDBSession.CouchDBException(
+                        '%d documents not written: %s' % (len(retried),
+                                                          retried[0][1]),
+                        503)
+                if self.spool is None:
+                    return rejected + retried
+                self._fallback(docs, database)
+                return rejected
+            time.sleep(delay)
+
+    def _fallback(self, docs, database):
+        # documents couchdb could not take now: spooled, or dropped while
+        # the circuit is open
+        if self.spool is not None:
+            self.spool.append(docs, database)
+            self.metrics.incr('spooled', len(docs))
+        else:
+            self.metrics.incr('dropped', len(docs))
+            self._forget(docs)
+
+    def _forget(self, docs):
+        # payload documents not written are uploaded again by the next
+        # record with the same text
+        if self.payloads:
+            self.payloads.forget(docs)
+
+    def _post_one(self, doc, database=None):
+        """
+            Post one document to the database
+
+        :param doc: json document (str)
+        :param database: database's name, None for the database of the
+            handler
+        :return: [] (couchdb answers an error status for the document)
+        """
+        headers = {'Content-type': 'application/json'}
+        body = lambda: doc
+        if self.compress and len(doc) >= self.compress_min_size:
+            body = lambda: self._gzip([doc])
+            headers['Content-Encoding'] = 'gzip'
+        try:
+            self._post('', body, headers, database)
+        except CouchDBSession.CouchDBException as exc:
+            if exc.status_code == 409:
+                return []  # written by an earlier attempt
+            raise
+        self.metrics.incr('documents_sent')
+        self.metrics.incr('bytes_sent', len(doc))
+        return []
+
+    @staticmethod
+    def _rejected(docs, resp):
+        """
+            Return the (document, error) of a _bulk_docs request which
+            were not written, the documents already written (conflict on
+            their _id) are not
+
+        :param docs: list of json documents (str) sent
+        :param resp: response of _bulk_docs
+        """
+        try:
+            results = resp.json()
+        except Exception:
+            return []
+        return CouchDBLogHandler._errors(docs, results)
+
+    @staticmethod
+    def _errors(docs, results):
+        """
+            Return the (document, error) not written from the decoded
+            results of a _bulk_docs request
+
+        :param docs: list of json documents (str) sent
+        :param results: decoded response of _bulk_docs
+        """
+        if not isinstance(results, list) or len(results) != len(docs):
+            return []
+        return [(doc, result['error']) for doc, result in zip(docs, results)
+                if isinstance(result, dict) and 'error' in result and
+                result['error'] != 'conflict']
+
+    def _documents(self, record, weight=None):
+        """
+            Format a logging record to a couchdb document with its id and
+            its exception, preceded by the payload documents of its large
+            texts
+
+        :param record: loggging record
+        :param weight: sample weight of the record, None when not sampled
+        :return: list of json documents (str), the record's one last
+        """
+        fields, docs = [], []
+        if not self.id_generator:
+            doc = self.format(record)
+        elif getattr(self.format, '__func__', None) is _encoder_format:
+            # the compiled encoder writes the _id, no copy of the json
+            doc = self.encoder.encode_id(record,
+                                         self.id_generator(record.created))
+        else:
+            doc = self.format(record)
+            fields.append(('_id', self.id_generator(record.created)))
+        if weight is not None:
+            fields.append(('sample_weight', weight))
+        payloads = self.payloads
+        if payloads and len(doc) > payloads.threshold:
+            doc = self._compact_message(record, doc, fields, docs)
+        exc_text = getattr(record, 'exc_text', None)
+        exc_info = getattr(record, 'exc_info', None)
+        stack_info = getattr(record, 'stack_info', None)
+        if self.capture_exceptions and (exc_text or exc_info or stack_info):
+            if not exc_text and exc_info:
+                exc_text = _exception_formatter.formatException(exc_info)
+            for name, text in (('exception', exc_text),
+                               ('stack', stack_info)):
+                if not text:
+                    continue
+                if payloads and len(text) > payloads.threshold:
+                    payload_fields, payload_docs = payloads.compact(name, text)
+                    fields.extend(payload_fields)
+                    docs.extend(payload_docs)
+                else:
+                    fields.append((name, text))
+        if fields:
+            doc = _add_fields(doc, fields)
+        docs.append(doc)
+        return docs
+
+    def _compact_message(self, record, doc, fields, docs):
+        # rare path: decode the document to replace its large message
+        message = record.getMessage()
+        if len(message) <= self.payloads.threshold:
+            return doc
+        data = json.loads(doc)
+        for key, attribute in self.encoder.fields:
+            if attribute == 'message' and key in data:
+                del data[key]
+                payload_fields, payload_docs = self.payloads.compact(key,
+                                                                     message)
+                fields.extend(payload_fields)
+                docs.extend(payload_docs)
+        return _json_any(data)
+
+    def close(self):
+        """
+            Stop the spool replay and close the handler
+        """
+        self._replay_stop.set()
+        self._retention_stop.set()
+        self._stats_stop.set()
+        if self.nodes is not None:
+            self.nodes.stop()
+        if self._replay_thread is not None:
+            self._replay_thread.join(self.spool_retry_interval)
+            self.spool.close()
+        super(CouchDBLogHandler, self).close()
+
+    def _post_bulk(self, docs, database=None):
+        """
+            Post formatted documents to _bulk_docs
+
+        :param docs: list of json documents (str)
+        :param database: database's name, None for the database of the
+            handler
+        """
+        headers = {'Content-type': 'application/json'}
+        size = sum(len(doc) for doc in docs) + len(docs) + 10
+        if self.compress and size >= self.compress_min_size:
+            body = lambda: self._gzip(self._bulk_pieces(docs))
+            headers['Content-Encoding'] = 'gzip'
+        else:
+            data = '{"docs":[' + ','.join(docs) + ']}'
+            body = lambda: data
+        resp = self._post('/_bulk_docs', body, headers, database)
+        self.metrics.incr('documents_sent', len(docs))
+        self.metrics.incr('bytes_sent', size)
+        return resp
+
+    def _post(self, suffix, body, headers, database=None):
+        """
+            Post to the database, on a node of the cluster when nodes are
+            given
+
+        :param suffix: path after the database url ('' or '/_bulk_docs')
+        :param body: function returning the request body
+        :param headers: request headers
+        :param database: database's name, None for the database of the
+            handler
+        """
+        self._ensure_connected()
+        path = '/' + (database or self.database) + suffix
+        self.metrics.incr('requests')
+        start = time.time()
+        try:
+            if self.nodes is not None:
+                return self.nodes.post(path, body, headers)
+            url = self.db_url + suffix if database is None else self.url + path
+            return self.session.post_body(url, body, headers=headers)
+        finally:
+            elapsed = time.time() - start
+            self.metrics.observe('request', elapsed)
+            self._latency += (elapsed - self._latency) * 0.2
+
+    def _load(self):
+        """
+            Return the load read by the sampler: (latency of the recent
+            requests, fraction of the queue filled)
+        """
+        return self._latency, 0.0
+
+    def _probe(self):
+        """
+            Raise an exception when couchdb is unreachable
+        """
+        self._ensure_connected()
+        if self.nodes is None:
+            self.session.get(self.url + '/')
+        elif not self.nodes.healthy():
+            raise CouchDBSession.CouchDBException('no healthy node', 503)
+
+    @staticmethod
+    def _bulk_pieces(docs):
+        yield '{"docs":['
+        for i, doc in enumerate(docs):
+            if i:
+                yield ','
+            yield doc
+        yield ']}'
+
+    def _gzip(self, pieces):
+        """
+            Compress the body while it is sent (chunked transfer encoding),
+            no compressed copy of the whole body is built
+
+        :param pieces: iterable of str making the body
+        """
+        compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        uncompressed = compressed = 0
+        for piece in pieces:
+            piece = piece.encode('utf-8')
+            uncompressed += len(piece)
+            chunk = compressor.compress(piece)
+            if chunk:
+                compressed += len(chunk)
+                yield chunk
+        chunk = compressor.flush()
+        compressed += len(chunk)
+        yield chunk
+        self.uncompressed_bytes += uncompressed
+        self.compressed_bytes += compressed
+
+    @property
+    def compression_ratio(self):
+        """
+            Uncompressed size / compressed size of the bodies sent gzip
+            compressed so far, None before the first one
+        """
+        if not self.compressed_bytes:
+            return None
+        return float(self.uncompressed_bytes) / self.compressed_bytes
+
+    def _replay(self):
+        """
+            Worker thread uploading the spool once couchdb is reachable
+        """
+        while not self._replay_stop.is_set():
+            if self.spool.pending():
+                try:
+                    self._probe()
+                    self.spool.replay(self._replay_send)
+                    continue
+                except Exception:
+                    pass
+            self._replay_stop.wait(self.spool_retry_interval)
+
+    def _replay_send(self, docs, database=None):
+        try:
+            rejected = self._write(docs, database, fallback=False)
+        except Exception as exc:
+            if _is_unreachable(exc):
+                raise  # the checkpoint stays before this batch
+            # couchdb rejected the batch, replaying it again would not help
+            self.handleError(logging.makeLogRecord({
+                'msg': 'Unable to replay %d records to %s',
+                'args': (len(docs), database or self.database),
+            }))
+            return
+        if rejected:
+            self.metrics.incr('failed', len(rejected))
+            self.handleError(logging.makeLogRecord({
+                'msg': 'CouchDB rejected %d of %d replayed records to %s: %s',
+                'args': (len(rejected), len(docs), database or self.database,
+                         rejected[0][1]),
+            }))
+
+
+# format of the handlers formatting with their compiled encoder
+_encoder_format = CouchDBLogHandler.__dict__['format']
+
+
+class _Flush(object):
+    """
+        Marker put on the queue of CouchDBBulkLogHandler to ask the
+        worker thread to ship everything queued before it
+    """
+    __slots__ = ('event', 'stop')
+
+    def __init__(self, stop=False):
+        self.event = threading.Event()
+        self.stop = stop
+
+
+class CouchDBRecord(object):
+    """
+        CouchDBRecord:
+            Compact snapshot of a logging record queued by
+            CouchDBBulkLogHandler. The message is rendered and the
+            exception formatted when the record is emitted, args, exc_info
+            and the __dict__ of the LogRecord are not kept. CouchDBRecord
+            keeps every attribute of ATTRIBUTES, the class returned by
+            capturing() only the ones the documents need.
+    """
+
+    ATTRIBUTES = ('name', 'levelno', 'levelname', 'pathname', 'filename',
+                  'module', 'lineno', 'funcName', 'created', 'msecs',
+                  'relativeCreated', 'thread', 'threadName', 'process',
+                  'processName', 'exc_text', 'stack_info')
+    # read by the handler (deduplication, overflow, partitions)
+    REQUIRED = ('name', 'levelno', 'created')
+    __slots__ = ('message', 'extra', 'size', 'collapsed', 'weight')
+    CAPTURED = ()
+
+    # approximate size of the snapshot without its strings: the object,
+    # and the slot and value of every captured attribute
+    OVERHEAD = 100
+    ATTRIBUTE_OVERHEAD = 12
+    args = None
+    exc_info = None
+    exc_text = None
+    stack_info = None
+    _classes = {}
+
+    @classmethod
+    def capturing(cls, attributes):
+        """
+            Return the CouchDBRecord class keeping only these attributes
+            (and REQUIRED), the others read as missing
+
+        :param attributes: names of LogRecord attributes, those out of
+            ATTRIBUTES are ignored
+        """
+        captured = tuple(name for name in cls.ATTRIBUTES
+                         if name in attributes or name in cls.REQUIRED)
+        record_class = cls._classes.get(captured)
+        if record_class is None:
+            record_class = cls._classes.setdefault(captured, type(
+                'CouchDBRecord', (cls,), {
+                    '__slots__': captured, 'CAPTURED': captured,
+                    'OVERHEAD': cls.OVERHEAD +
+                    cls.ATTRIBUTE_OVERHEAD * len(captured)}))
+        return record_class
+
+    def __new__(cls, record, extra=(), weight=None):
+        if cls is CouchDBRecord:
+            cls = cls.capturing(cls.ATTRIBUTES)
+        return object.__new__(cls)
+
+    def __init__(self, record, extra=(), weight=None):
+        """
+            Capture a logging record
+
+        :param record: loggging record (LogRecord)
+        :param extra: names of other attributes of the record to keep
+        :param weight: sample weight of the record, None when not sampled
+        """
+        for name in self.CAPTURED:
+            setattr(self, name, getattr(record, name, None))
+        self.message = record.getMessage()
+        if (record.exc_info and not self.exc_text and
+                'exc_text' in self.CAPTURED):
+            self.exc_text = _exception_formatter.formatException(
+                record.exc_info)
+        self.extra = None
+        if extra:
+            self.extra = dict((name, getattr(record, name)) for name in extra
+                              if hasattr(record, name))
+        self.size = (self.OVERHEAD + len(self.message) +
+                     len(self.exc_text or '') + len(self.stack_info or ''))
+        # (count, first_created, last_created) of collapsed duplicates
+        self.collapsed = None
+        self.weight = weight
+
+    @property
+    def msg(self):
+        return self.message
+
+    def getMessage(self):
+        """
+            Return the rendered message, as LogRecord.getMessage
+        """
+        return self.message
+
+    def __getattr__(self, name):
+        extra = self.extra
+        if extra and name in extra:
+            return extra[name]
+        raise AttributeError(name)
+
+
+class CouchDBRecordBuffer(object):
+    """
+        CouchDBRecordBuffer:
+            Queue of CouchDBRecord bounded by a byte budget. When a record
+            does not fit, the overflow policy applies:
+
+            block:       wait for room at most `timeout` seconds, then drop
+                         the new record
+            drop_newest: drop the new record
+            drop_oldest: drop the oldest queued records
+            drop_level:  drop the oldest queued records below `level`
+                         first, then the new record when it is below
+                         `level`, then the oldest queued records
+
+            The dropped records are counted in dropped_newest,
+            dropped_oldest and dropped_level.
+    """
+
+    OVERFLOWS = ('block', 'drop_newest', 'drop_oldest', 'drop_level')
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, max_records=0,
+                 overflow='drop_newest', timeout=1.0, level=logging.WARNING):
+        """
+            Initialize the buffer
+
+        :param max_bytes: byte budget of the queued records
+        :param max_records: max number of queued records, 0 for unbounded
+        :param overflow: overflow policy, one of OVERFLOWS
+        :param timeout: max seconds the block policy waits
+        :param level: records below this level are dropped first by the
+            drop_level policy
+        """
+        if overflow not in self.OVERFLOWS:
+            raise ValueError('overflow must be one of %s' % (self.OVERFLOWS,))
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.overflow = overflow
+        self.timeout = timeout
+        self.level = level
+        self.bytes = 0
+        self.records = 0
+        self.dropped_newest = 0
+        self.dropped_oldest = 0
+        self.dropped_level = 0
+
+        self._items = collections.deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    def qsize(self):
+        """
+            Return the number of queued items
+        """
+        return len(self._items)
+
+    def put(self, item, block=True, timeout=None):
+        """
+            Queue a record (or a marker of the worker thread, which is
+            never dropped)
+
+        :param item: CouchDBRecord
+        :return: False when the record was dropped
+        """
+        with self._lock:
+            size = getattr(item, 'size', None)
+            if size is not None:
+                if not self._fits(size) and not self._make_room(item):
+                    return False
+                self.bytes += size
+                self.records += 1
+            self._items.append(item)
+            self._not_empty.notify()
+            return True
+
+    def put_nowait(self, item):
+        return self.put(item, block=False)
+
+    def get(self, block=True, timeout=None):
+        """
+            Remove and return the oldest item
+
+        :param timeout: max seconds to wait for an item
+        :raise queue.Empty: when no item came in time
+        """
+        with self._lock:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while not self._items:
+                if not block:
+                    raise queue.Empty
+                if timeout is None:
+                    self._not_empty.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self._not_empty.wait(remaining)
+            item = self._items.popleft()
+            self._forget(item)
+            return item
+
+    def _forget(self, item):
+        size = getattr(item, 'size', None)
+        if size is not None:
+            self.bytes -= size
+            self.records -= 1
+            self._not_full.notify()
+
+    def _fits(self, size):
+        if self.max_records and self.records >= self.max_records:
+            return False
+        return not self.records or self.bytes + size <= self.max_bytes
+
+    def _drop_oldest(self, below=None):
+        for i, item in enumerate(self._items):
+            level = getattr(item, 'levelno', None)
+            if level is not None and (below is None or level < below):
+                del self._items[i]
+                self._forget(item)
+                return True
+        return False
+
+    def _make_room(self, item):
+        if self.overflow == 'block':
+            deadline = time.time() + self.timeout
+            while not self._fits(item.size):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.dropped_newest += 1
+                    return False
+                self._not_full.wait(remaining)
+            return True
+
+        if self.overflow == 'drop_level':
+            while not self._fits(item.size) and self._drop_oldest(self.level):
+                self.dropped_level += 1
+            if self._fits(item.size):
+                return True
+            if (item.levelno or 0) < self.level:
+                self.dropped_level += 1
+                return False
+        elif self.overflow == 'drop_newest':
+            self.dropped_newest += 1
+            return False
+
+        while not self._fits(item.size) and self._drop_oldest():
+            self.dropped_oldest += 1
+        return True
+
+
+class CouchDBDeduplicator(object):
+    """
+        CouchDBDeduplicator:
+            Collapses repeated records into one document carrying count,
+            first_created and last_created. A record is held until no
+            repeat came for `window` seconds (or for at most `max_age`
+            seconds), the held records are kept in a LRU of `max_keys`
+            entries, the least recently repeated one is released when it
+            is full.
+    """
+
+    def __init__(self, window=1.0, max_age=60.0, max_keys=10000, key=None):
+        """
+            Initialize the deduplicator
+
+        :param window: seconds without a repeat after which a record is
+            released
+        :param max_age: max seconds a record is held
+        :param max_keys: max number of held records
+        :param key: function returning the key of a record, by default
+            (logger, level, message template)
+        """
+        self.window = window
+        self.max_age = max_age
+        self.max_keys = max_keys
+        if key is not None:
+            self.key = key
+        self.collapsed = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(record):
+        """
+            Return the key of a record: (logger, level, message template)
+
+        :param record: loggging record (LogRecord)
+        """
+        return record.name, record.levelno, str(record.msg)
+
+    def add(self, record, capture):
+        """
+            Hold a record or count it as a repeat of a held one
+
+        :param record: loggging record (LogRecord)
+        :param capture: function returning the snapshot of a record
+        :return: list of snapshots released by the LRU
+        """
+        key = self.key(record)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                entry[1] += 1
+                entry[3] = record.created
+                self._entries[key] = entry
+                self.collapsed += 1
+                return []
+            self._entries[key] = [capture(record), 1, record.created,
+                                  record.created]
+            if len(self._entries) <= self.max_keys:
+                return []
+            return [self._release(self._entries.popitem(last=False)[1])]
+
+    def expired(self, flush=False):
+        """
+            Release the held records whose window is over
+
+        :param flush: bool to release every held record
+        :return: list of snapshots
+        """
+        now = time.time()
+        released = []
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if (flush or now - entry[3] >= self.window or
+                        now - entry[2] >= self.max_age):
+                    del self._entries[key]
+                    released.append(self._release(entry))
+        return released
+
+    @staticmethod
+    def _release(entry):
+        record, count, first_created, last_created = entry
+        if count > 1:
+            record.collapsed = (count, first_created, last_created)
+        return record
+
+
+class CouchDBBulkLogHandler(CouchDBLogHandler):
+    """
+        CouchDBBulkLogHandler that inherits from CouchDBLogHandler
+
+        CouchDBBulkLogHandler:
+            emit only queues a compact snapshot of the record
+            (CouchDBRecord) in a buffer bounded by a byte budget, a
+            background thread formats and ships the queued records through
+            <database>/_bulk_docs once batch_size records, batch_bytes
+            bytes or flush_interval seconds are reached
+
+        CouchDBLogHandler:
+            Handler which writes logging records to CouchDB
+    """
+
+    def __init__(self, batch_size=500, batch_bytes=1024 * 1024,
+                 flush_interval=1.0, queue_size=0, flush_timeout=30.0,
+                 buffer_bytes=16 * 1024 * 1024, overflow='drop_newest',
+                 overflow_timeout=1.0, overflow_level=logging.WARNING,
+                 deduplicate=None, **kwargs):
+        """
+            Initialize the couchdb bulk handler
+
+        :param batch_size: max number of records in one _bulk_docs request
+        :param batch_bytes: max size (in bytes) of the records in one
+            _bulk_docs request
+        :param flush_interval: max seconds a record waits in the queue
+        :param queue_size: max number of queued records, 0 for unbounded
+        :param flush_timeout: max seconds flush() and close() wait for the
+            queue to drain
+        :param buffer_bytes: byte budget of the queued records
+        :param overflow: what to do with a record which does not fit in
+            the budget, 'block', 'drop_newest', 'drop_oldest' or
+            'drop_level' (see CouchDBRecordBuffer)
+        :param overflow_timeout: max seconds emit blocks with the 'block'
+            policy
+        :param overflow_level: records below this level are dropped first
+            with the 'drop_level' policy
+        :param deduplicate: CouchDBDeduplicator (or its window in seconds)
+            collapsing the repeated records
+        :param kwargs: arguments of CouchDBLogHandler
+        """
+        super(CouchDBBulkLogHandler, self).__init__(**kwargs)
+
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.flush_timeout = flush_timeout
+
+        if (deduplicate is not None and
+                not isinstance(deduplicate, CouchDBDeduplicator)):
+            deduplicate = CouchDBDeduplicator(window=deduplicate)
+        self.deduplicator = deduplicate
+
+        self._buffer_args = dict(max_bytes=buffer_bytes,
+                                 max_records=queue_size, overflow=overflow,
+                                 timeout=overflow_timeout,
+                                 level=overflow_level)
+        self.queue = CouchDBRecordBuffer(**self._buffer_args)
+        self.metrics.gauges['queue_depth'] = lambda: self.queue.qsize()
+        self.metrics.gauges['dropped'] = lambda: sum(self.dropped.values())
+        # attributes of the records needed by the documents
+        attributes = [attribute for _, attribute in self.encoder.fields
+                      if attribute != 'message']
+        if self.capture_exceptions:
+            attributes.extend(('exc_text', 'stack_info'))
+        self._record_class = CouchDBRecord.capturing(attributes)
+        self._extra_attributes = tuple(
+            attribute for attribute in attributes
+            if attribute not in CouchDBRecord.ATTRIBUTES)
+        self._start()
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='CouchDBBulkLogHandler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _after_fork(self):
+        """
+            Start a new queue and worker thread in the child process, the
+            records queued by the parent are shipped by the parent
+        """
+        super(CouchDBBulkLogHandler, self)._after_fork()
+        if self.deduplicator is not None:
+            self.deduplicator._lock = threading.Lock()
+        self.queue = CouchDBRecordBuffer(**self._buffer_args)
+        self._start()
+
+    @property
+    def dropped(self):
+        """
+            Counters of the records dropped because the buffer was full
+        """
+        return dict(newest=self.queue.dropped_newest,
+                    oldest=self.queue.dropped_oldest,
+                    level=self.queue.dropped_level)
+
+    def emit(self, record):
+        """
+            Queue a logging record
+
+        :param record: loggging record
+        """
+        if threading.current_thread() is self._thread:
+            # records logged while shipping (e.g. by urllib3) would feed
+            # the queue forever
+            return
+        metrics = self.metrics
+        start = time.time()
+        try:
+            if self._pid != os.getpid():
+                # before the metrics, which may take their lock
+                self._after_fork()
+            metrics.incr('emitted')
+            capture = self._capture
+            if self.sampler is not None:
+                weight = self.sampler.sample(record, self._load)
+                if weight is None:
+                    metrics.incr('sampled')
+                    return
+                capture = lambda record: self._capture(record, weight)
+            if self.deduplicator is not None:
+                for snapshot in self.deduplicator.add(record, capture):
+                    self.queue.put(snapshot)
+            else:
+                self.queue.put(capture(record))
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            metrics.incr('failed')
+            self.handleError(record)
+        finally:
+            metrics.observe('emit', time.time() - start)
+
+    def _capture(self, record, weight=None):
+        if getattr(self.format, '__func__', None) is _encoder_format:
+            return self._record_class(record, self._extra_attributes, weight)
+        # a format function may read any attribute
+        return CouchDBRecord(record, self._extra_attributes, weight)
+
+    def _load(self):
+        queue = self.queue
+        fill = float(queue.bytes) / queue.max_bytes if queue.max_bytes else 0.0
+        if queue.max_records:
+            fill = max(fill, float(queue.records) / queue.max_records)
+        return self._latency, fill
+
+    def flush(self):
+        """
+            Wait until every record queued so far has been shipped
+        """
+        self._drain(_Flush())
+
+    def close(self):
+        """
+            Ship the queued records and stop the worker thread
+        """
+        self._drain(_Flush(stop=True))
+        self._thread.join(self.flush_timeout)
+        super(CouchDBBulkLogHandler, self).close()
+
+    def _drain(self, marker):
+        if (not self._thread.is_alive() or
+                threading.current_thread() is self._thread):
+            return
+        self.queue.put(marker)
+        marker.event.wait(self.flush_timeout)
+
+    def _run(self):
+        records, size, deadline = [], 0, None
+        deduplicator = self.deduplicator
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, deadline - time.time())
+            if deduplicator is not None and (timeout is None or
+                                             timeout > deduplicator.window):
+                timeout = deduplicator.window
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            marker = item if isinstance(item, _Flush) else None
+
+            incoming = [item] if item is not None and marker is None else []
+            if deduplicator is not None:
+                incoming.extend(deduplicator.expired(flush=marker is not None))
+            for record in incoming:
+                records.append(record)
+                size += record.size
+                if deadline is None:
+                    deadline = time.time() + self.flush_interval
+                if len(records) >= self.batch_size or size >= self.batch_bytes:
+                    self._ship_records(records)
+                    records, size, deadline = [], 0, None
+
+            if marker is not None or (deadline is not None and
+                                      time.time() >= deadline):
+                self._ship_records(records)
+                records, size, deadline = [], 0, None
+            if marker is not None:
+                marker.event.set()
+                if marker.stop:
+                    return
+
+    def _ship_records(self, records):
+        """
+            Format and ship queued records, one batch per time-partitioned
+            database
+
+        :param records: list of CouchDBRecord
+        """
+        if not self.partitioned:
+            self._ship(self._format_batch(records))
+            return
+        for database, group in itertools.groupby(
+                records, lambda record: self._partition(record.created)):
+            self._ship(self._format_batch(list(group)), database)
+
+    def _format_batch(self, records):
+        """
+            Format queued records to couchdb documents
+
+        :param records: list of CouchDBRecord
+        :return: list of json documents (str)
+        """
+        docs = []
+        start = time.time()
+        for record in records:
+            try:
+                record_docs = self._documents(record, record.weight)
+                if record.collapsed is not None:
+                    record_docs[-1] = _add_fields(record_docs[-1], zip(
+                        ('count', 'first_created', 'last_created'),
+                        record.collapsed))
+                docs.extend(record_docs)
+            except Exception:
+                self.metrics.incr('failed')
+                self.handleError(record)
+        if records:
+            self.metrics.observe('serialize', time.time() - start)
+        return docs
+
+    def _ship(self, docs, database=None):
+        """
+            Post a batch of formatted documents to _bulk_docs
+
+        :param docs: list of json documents (str)
+        :param database: database's name, None for the database of the
+            handler
+        """
+        if not docs:
+            return
+        try:
+            if self.spool is not None and self.spool.pending():
+                self.spool.append(docs, database)
+                self.metrics.incr('spooled', len(docs))
+                return
+            rejected = self._deliver(docs, database)
+        except Exception:
+            self.metrics.incr('failed', len(docs))
+            self.handleError(logging.makeLogRecord({
+                'msg': 'Unable to ship %d records to %s',
+                'args': (len(docs), database or self.database),
+            }))
+            return
+        if rejected:
+            self.metrics.incr('failed', len(rejected))
+            self.handleError(logging.makeLogRecord({
+                'msg': 'CouchDB rejected %d of %d records to %s: %s',
+                'args': (len(rejected), len(docs), database or self.database,
+                         rejected[0][1]),
+            }))
+
+
+class CouchDBWriterRegistry(object):
+    """
+        CouchDBWriterRegistry:
+            Registry of the CouchDBBulkLogHandler writers shared by the
+            CouchDBSharedLogHandler of a process, keyed by the url, the
+            database and the credentials. The first handler of a key
+            creates its writer, which counts the handlers using it; the
+            last one to close flushes and closes the writer.
+    """
+
+    def __init__(self):
+        self._writers = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(host='localhost', port=5984, database='logs', username=None,
+            password=None, ssl=False, nodes=None, **kwargs):
+        """
+            Return the key of the writer of the handler arguments
+
+        :param kwargs: arguments of CouchDBBulkLogHandler
+        :return: (protocol, addresses, database, username, password)
+        """
+        addresses = []
+        for address in nodes or [host]:
+            node_port = port
+            if isinstance(address, (tuple, list)):
+                address, node_port = address
+            elif ':' in address:
+                address, node_port = address.rsplit(':', 1)
+            addresses.append('%s:%d' % (address.lower(), int(node_port)))
+        return ('https' if ssl else 'http', tuple(addresses), database,
+                username, password)
+
+    def acquire(self, kwargs):
+        """
+            Return the writer of the handler arguments, created by the
+            first handler of its key
+
+        :param kwargs: arguments of CouchDBBulkLogHandler
+        :return: key, writer (CouchDBBulkLogHandler)
+        """
+        key = self.key(**kwargs)
+        with self._lock:
+            entry = self._writers.get(key)
+            if entry is None:
+                # created under the lock: one session and one login per key
+                entry = self._writers[key] = [CouchDBBulkLogHandler(**kwargs),
+                                              0]
+            entry[1] += 1
+            return key, entry[0]
+
+    def release(self, key):
+        """
+            Release a writer, closed (its queue shipped) when no handler
+            uses it anymore
+
+        :param key: key returned by acquire
+        """
+        with self._lock:
+            entry = self._writers[key]
+            entry[1] -= 1
+            if entry[1]:
+                return
+            del self._writers[key]
+        entry[0].close()
+
+    def writers(self):
+        """
+            Return the writers in use and their number of handlers
+
+        :return: dict key -> (writer, handlers)
+        """
+        with self._lock:
+            return dict((key, tuple(entry))
+                        for key, entry in self._writers.items())
+
+
+_registry = CouchDBWriterRegistry()
+
+
+class CouchDBSharedLogHandler(logging.Handler, object):
+    """
+        CouchDBSharedLogHandler that inherits from logging.Handler
+
+        CouchDBSharedLogHandler:
+            Forwards the records to the CouchDBBulkLogHandler shared by
+            every CouchDBSharedLogHandler of the process writing to the
+            same couchdb url and database with the same credentials, so
+            the handlers attached to many loggers share one session, one
+            login and one batching queue.
+            The arguments of the first handler of a key create the
+            writer, the other arguments of the next handlers are ignored.
+    """
+
+    def __init__(self, registry=None, **kwargs):
+        """
+            Initialize the shared handler, acquiring its writer
+
+        :param registry: CouchDBWriterRegistry, the registry of the process
+            by default
+        :param kwargs: arguments of CouchDBBulkLogHandler
+        """
+        super(CouchDBSharedLogHandler, self).__init__()
+        self.registry = registry if registry is not None else _registry
+        self.key, self.writer = self.registry.acquire(kwargs)
+        self._closed = False
+
+    @property
+    def metrics(self):
+        """
+            CouchDBMetrics of the shared writer
+        """
+        return self.writer.metrics
+
+    def emit(self, record):
+        """
+            Queue a logging record in the shared writer
+
+        :param record: loggging record
+        """
+        # under the lock of the writer: one _after_fork in a forked child
+        self.writer.handle(record)
+
+    def flush(self):
+        """
+            Wait until every record queued in the shared writer so far has
+            been shipped
+        """
+        if not self._closed:
+            self.writer.flush()
+
+    def close(self):
+        """
+            Release the shared writer, closed by the last handler
+        """
+        self.acquire()
+        try:
+            closed, self._closed = self._closed, True
+        finally:
+            self.release()
+        if not closed:
+            self.registry.release(self.key)
+        super(CouchDBSharedLogHandler, self).close()
+
+
+class CouchDBShipperHandler(logging.Handler, object):
+    """
+        CouchDBShipperHandler that inherits from logging.Handler
+
+        CouchDBShipperHandler:
+            Sends compact serialized records over a unix socket to the
+            CouchDBShipper shared by a group of processes (gunicorn or
+            multiprocessing workers), so they share one couchdb session
+            and their records are batched together.
+            The connection is reopened in a forked child process.
+    """
+
+    ATTRIBUTES = ('name', 'levelno', 'levelname', 'pathname', 'filename',
+                  'module', 'lineno', 'funcName', 'created', 'msecs',
+                  'relativeCreated', 'thread', 'threadName', 'process',
+                  'stack_info')
+
+    def __init__(self, address, timeout=5.0, attributes=None):
+        """
+            Initialize the shipper client handler, the socket is opened by
+            the first emit
+
+        :param address: path of the unix socket of the CouchDBShipper
+        :param timeout: socket timeout in seconds
+        :param attributes: names of the extra attributes of the records
+            sent to the shipper, the custom attributes of the fields of
+            its handler
+        """
+        super(CouchDBShipperHandler, self).__init__()
+        self.address = address
+        self.timeout = timeout
+        self.attributes = self.ATTRIBUTES + tuple(attributes or ())
+        self._socket = None
+        self._pid = os.getpid()
+
+    def serialize(self, record):
+        """
+            Serialize the attributes of a record shipped to couchdb, the
+            message is rendered and the exception formatted here
+
+        :param record: loggging record (LogRecord)
+        :return: json (bytes)
+        """
+        data = dict((name, getattr(record, name, None))
+                    for name in self.attributes)
+        data['msg'] = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+        data['exc_text'] = record.exc_text
+        return json.dumps(data, separators=(',', ':'),
+                          default=str).encode('utf-8')
+
+    def emit(self, record):
+        """
+            Send a logging record to the shipper
+
+        :param record: loggging record
+        """
+        try:
+            data = self.serialize(record)
+            if self._pid != os.getpid():
+                # never write to the socket inherited from the parent
+                self._close_socket()
+                self._pid = os.getpid()
+            if self._socket is None:
+                self._socket = socket.socket(socket.AF_UNIX,
+                                             socket.SOCK_STREAM)
+                self._socket.settimeout(self.timeout)
+                self._socket.connect(self.address)
+            self._socket.sendall(_FRAME.pack(len(data)) + data)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self._close_socket()
+            self.handleError(record)
+
+    def _close_socket(self):
+        sock, self._socket = self._socket, None
+        if sock is not None:
+            try:
+                sock.close()
+            except socket.error:
+                pass
+
+    def close(self):
+        """
+            Close the socket to the shipper
+        """
+        self.acquire()
+        try:
+            self._close_socket()
+        finally:
+            self.release()
+        super(CouchDBShipperHandler, self).close()
+
+
+class _ShipperRequestHandler(socketserver.StreamRequestHandler):
+    """
+        Reads the records sent by one CouchDBShipperHandler
+    """
+
+    def handle(self):
+        handler = self.server.handler
+        while True:
+            header = self.rfile.read(_FRAME.size)
+            if len(header) < _FRAME.size:
+                return
+            length, = _FRAME.unpack(header)
+            data = self.rfile.read(length)
+            if len(data) < length:
+                return
+            handler.handle(logging.makeLogRecord(
+                json.loads(data.decode('utf-8'))))
+
+
+class _ShipperServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class CouchDBShipper(object):
+    """
+        CouchDBShipper:
+            Process owning the single CouchDBBulkLogHandler, and so the
+            single couchdb session, of a group of processes logging
+            through CouchDBShipperHandler
+    """
+
+    def __init__(self, address, **kwargs):
+        """
+            Initialize the shipper
+
+        :param address: path of the unix socket to listen on
+        :param kwargs: arguments of CouchDBBulkLogHandler
+        """
+        self.address = address
+        self.kwargs = kwargs
+        self.process = None
+        self.server = None
+
+    def start(self, timeout=30.0):
+        """
+            Start the shipper in a child process and wait until it listens,
+            raises RuntimeError when it exits or times out before
+
+        :param timeout: max seconds to wait for the shipper
+        """
+        import multiprocessing
+        ready = multiprocessing.Event()
+        self.process = multiprocessing.Process(
+            target=self.serve_forever, args=(ready,), name='CouchDBShipper')
+        self.process.daemon = True
+        self.process.start()
+        deadline = time.time() + timeout
+        while not ready.wait(0.05):
+            if not self.process.is_alive():
+                raise RuntimeError('CouchDBShipper exited with code %s' %
+                                   self.process.exitcode)
+            if time.time() >= deadline:
+                self.process.terminate()
+                self.process.join(timeout)
+                raise RuntimeError('CouchDBShipper not listening on %s '
+                                   'after %s seconds' % (self.address,
+                                                         timeout))
+
+    def stop(self, timeout=30.0):
+        """
+            Stop the shipper process, it ships the queued records first
+
+        :param timeout: max seconds to wait for the shipper
+        """
+        if self.process is not None and self.process.is_alive():
+            os.kill(self.process.pid, signal.SIGTERM)
+            self.process.join(timeout)
+
+    def serve_forever(self, ready=None):
+        """
+            Receive records until SIGTERM, called in the shipper process
+
+        :param ready: event set once the socket listens
+        """
+        handler = CouchDBBulkLogHandler(**self.kwargs)
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        self.server = server = _ShipperServer(self.address,
+                                              _ShipperRequestHandler)
+        server.handler = handler
+
+        def shutdown(signum, frame):
+            threading.Thread(target=server.shutdown).start()
+        try:
+            signal.signal(signal.SIGTERM, shutdown)
+        except ValueError:  # not called from the main thread
+            pass
+        if ready is not None:
+            ready.set()
+
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            handler.close()
+
+
+class CouchDBLogReader(object):
+    """
+        CouchDBLogReader:
+            Queries the log documents through the views of DESIGN_DOCUMENT
+            or _all_docs. Rows are read page by page (startkey
+            pagination) and parsed incrementally from the response stream,
+            so scanning a whole database uses constant memory.
+    """
+
+    DESIGN_DOCUMENT = {
+        '_id': '_design/couchdblogger',
+        'version': 1,
+        'language': 'javascript',
+        'views': {
+            'by_level': {'map': 'function (doc) { if (doc.level && '
+                                'doc.created) { emit([doc.level, '
+                                'doc.created], null); } }'},
+            'by_logger': {'map': 'function (doc) { if (doc.logger && '
+                                 'doc.created) { emit([doc.logger, '
+                                 'doc.created], null); } }'},
+            'by_time': {'map': 'function (doc) { if (doc.created) { '
+                               'emit(doc.created, null); } }'},
+        },
+    }
+
+    def __init__(self, url='http://localhost:5984', database='logs',
+                 username=None, password=None, request_args=None,
+                 page_size=1000, chunk_size=64 * 1024, transport=None):
+        """
+            Initialize the reader
+
+        :param url: url of couchdb (protocol://host:port)
+        :param database: database's name of the logs
+        :param username: user's name for logging in the database
+        :param password: password for logging in the database
+        :param request_args: args for request
+        :param page_size: number of rows requested at once
+        :param chunk_size: bytes read at once from the response stream
+        :param transport: HTTP layer of the session, see CouchDBSession
+        """
+        self.url = url.rstrip('/')
+        self.database = database
+        self.db_url = self.url + '/' + database
+        self.page_size = page_size
+        self.chunk_size = chunk_size
+        self.session = CouchDBSession(request_args=request_args,
+                                      transport=transport)
+        if username:
+            self.session.login(self.url, username, password)
+
+    @classmethod
+    def install(cls, session, db_url):
+        """
+            Install or upgrade DESIGN_DOCUMENT in a database, nothing is
+            written when it is up to date
+
+        :param session: CouchDBSession
+        :param db_url: url of the database
+        """
+        doc_url = db_url + '/' + cls.DESIGN_DOCUMENT['_id']
+        doc = dict(cls.DESIGN_DOCUMENT)
+        try:
+            current = session.get(doc_url).json()
+        except CouchDBSession.CouchDBException as exc:
+            if exc.status_code != 404:
+                raise
+        else:
+            if current.get('version', 0) >= doc['version']:
+                return
+            doc['_rev'] = current['_rev']
+        try:
+            session.put(doc_url, data=json.dumps(doc),
+                        headers={'Content-type': 'application/json'})
+        except CouchDBSession.CouchDBException as exc:
+            if exc.status_code != 409:  # installed meanwhile
+                raise
+
+    def install_views(self):
+        """
+            Install DESIGN_DOCUMENT in the database of the reader
+        """
+        self.install(self.session, self.db_url)
+
+    def by_level(self, level, start=None, end=None, **kwargs):
+        """
+            Documents of a level, sorted by creation time
+
+        :param level: level name ('ERROR')
+        :param start: min creation time (time.time())
+        :param end: max creation time
+        :param kwargs: arguments of view()
+        """
+        return self._range('by_level', [level], start, end, **kwargs)
+
+    def by_logger(self, logger, start=None, end=None, **kwargs):
+        """
+            Documents of a logger, sorted by creation time
+
+        :param logger: logger's name
+        :param start: min creation time (time.time())
+        :param end: max creation time
+        :param kwargs: arguments of view()
+        """
+        return self._range('by_logger', [logger], start, end, **kwargs)
+
+    def by_time(self, start=None, end=None, **kwargs):
+        """
+            Documents sorted by creation time
+
+        :param start: min creation time (time.time())
+        :param end: max creation time
+        :param kwargs: arguments of view()
+        """
+        return self._range('by_time', None, start, end, **kwargs)
+
+    def _range(self, view, prefix, start, end, descending=False, **kwargs):
+        if prefix is None:
+            low, high = start, end
+        else:
+            low = prefix + ([] if start is None else [start])
+            high = prefix + [{} if end is None else end]
+        if descending:
+            low, high = high, low
+        return self.view(view, startkey=low, endkey=high,
+                         descending=descending, **kwargs)
+
+    def view(self, view, startkey=None, endkey=None, descending=False,
+             include_docs=True, limit=None):
+        """
+            Stream the rows of a view of DESIGN_DOCUMENT
+
+        :param view: name of the view
+        :param startkey: first key
+        :param endkey: last key (included)
+        :param descending: newest first
+        :param include_docs: yield the documents instead of the rows
+        :param limit: max number of rows, all by default
+        """
+        url = '%s/%s/_view/%s' % (self.db_url, self.DESIGN_DOCUMENT['_id'],
+                                  view)
+        return self._paginate(url, startkey, endkey, descending,
+                              include_docs, limit)
+
+    def all_docs(self, startkey=None, endkey=None, descending=False,
+                 include_docs=True, limit=None):
+        """
+            Stream _all_docs, the documents of a time range when their ids
+            come from CouchDBIdGenerator (see CouchDBIdGenerator.time_key)
+
+        :param startkey: first id
+        :param endkey: last id (included)
+        :param descending: newest first
+        :param include_docs: yield the documents instead of the rows
+        :param limit: max number of rows, all by default
+        """
+        return self._paginate(self.db_url + '/_all_docs', startkey, endkey,
+                              descending, include_docs, limit)
+
+    def changes(self, since='now', include_docs=True, follow=True,
+                 heartbeat=30.0, retry_interval=5.0):
+        """
+            Stream the continuous _changes feed, yield (seq, row) where row
+            holds the doc when include_docs is set. The feed is reopened
+            from the last seq when the connection drops.
+
+        :param since: seq to start after, 'now' for the new changes only,
+            0 for the whole history
+        :param include_docs: add the documents to the rows
+        :param follow: wait for new changes (tail -f), False to stop at
+            the current end of the feed
+        :param heartbeat: seconds between two newlines sent by couchdb to
+            keep an idle feed open
+        :param retry_interval: seconds to wait before reopening a feed
+            which failed
+        """
+        params = {'feed': 'continuous',
+                  'include_docs': 'true' if include_docs else 'false',
+                  'heartbeat': int(heartbeat * 1000)}
+        if not follow:
+            # couchdb closes the feed once it sent the current changes
+            params['timeout'] = 0
+        while True:
+            try:
+                for row in self._stream_lines(self.db_url + '/_changes',
+                                              dict(params, since=since)):
+                    if 'last_seq' in row:
+                        since = row['last_seq']
+                        continue
+                    since = row['seq']
+                    yield since, row
+            except (requests.RequestException,
+                    CouchDBSession.CouchDBException) as exc:
+                if not follow or not _is_unreachable(exc):
+                    raise
+                time.sleep(retry_interval)
+                continue
+            if not follow:
+                return
+
+    def _stream_lines(self, url, params):
+        """
+            Parse a response made of one json object per line
+        """
+        resp = self.session.get(url, params=params, stream=True)
+        try:
+            for line in resp.iter_lines(self.chunk_size):
+                if line.strip():  # not a heartbeat
+                    yield json.loads(line.decode('utf-8'))
+        finally:
+            resp.close()
+
+    def _paginate(self, url, startkey, endkey, descending, include_docs,
+                  limit):
+        params = {'include_docs': 'true' if include_docs else 'false',
+                  'descending': 'true' if descending else 'false'}
+        if endkey is not None:
+            params['endkey'] = json.dumps(endkey)
+        next_key, next_id = startkey, None
+        remaining = limit
+        while remaining is None or remaining > 0:
+            page = self.page_size
+            if remaining is not None:
+                page = min(page, remaining)
+            page_params = dict(params, limit=page + 1)
+            if next_key is not None:
+                page_params['startkey'] = json.dumps(next_key)
+            if next_id is not None:
+                page_params['startkey_docid'] = next_id
+            count, next_row = 0, None
+            for row in self._stream_rows(url, page_params):
+                if count == page:
+                    # first row of the next page
+                    next_row = row
+                    break
+                count += 1
+                yield row.get('doc') if include_docs else row
+            if next_row is None:
+                return
+            if remaining is not None:
+                remaining -= count
+            next_key, next_id = next_row['key'], next_row['id']
+
+    def _stream_rows(self, url, params):
+        """
+            Parse the rows of a view response while it is downloaded
+        """
+        resp = self.session.get(url, params=params, stream=True)
+        try:
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            parser = json.JSONDecoder()
+            chunks = resp.iter_content(self.chunk_size)
+            buf, pos, in_rows = '', 0, False
+            for chunk in chunks:
+                buf = buf[pos:] + decoder.decode(chunk)
+                pos = 0
+                if not in_rows:
+                    start = buf.find('"rows"')
+                    if start < 0:
+                        continue
+                    start = buf.find('[', start)
+                    if start < 0:
+                        continue
+                    pos, in_rows = start + 1, True
+                while True:
+                    while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                        pos += 1
+                    if pos == len(buf):
+                        break
+                    if buf[pos] == ']':
+                        return
+                    try:
+                        row, end = parser.raw_decode(buf, pos)
+                    except ValueError:
+                        break  # incomplete row, read more
+                    pos = end
+                    yield row
+            if buf[pos:].strip():
+                raise ValueError('truncated view response from %s' % url)
+        finally:
+            resp.close()
+
+
+def _record_filter(level=None, loggers=None):
+    """
+        Return a function telling if a document passes the level and logger
+        filters of the command line
+
+    :param level: min level name ('WARNING')
+    :param loggers: logger names, their children pass too
+    """
+    min_level = logging.getLevelName(level.upper()) if level else None
+    if min_level is not None and not isinstance(min_level, int):
+        raise ValueError('unknown level %r' % level)
+    prefixes = tuple(name + '.' for name in loggers or ())
+
+    def accept(doc):
+        if 'created' not in doc:  # design or payload document
+            return False
+        if min_level is not None:
+            levelno = logging.getLevelName(doc.get('level'))
+            if not isinstance(levelno, int) or levelno < min_level:
+                return False
+        if loggers:
+            name = doc.get('logger') or ''
+            if name not in loggers and not name.startswith(prefixes):
+                return False
+        return True
+    return accept
+
+
+def _format_record(doc):
+    created = doc['created']
+    return '%s.%03dZ %-8s %s %s' % (
+        time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(created)),
+        int(created * 1000) % 1000, doc.get('level'), doc.get('logger'),
+        doc.get('message'))
+
+
+def _write_checkpoint(path, seq):
+    with open(path + '.tmp', 'w') as checkpoint:
+        checkpoint.write(json.dumps(seq))
+    getattr(os, 'replace', os.rename)(path + '.tmp', path)
+
+
+def _tail(reader, args, output):
+    accept = _record_filter(args.level, args.logger)
+    since = args.since
+    if args.checkpoint and os.path.exists(args.checkpoint):
+        with open(args.checkpoint) as checkpoint:
+            since = json.loads(checkpoint.read())
+    seq, saved, saved_at = since, since, time.time()
+    try:
+        for seq, row in reader.changes(since, follow=not args.no_follow,
+                                       heartbeat=args.heartbeat):
+            doc = row.get('doc')
+            if doc and not row.get('deleted') and accept(doc):
+                output.write((_json_any(doc) if args.json
+                              else _format_record(doc)) + '\n')
+                output.flush()
+            if args.checkpoint and time.time() - saved_at >= 1.0:
+                _write_checkpoint(args.checkpoint, seq)
+                saved, saved_at = seq, time.time()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.checkpoint and seq != saved:
+            _write_checkpoint(args.checkpoint, seq)
+    return 0
+
+
+def _export(reader, args, output):
+    accept = _record_filter(args.level, args.logger)
+    count = 0
+    for doc in reader.all_docs():
+        if doc is None or doc['_id'].startswith('_design/'):
+            continue
+        if (args.level or args.logger) and not accept(doc):
+            continue
+        output.write(_json_any(doc) + '\n')
+        count += 1
+    sys.stderr.write('exported %d documents\n' % count)
+    return 0
+
+
+def _add_filters(parser, default):
+    # before or after the command: the defaults of a subcommand are
+    # SUPPRESS, not to override the filters given before it
+    parser.add_argument('--level', default=default,
+                        help='min level of the records')
+    parser.add_argument('--logger', action='append', default=default,
+                        help='logger of the records, with its children '
+                             '(repeatable)')
+
+
+def main(argv=None):
+    """
+        Command line: tail -f of the log database over its _changes feed,
+        export of the whole database to NDJSON
+
+        python -m couchdblogger tail --level WARNING --logger app
+        python -m couchdblogger export -o logs.ndjson
+
+    :param argv: arguments, sys.argv[1:] by default
+    """
+    import argparse  # only the command line needs it
+    parser = argparse.ArgumentParser(
+        prog='couchdblogger',
+        description='Read the logs written by couchdblogger')
+    parser.add_argument('--host', default='localhost',
+                        help='host of couchdb (host or host:port)')
+    parser.add_argument('--port', type=int, default=5984)
+    parser.add_argument('--database', default='logs',
+                        help="database's name, a partition pattern "
+                             "('logs-%%Y-%%m') reads the current partition")
+    parser.add_argument('--username')
+    parser.add_argument('--password',
+                        default=os.environ.get('COUCHDB_PASSWORD'),
+                        help='$COUCHDB_PASSWORD by default')
+    parser.add_argument('--ssl', action='store_true', help='use https')
+    parser.add_argument('--transport', choices=('requests', 'http.client'),
+                        default='requests', help='HTTP layer')
+    _add_filters(parser, None)
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    tail = commands.add_parser('tail', help='print the new records')
+    _add_filters(tail, argparse.SUPPRESS)
+    tail.add_argument('--since', default='now',
+                      help="seq to start after, 0 for the whole history "
+                           "('now' by default)")
+    tail.add_argument('--checkpoint',
+                      help='file keeping the last seq read, tail resumes '
+                           'from it')
+    tail.add_argument('--no-follow', action='store_true',
+                      help='stop at the current end of the feed')
+    tail.add_argument('--heartbeat', type=float, default=30.0,
+                      help='seconds between two keep-alives of the feed')
+    tail.add_argument('--json', action='store_true',
+                      help='print the documents as json lines')
+
+    export = commands.add_parser('export',
+                                 help='write the documents as json lines')
+    _add_filters(export, argparse.SUPPRESS)
+    export.add_argument('-o', '--output', help='file, stdout by default')
+    export.add_argument('--page-size', type=int, default=10000,
+                        help='documents per request')
+    args = parser.parse_args(argv)
+
+    host, port = args.host, args.port
+    if ':' in host:
+        host, port = host.rsplit(':', 1)
+        port = int(port)
+    database = args.database
+    if '%' in database:
+        database = time.strftime(database, time.gmtime())
+    reader = CouchDBLogReader(
+        '%s://%s:%d' % ('https' if args.ssl else 'http', host, port),
+        database, args.username, args.password,
+        page_size=getattr(args, 'page_size', 1000), transport=args.transport)
+
+    if args.command == 'tail':
+        return _tail(reader, args, sys.stdout)
+    if not args.output:
+        return _export(reader, args, sys.stdout)
+    with open(args.output, 'w') as output:
+        return _export(reader, args, output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,648 @@
+'''
+File: couchdblogger_asyncio.py
+Description: asyncio logger handler for CouchDB
+'''
+import asyncio
+import base64
+import datetime
+import itertools
+import json
+import logging
+import os
+import socket
+import ssl as ssl_module
+import time
+import zlib
+
+from urllib.parse import urlsplit, urlencode
+
+from couchdblogger import CouchDBLogHandler, CouchDBRetry, CouchDBSession
+
+_STOP = object()
+
+
+class AsyncCouchDBConnection(object):
+    """
+        AsyncCouchDBConnection:
+            One HTTP/1.1 keep-alive connection to couchdb over asyncio
+            streams
+    """
+
+    def __init__(self, host, port, ssl=None):
+        """
+            Initialize the connection, nothing is opened until the first
+            request
+
+        :param host: host of couchdb
+        :param port: port of couchdb
+        :param ssl: ssl.SSLContext for https, None for http
+        """
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, body=b'', headers=None):
+        """
+            Send a request and read the whole response
+
+        :param method: http method
+        :param path: path (and query string) of the request
+        :param body: request body (bytes)
+        :param headers: dict of extra headers
+        :return: tuple (status, headers, body)
+        """
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port, ssl=self.ssl)
+
+        lines = ['%s %s HTTP/1.1' % (method, path),
+                 'Host: %s:%d' % (self.host, self.port),
+                 'Content-Length: %d' % len(body)]
+        for name, value in (headers or {}).items():
+            lines.append('%s: %s' % (name, value))
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+                          + body)
+        await self.writer.drain()
+
+        try:
+            status, resp_headers, resp_body = await self._read_response()
+        except Exception:
+            await self.close()
+            raise
+        if resp_headers.get('connection', '').lower() == 'close':
+            await self.close()
+        return status, resp_headers, resp_body
+
+    async def _read_response(self):
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError('connection closed by couchdb')
+        status = int(status_line.split()[1])
+
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                if not size:
+                    await self.reader.readline()
+                    break
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readline()
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await self.reader.readexactly(
+                int(headers['content-length']))
+        else:
+            body = await self.reader.read()
+            await self.close()
+        return status, headers, body
+
+    async def close(self):
+        """
+            Close the connection
+        """
+        writer, self.reader, self.writer = self.writer, None, None
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+
+class AsyncCouchDBSession(object):
+    """
+        AsyncCouchDBSession:
+            Pool of keep-alive connections to one couchdb server with
+            cookie authentication, the asyncio counterpart of
+            CouchDBSession: the cookie is refreshed from every response
+            and the session is opened again when couchdb answers 401
+    """
+
+    def __init__(self, url, pool_size=2, request_args=None):
+        """
+            Initialize the session
+
+        :param url: url of couchdb (protocol://[user:password@]host:port)
+        :param pool_size: max number of idle connections kept open
+        :param request_args: args for request, only verify is used
+        """
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.pool_size = pool_size
+        self.headers = {}
+        if parts.username:
+            credentials = '%s:%s' % (parts.username, parts.password or '')
+            self.headers['Authorization'] = 'Basic ' + base64.b64encode(
+                credentials.encode('utf-8')).decode('ascii')
+
+        self.ssl = None
+        if parts.scheme == 'https':
+            self.ssl = ssl_module.create_default_context()
+            if not (request_args or {}).get('verify', True):
+                self.ssl.check_hostname = False
+                self.ssl.verify_mode = ssl_module.CERT_NONE
+        self._idle = []
+        self._credentials = None
+
+    async def request(self, method, path, body=b'', headers=None):
+        """
+            Send a request over a pooled connection.
+            In the case of having a code greater than 400 raises
+            CouchDBException
+
+        :param method: http method
+        :param path: path (and query string) of the request
+        :param body: request body (bytes)
+        :param headers: dict of extra headers
+        :return: tuple (status, headers, body)
+        """
+        status, resp_headers, resp_body = await self._send(method, path,
+                                                           body, headers)
+        if (status == 401 and self._credentials is not None and
+                path != '/_session'):
+            # expired session: log in again and replay once
+            await self._login()
+            status, resp_headers, resp_body = await self._send(
+                method, path, body, headers)
+        if status >= 400:
+            raise CouchDBSession.CouchDBException(
+                resp_body.decode('utf-8', 'replace'), status)
+        return status, resp_headers, resp_body
+
+    async def _send(self, method, path, body, headers):
+        all_headers = dict(self.headers)
+        all_headers.update(headers or {})
+        reused = bool(self._idle)
+        if reused:
+            connection = self._idle.pop()
+        else:
+            connection = self._connection()
+        try:
+            status, resp_headers, resp_body = await connection.request(
+                method, path, body, all_headers)
+        except (OSError, asyncio.IncompleteReadError):
+            await connection.close()
+            if not reused:
+                raise
+            # closed by couchdb while idle: once more on a new connection
+            connection = self._connection()
+            try:
+                status, resp_headers, resp_body = await connection.request(
+                    method, path, body, all_headers)
+            except Exception:
+                await connection.close()
+                raise
+        except Exception:
+            await connection.close()
+            raise
+        if len(self._idle) < self.pool_size:
+            self._idle.append(connection)
+        else:
+            await connection.close()
+
+        cookie = resp_headers.get('set-cookie', '')
+        if cookie.startswith('AuthSession='):
+            # opened by login or refreshed by couchdb
+            self.headers['Cookie'] = cookie.split(';', 1)[0]
+        return status, resp_headers, resp_body
+
+    def _connection(self):
+        return AsyncCouchDBConnection(self.host, self.port, self.ssl)
+
+    async def login(self, username, password):
+        """
+            Open a cookie session in couchdb, opened again when it expires
+
+        :param username: user's name for logging in the database
+        :param password: password for logging in the database
+        """
+        self._credentials = (username, password)
+        await self._login()
+
+    async def _login(self):
+        username, password = self._credentials
+        self.headers.pop('Cookie', None)
+        await self.request(
+            'POST', '/_session',
+            urlencode({'name': username, 'password': password}).encode(),
+            {'Content-Type': 'application/x-www-form-urlencoded'})
+
+    async def close(self):
+        """
+            Close every pooled connection
+        """
+        idle, self._idle = self._idle, []
+        for connection in idle:
+            await connection.close()
+
+
+class AsyncCouchDBLogHandler(CouchDBLogHandler):
+    """
+        AsyncCouchDBLogHandler that inherits from CouchDBLogHandler
+
+        AsyncCouchDBLogHandler:
+            emit only enqueues the formatted record, a writer task on the
+            running event loop ships the queued documents through
+            <database>/_bulk_docs, one batch per time-partitioned
+            database. Use `await handler.aclose()` to drain the queue on
+            shutdown. The retry policy, the circuit breaker, the retention
+            and the metrics writes run on the loop, the nodes of a cluster
+            and the spool are not supported.
+
+        CouchDBLogHandler:
+            Handler which writes logging records to CouchDB
+    """
+
+    def __init__(self, batch_size=500, batch_bytes=1024 * 1024,
+                 flush_interval=1.0, queue_size=10000, pool_size=2,
+                 **kwargs):
+        """
+            Initialize the couchdb asyncio handler, no I/O is done until
+            the first record is emitted on a running event loop
+
+        :param batch_size: max number of records in one _bulk_docs request
+        :param batch_bytes: max size (in bytes) of the documents in one
+            _bulk_docs request
+        :param flush_interval: max seconds a record waits in the queue
+        :param queue_size: max number of queued records, 0 for unbounded
+        :param pool_size: max number of keep-alive connections
+        :param kwargs: arguments of CouchDBLogHandler
+        """
+        for name in ('nodes', 'spool'):
+            if kwargs.get(name) is not None:
+                raise ValueError('%s is not supported by '
+                                 'AsyncCouchDBLogHandler' % name)
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.pool_size = pool_size
+        # run by tasks on the event loop instead of the worker threads
+        retention = kwargs.pop('retention', None)
+        stats_interval = kwargs.pop('stats_interval', None)
+        super(AsyncCouchDBLogHandler, self).__init__(**kwargs)
+        if isinstance(retention, datetime.timedelta):
+            retention = retention.total_seconds()
+        self.retention = retention
+        self.stats_interval = stats_interval
+
+        self.async_session = AsyncCouchDBSession(
+            self.url, pool_size=pool_size,
+            request_args=self.session.request_args)
+        self.bulk_path = '/%s/_bulk_docs' % self.database
+        self.loop = None
+        self._queue = None
+        self._task = None
+        self._periodic_tasks = []
+
+    def _connect(self, username, password, create_database):
+        # done by the writer task on the event loop
+        self._credentials = (username, password)
+        self._create_database = create_database
+
+    def start(self, loop=None):
+        """
+            Bind the handler to an event loop and start the writer task.
+            Called by the first emit on a running loop, call it explicitly
+            to accept records from other threads before that.
+
+        :param loop: event loop, the running one by default
+        """
+        if self._task is not None:
+            return
+        self.loop = loop or asyncio.get_running_loop()
+        self._queue = asyncio.Queue(self.queue_size)
+        self._task = self.loop.create_task(self._writer())
+        if self.retention is not None and self.partitioned:
+            self._periodic_tasks.append(self.loop.create_task(self._periodic(
+                self.retention_interval, self.aapply_retention,
+                'Unable to apply the retention of %s')))
+        if self.stats_interval is not None:
+            self._periodic_tasks.append(self.loop.create_task(self._periodic(
+                self.stats_interval, self.awrite_stats,
+                'Unable to write the metrics to %s')))
+
+    def emit(self, record):
+        """
+            Enqueue a logging record without blocking
+
+        :param record: loggging record
+        """
+        self.metrics.incr('emitted')
+        try:
+            weight = None
+            if self.sampler is not None:
+                weight = self.sampler.sample(record, self._load)
+                if weight is None:
+                    self.metrics.incr('sampled')
+                    return
+            database = self._partition(record.created)
+            items = [(database, doc) for doc in self._documents(record, weight)]
+            if self._task is None:
+                self.start()
+            if self._on_loop():
+                for item in items:
+                    self._queue.put_nowait(item)
+            else:
+                self.loop.call_soon_threadsafe(self._put, items, record)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except asyncio.QueueFull:
+            self.metrics.incr('dropped')
+            self.handleError(record)
+        except:
+            self.metrics.incr('failed')
+            self.handleError(record)
+
+    def _put(self, items, record):
+        try:
+            for item in items:
+                self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.metrics.incr('dropped')
+            self.handleError(record)
+
+    def _load(self):
+        fill = 0.0
+        if self._queue is not None and self.queue_size:
+            fill = float(self._queue.qsize()) / self.queue_size
+        return self._latency, fill
+
+    def _on_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    async def aflush(self):
+        """
+            Wait until every record queued so far has been shipped
+        """
+        if self._task is None or self._task.done():
+            return
+        done = self.loop.create_future()
+        await self._queue.put(done)
+        await done
+
+    async def aclose(self):
+        """
+            Ship the queued records, stop the writer task and close the
+            connections
+        """
+        if self._task is not None and not self._task.done():
+            await self._queue.put(_STOP)
+            await self._task
+        tasks, self._periodic_tasks = self._periodic_tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.async_session.close()
+        self.close()
+
+    async def aapply_retention(self):
+        """
+            Delete the time-partitioned databases older than the retention
+        """
+        _, _, body = await self.async_session.request('GET', '/_all_dbs')
+        for name in self.expired_databases(json.loads(body.decode('utf-8'))):
+            await self.async_session.request('DELETE', '/' + name)
+            with self._databases_lock:
+                self.databases.discard(name)
+
+    async def awrite_stats(self):
+        """
+            Write the metrics snapshot to the document
+            _local/couchdblogger-<host>-<pid> of the database
+        """
+        database = self._partition(time.time())
+        await self._aensure_database(database)
+        path = '/%s/_local/couchdblogger-%s-%d' % (
+            database or self.database, socket.gethostname(), os.getpid())
+        doc = self.metrics.snapshot()
+        doc['time'] = time.time()
+        for attempt in range(2):
+            if self._stats_rev is not None:
+                doc['_rev'] = self._stats_rev
+            try:
+                _, _, body = await self.async_session.request(
+                    'PUT', path, json.dumps(doc).encode('utf-8'),
+                    {'Content-Type': 'application/json'})
+                self._stats_rev = json.loads(body.decode('utf-8')).get('rev')
+                return
+            except CouchDBSession.CouchDBException as exc:
+                if exc.status_code != 409 or attempt:
+                    raise
+                # written by an earlier process with the same pid
+                _, _, body = await self.async_session.request('GET', path)
+                self._stats_rev = json.loads(body.decode('utf-8')).get('_rev')
+
+    async def _periodic(self, interval, function, msg):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await function()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.handleError(logging.makeLogRecord({
+                    'msg': msg, 'args': (self.database,)}))
+
+    async def _writer(self):
+        username, password = self._credentials
+        try:
+            if username:
+                await self.async_session.login(username, password)
+            if self._create_database and not self.partitioned:
+                try:
+                    await self.async_session.request(
+                        'GET', '/' + self.database)
+                except CouchDBSession.CouchDBException:
+                    await self.async_session.request(
+                        'PUT', '/' + self.database)
+        except Exception:
+            self.handleError(logging.makeLogRecord({
+                'msg': 'Unable to connect to %s', 'args': (self.url,)}))
+
+        # (database, document), database is None unless partitioned
+        items, size, deadline = [], 0, None
+        while True:
+            try:
+                if deadline is None:
+                    item = await self._queue.get()
+                else:
+                    item = await asyncio.wait_for(
+                        self._queue.get(),
+                        max(0, deadline - self.loop.time()))
+            except asyncio.TimeoutError:
+                item = None
+
+            if item is None or item is _STOP or isinstance(item,
+                                                           asyncio.Future):
+                await self._ship_items(items)
+                items, size, deadline = [], 0, None
+                if isinstance(item, asyncio.Future) and not item.done():
+                    item.set_result(None)
+                if item is _STOP:
+                    return
+                continue
+
+            items.append(item)
+            size += len(item[1])
+            if deadline is None:
+                deadline = self.loop.time() + self.flush_interval
+            if len(items) >= self.batch_size or size >= self.batch_bytes:
+                await self._ship_items(items)
+                items, size, deadline = [], 0, None
+
+    async def _ship_items(self, items):
+        for database, group in itertools.groupby(items, lambda item: item[0]):
+            await self._ship([doc for _, doc in group], database)
+
+    async def _aensure_database(self, database):
+        """
+            Create a time-partitioned database unless it is known to exist
+
+        :param database: database's name, None for the database of the
+            handler
+        """
+        if database is None or database in self.databases:
+            return
+        try:
+            await self.async_session.request('GET', '/' + database)
+        except CouchDBSession.CouchDBException as exc:
+            if exc.status_code != 404:
+                raise
+            try:
+                await self.async_session.request('PUT', '/' + database)
+            except CouchDBSession.CouchDBException as exc:
+                if exc.status_code != 412:  # created meanwhile
+                    raise
+        self.databases.add(database)
+
+    async def _ship(self, docs, database=None):
+        """
+            Post a batch of formatted documents to _bulk_docs under the
+            retry policy and the circuit breaker
+
+        :param docs: list of json documents (str)
+        :param database: database's name, None for the database of the
+            handler
+        """
+        if not docs:
+            return
+        try:
+            rejected = await self._write(docs, database)
+        except Exception:
+            self._forget(docs)
+            self.metrics.incr('failed', len(docs))
+            self.handleError(logging.makeLogRecord({
+                'msg': 'Unable to ship %d records to %s',
+                'args': (len(docs), database or self.database),
+            }))
+            return
+        if rejected:
+            self._forget([doc for doc, _ in rejected])
+            self.metrics.incr('failed', len(rejected))
+            self.handleError(logging.makeLogRecord({
+                'msg': 'CouchDB rejected %d of %d records to %s: %s',
+                'args': (len(rejected), len(docs), database or self.database,
+                         rejected[0][1]),
+            }))
+
+    async def _write(self, docs, database):
+        # retry loop of CouchDBLogHandler._write, documents are dropped
+        # while the circuit is open since there is no spool
+        breaker = self.circuit_breaker
+        delays = iter(()) if self.retry is None else self.retry.delays()
+        rejected = []
+        while True:
+            if breaker is not None and not breaker.allow():
+                self.metrics.incr('dropped', len(docs))
+                self._forget(docs)
+                return rejected
+            try:
+                failed = await self._post_bulk(docs, database)
+            except Exception as exc:
+                transient = _transient(exc)
+                if breaker is not None:
+                    if transient:
+                        breaker.failure()
+                    else:
+                        breaker.success()  # couchdb answered
+                delay = next(delays, None) if transient else None
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            if breaker is not None:
+                breaker.success()
+            retried = []
+            for doc, error in failed:
+                if error in CouchDBRetry.PERMANENT_ERRORS:
+                    rejected.append((doc, error))
+                else:
+                    retried.append((doc, error))
+            if not retried:
+                return rejected
+            docs = [doc for doc, _ in retried]
+            delay = next(delays, None)
+            if delay is None:
+                return rejected + retried
+            await asyncio.sleep(delay)
+
+    async def _post_bulk(self, docs, database=None):
+        """
+            Post formatted documents to _bulk_docs
+
+        :param docs: list of json documents (str)
+        :param database: database's name, None for the database of the
+            handler
+        :return: list of (document, error) not written by couchdb
+        """
+        path = self.bulk_path
+        if database is not None:
+            path = '/%s/_bulk_docs' % database
+        body = ('{"docs":[' + ','.join(docs) + ']}').encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if self.compress and len(body) >= self.compress_min_size:
+            compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            self.uncompressed_bytes += len(body)
+            body = compressor.compress(body) + compressor.flush()
+            self.compressed_bytes += len(body)
+            headers['Content-Encoding'] = 'gzip'
+        self.metrics.incr('requests')
+        start = self.loop.time()
+        try:
+            await self._aensure_database(database)
+            _, _, resp_body = await self.async_session.request(
+                'POST', path, body, headers)
+        finally:
+            elapsed = self.loop.time() - start
+            self.metrics.observe('request', elapsed)
+            self._latency += (elapsed - self._latency) * 0.2
+        try:
+            failed = self._errors(docs, json.loads(resp_body.decode('utf-8')))
+        except ValueError:
+            failed = []
+        self.metrics.incr('documents_sent', len(docs) - len(failed))
+        self.metrics.incr('bytes_sent', sum(len(doc) for doc in docs))
+        return failed
+
+
+def _transient(exc):
+    # CouchDBRetry.transient for the errors of the asyncio streams
+    return CouchDBRetry.transient(exc) or isinstance(
+        exc, (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError))
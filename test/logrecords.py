@@ -0,0 +1,14 @@
+'''
+    File: logrecords.py
+    Description: Tests - logging records shared by the tests
+'''
+import logging
+
+
+def make_record(message='log to couchdb', level=logging.INFO, name='process_name', created=None, args=(),
+                **attributes):
+    attributes.update(msg=message, args=args, name=name, levelno=level, levelname=logging.getLevelName(level))
+    record = logging.makeLogRecord(attributes)
+    if created is not None:
+        record.created = created
+    return record
@@ -0,0 +1,125 @@
+'''
+    File: test_couchdbbulkloghandler_unit.py
+    Description: Tests - CouchDBBulkLogHandler
+'''
+from mock import Mock, patch
+import unittest
+import json
+import gzip
+import time
+
+
+import sys, os
+sys.path.insert(0, os.path.abspath("../src"))
+
+from couchdblogger import CouchDBBulkLogHandler, CouchDBLogHandler, CouchDBSession, logging
+from logrecords import make_record
+
+
+class CouchDBBulkLogHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.post = patch.object(CouchDBSession, 'post').start()
+        self.couchdb_handler = CouchDBBulkLogHandler(flush_interval=60)
+
+    def tearDown(self):
+        self.couchdb_handler.close()
+        patch.stopall()
+
+    def posted_docs(self, call):
+        return json.loads(call[1]['data'])['docs']
+
+    def test_is_instance(self):
+        self.assertTrue(issubclass(CouchDBBulkLogHandler, CouchDBLogHandler), "")
+        self.assertEqual(self.couchdb_handler.bulk_url, 'http://localhost:5984/logs/_bulk_docs', "")
+
+    def test_emit_only_queues(self):
+        self.couchdb_handler.emit(make_record())
+        time.sleep(0.05)
+        self.assertFalse(self.post.called, "")
+
+    def test_flush(self):
+        self.couchdb_handler.emit(make_record('first'))
+        self.couchdb_handler.emit(make_record('second'))
+        self.couchdb_handler.flush()
+
+        self.assertEqual(self.post.call_count, 1, "")
+        self.assertEqual(self.post.call_args[0][0], 'http://localhost:5984/logs/_bulk_docs', "")
+        self.assertEqual(self.post.call_args[1]['headers']['Content-type'], 'application/json', "")
+        docs = self.posted_docs(self.post.call_args)
+        self.assertEqual([doc['message'] for doc in docs], ['first', 'second'], "")
+        self.assertEqual(docs[0]['logger'], 'process_name', "")
+        self.assertEqual(docs[0]['level'], 'INFO', "")
+
+    def test_flush_compress(self):
+        self.couchdb_handler.close()
+        self.couchdb_handler = CouchDBBulkLogHandler(flush_interval=60, compress=True, compress_min_size=0)
+        for i in range(100):
+            self.couchdb_handler.emit(make_record('repeated message %d' % i))
+        self.couchdb_handler.flush()
+
+        self.assertEqual(self.post.call_args[1]['headers']['Content-Encoding'], 'gzip', "")
+        body = gzip.decompress(b''.join(self.post.call_args[1]['data']))
+        docs = json.loads(body.decode('utf-8'))['docs']
+        self.assertEqual(len(docs), 100, "")
+        self.assertEqual(docs[99]['message'], 'repeated message 99', "")
+        self.assertEqual(self.couchdb_handler.uncompressed_bytes, len(body), "")
+        self.assertTrue(self.couchdb_handler.compression_ratio > 5, "")
+
+    def test_flush_empty_queue(self):
+        self.couchdb_handler.flush()
+        self.assertFalse(self.post.called, "")
+
+    def test_batch_size(self):
+        self.couchdb_handler.close()
+        self.couchdb_handler = CouchDBBulkLogHandler(batch_size=2, flush_interval=60)
+        for i in range(5):
+            self.couchdb_handler.emit(make_record(str(i)))
+        self.couchdb_handler.flush()
+
+        self.assertEqual([len(self.posted_docs(call)) for call in self.post.call_args_list], [2, 2, 1], "")
+
+    def test_batch_bytes(self):
+        self.couchdb_handler.close()
+        self.couchdb_handler = CouchDBBulkLogHandler(batch_bytes=1, flush_interval=60)
+        self.couchdb_handler.emit(make_record('first'))
+        self.couchdb_handler.emit(make_record('second'))
+        self.couchdb_handler.flush()
+
+        self.assertEqual(self.post.call_count, 2, "")
+
+    def test_flush_interval(self):
+        self.couchdb_handler.close()
+        self.couchdb_handler = CouchDBBulkLogHandler(flush_interval=0.01)
+        self.couchdb_handler.emit(make_record())
+        for _ in range(100):
+            if self.post.called:
+                break
+            time.sleep(0.01)
+        self.assertTrue(self.post.called, "")
+
+    def test_close_drains_queue(self):
+        self.couchdb_handler.emit(make_record())
+        self.couchdb_handler.close()
+
+        self.assertTrue(self.post.called, "")
+        self.assertFalse(self.couchdb_handler._thread.is_alive(), "")
+
+    def test_ship_error_handle(self):
+        self.post.side_effect = AttributeError
+        self.couchdb_handler.handleError = Mock()
+        self.couchdb_handler.emit(make_record())
+        self.couchdb_handler.flush()
+
+        self.assertTrue(self.couchdb_handler.handleError.called, "")
+
+    def test_emit_queue_error(self):
+        self.couchdb_handler.handleError = Mock()
+        record = make_record()
+        with patch.object(self.couchdb_handler.queue, 'put', side_effect=Exception):
+            self.couchdb_handler.emit(record)
+        self.couchdb_handler.handleError.assert_called_with(record)
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(unittest.TestLoader().loadTestsFromTestCase(CouchDBBulkLogHandlerTest))
@@ -0,0 +1,153 @@
+'''
+    File: test_couchdbcli_unit.py
+    Description: Tests - command line, tail over _changes and export
+'''
+from mock import Mock, patch
+import unittest
+import functools
+import io
+import json
+import shutil
+import tempfile
+import threading
+
+
+import sys, os
+sys.path.insert(0, os.path.abspath("../src"))
+sys.path.insert(0, os.path.abspath("../benchmarks"))
+
+from couchdblogger import (CouchDBLogReader, CouchDBLogHandler, CouchDBSession, logging, main,
+                           requests, _record_filter)
+from fakecouchdb import FakeCouchDB
+from logrecords import make_record as make_log_record
+
+
+make_record = functools.partial(make_log_record, name='app', created=1000.0)
+
+
+class CouchDBRecordFilterTest(unittest.TestCase):
+
+    def test_level(self):
+        accept = _record_filter('warning')
+        self.assertTrue(accept({'created': 1, 'level': 'ERROR'}), "")
+        self.assertFalse(accept({'created': 1, 'level': 'INFO'}), "")
+        self.assertFalse(accept({'created': 1, 'level': 'CUSTOM'}), "")
+
+    def test_unknown_level(self):
+        self.assertRaises(ValueError, _record_filter, 'LOUD')
+
+    def test_logger_children(self):
+        accept = _record_filter(loggers=['app.db'])
+        self.assertTrue(accept({'created': 1, 'logger': 'app.db'}), "")
+        self.assertTrue(accept({'created': 1, 'logger': 'app.db.pool'}), "")
+        self.assertFalse(accept({'created': 1, 'logger': 'app.dbx'}), "")
+
+    def test_not_a_record(self):
+        self.assertFalse(_record_filter()({'_id': 'payload-1', 'type': 'payload'}), "")
+
+
+class CouchDBCommandLineTest(unittest.TestCase):
+
+    def setUp(self):
+        # other tests replace CouchDBSession.get for good
+        patch.object(CouchDBSession, 'get', requests.Session.get).start()
+        self.couchdb = FakeCouchDB().start()
+        self.handler = CouchDBLogHandler(host=self.couchdb.host, port=self.couchdb.port,
+                                         create_database=True, install_views=True)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.couchdb.stop()
+        patch.stopall()
+        shutil.rmtree(self.directory)
+
+    def run_main(self, *args):
+        stdout = io.StringIO()
+        with patch('sys.stdout', stdout), patch('sys.stderr', io.StringIO()):
+            self.assertEqual(main(['--host', '%s:%d' % (self.couchdb.host, self.couchdb.port)] +
+                                  list(args)), 0, "")
+        return stdout.getvalue().splitlines()
+
+    def test_tail(self):
+        self.handler.emit(make_record('started', created=1.5))
+        self.handler.emit(make_record('failed', logging.ERROR, name='app.db'))
+        self.assertEqual(self.run_main('tail', '--since', '0', '--no-follow'), [
+            '1970-01-01T00:00:01.500Z INFO     app started',
+            '1970-01-01T00:16:40.000Z ERROR    app.db failed',
+        ], "")
+
+    def test_tail_filters(self):
+        self.handler.emit(make_record('started'))
+        self.handler.emit(make_record('failed', logging.ERROR, name='app.db'))
+        self.handler.emit(make_record('slow', logging.WARNING, name='web'))
+        lines = self.run_main('--level', 'WARNING', '--logger', 'app', 'tail', '--since', '0',
+                              '--no-follow', '--json')
+        self.assertEqual([json.loads(line)['message'] for line in lines], ['failed'], "")
+
+    def test_filters_after_the_command(self):
+        self.handler.emit(make_record('started'))
+        self.handler.emit(make_record('failed', logging.ERROR, name='app.db'))
+        self.handler.emit(make_record('slow', logging.WARNING, name='web'))
+        lines = self.run_main('tail', '--since', '0', '--no-follow', '--json', '--level', 'WARNING',
+                              '--logger', 'app')
+        self.assertEqual([json.loads(line)['message'] for line in lines], ['failed'], "")
+        lines = self.run_main('--level', 'ERROR', 'export')
+        self.assertEqual([json.loads(line)['message'] for line in lines], ['failed'], "")
+
+    def test_tail_checkpoint(self):
+        checkpoint = os.path.join(self.directory, 'seq')
+        self.handler.emit(make_record('first'))
+        self.assertEqual(len(self.run_main('tail', '--since', '0', '--no-follow',
+                                           '--checkpoint', checkpoint)), 1, "")
+        self.handler.emit(make_record('second'))
+        lines = self.run_main('tail', '--no-follow', '--checkpoint', checkpoint)
+        self.assertEqual(len(lines), 1, "")
+        self.assertTrue(lines[0].endswith('second'), "resumed after the first record")
+
+    def test_follow(self):
+        reader = CouchDBLogReader(self.couchdb.url)
+        rows = []
+        received = threading.Event()
+
+        def tail():
+            for seq, row in reader.changes(since=0, heartbeat=0.05):
+                rows.append(row)
+                if len(rows) == 2:
+                    received.set()
+                    return
+
+        thread = threading.Thread(target=tail)
+        thread.daemon = True
+        thread.start()
+        self.assertFalse(received.wait(0.2), "waiting for new changes")
+        self.handler.emit(make_record('new'))
+        self.assertTrue(received.wait(5), "")
+        self.assertEqual(rows[1]['doc']['message'], 'new', "")
+
+    def test_reopened_after_failure(self):
+        reader = CouchDBLogReader(self.couchdb.url)
+        self.handler.emit(make_record('first'))
+        self.couchdb.fail_next(1)
+        with patch('time.sleep') as sleep:
+            seq, row = next(reader.changes(since=0))
+        self.assertTrue(sleep.called, "")
+        self.assertEqual(row['id'], '_design/couchdblogger', "")
+
+    def test_export(self):
+        for i in range(25):
+            self.handler.emit(make_record('record %d' % i, created=1000.0 + i))
+        output = os.path.join(self.directory, 'logs.ndjson')
+        self.run_main('export', '-o', output, '--page-size', '10')
+        with open(output) as export:
+            docs = [json.loads(line) for line in export]
+        self.assertEqual([doc['message'] for doc in docs], ['record %d' % i for i in range(25)], "")
+
+    def test_export_stdout(self):
+        self.handler.emit(make_record('started'))
+        self.handler.emit(make_record('failed', logging.ERROR))
+        lines = self.run_main('--level', 'ERROR', 'export')
+        self.assertEqual([json.loads(line)['message'] for line in lines], ['failed'], "")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+'''
+    File: test_couchdbdeduplicator_unit.py
+    Description: Tests - CouchDBDeduplicator
+'''
+from mock import patch
+import unittest
+import functools
+import json
+import time
+
+
+import sys, os
+sys.path.insert(0, os.path.abspath("../src"))
+
+from couchdblogger import CouchDBDeduplicator, CouchDBRecord, CouchDBBulkLogHandler, CouchDBSession, logging, _add_fields
+from logrecords import make_record as make_log_record
+
+
+make_record = functools.partial(make_log_record, message='connection to %s failed', args=('db',),
+                                level=logging.ERROR)
+
+
+class CouchDBDeduplicatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.deduplicator = CouchDBDeduplicator(window=60, max_age=3600, max_keys=2)
+
+    def add(self, record):
+        return self.deduplicator.add(record, CouchDBRecord)
+
+    def test_collapse_repeats(self):
+        now = time.time()
+        self.assertEqual(self.add(make_record(args=('db1',), created=now)), [], "")
+        self.assertEqual(self.add(make_record(args=('db2',), created=now + 1)), [], "")
+        self.assertEqual(self.add(make_record(args=('db3',), created=now + 2)), [], "")
+        self.assertEqual(self.deduplicator.expired(), [], "")
+
+        released, = self.deduplicator.expired(flush=True)
+        self.assertEqual(released.getMessage(), 'connection to db1 failed', "")
+        self.assertEqual(released.collapsed, (3, now, now + 2), "")
+        self.assertEqual(self.deduplicator.collapsed, 2, "")
+
+    def test_key(self):
+        self.add(make_record())
+        self.add(make_record(level=logging.WARNING))
+        self.add(make_record(name='other'))
+        self.add(make_record(message='other %s'))
+        self.assertEqual(self.deduplicator.collapsed, 0, "")
+
+    def test_custom_key(self):
+        deduplicator = CouchDBDeduplicator(key=lambda record: record.levelno)
+        deduplicator.add(make_record(), CouchDBRecord)
+        deduplicator.add(make_record(message='other %s'), CouchDBRecord)
+        self.assertEqual(deduplicator.collapsed, 1, "")
+
+    def test_unique_record_not_collapsed(self):
+        self.add(make_record())
+        released, = self.deduplicator.expired(flush=True)
+        self.assertTrue(released.collapsed is None, "")
+
+    def test_sliding_window(self):
+        self.deduplicator.window = 10
+        self.add(make_record(created=time.time() - 30))
+        self.add(make_record(created=time.time() - 5))
+        self.assertEqual(self.deduplicator.expired(), [], "repeated less than window seconds ago")
+        self.add(make_record(message='other %s', created=time.time() - 11))
+        self.assertEqual(len(self.deduplicator.expired()), 1, "")
+
+    def test_max_age(self):
+        self.deduplicator.max_age = 10
+        self.add(make_record(created=time.time() - 11))
+        self.add(make_record())
+        self.assertEqual(len(self.deduplicator.expired()), 1, "")
+
+    def test_lru(self):
+        self.add(make_record(message='a %s'))
+        self.add(make_record(message='b %s'))
+        self.add(make_record(message='a %s'))
+        released = self.add(make_record(message='c %s'))
+        self.assertEqual([record.getMessage() for record in released], ['b db'], "")
+
+
+class AddFieldsTest(unittest.TestCase):
+
+    def test_add_fields(self):
+        self.assertEqual(_add_fields('{"a": 1}', [('count', 2)]), '{"a": 1,"count":2}', "")
+        self.assertEqual(_add_fields('{}', [('count', 2), ('b', 'x')]), '{"count":2,"b":"x"}', "")
+        self.assertEqual(json.loads(_add_fields('{"a": {"b": 1}\n}\n', [('count', 2)])), {'a': {'b': 1}, 'count': 2}, "")
+
+
+class CouchDBBulkLogHandlerDeduplicateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.post = patch.object(CouchDBSession, 'post').start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_deduplicate_window(self):
+        handler = CouchDBBulkLogHandler(flush_interval=60, deduplicate=30)
+        self.assertTrue(isinstance(handler.deduplicator, CouchDBDeduplicator), "")
+        self.assertEqual(handler.deduplicator.window, 30, "")
+        handler.close()
+
+    def test_collapsed_document(self):
+        handler = CouchDBBulkLogHandler(flush_interval=60, deduplicate=60)
+        records = [make_record() for _ in range(5)]
+        for record in records:
+            handler.emit(record)
+        handler.emit(make_record(message='other', args=()))
+        handler.flush()
+
+        docs = json.loads(self.post.call_args[1]['data'])['docs']
+        self.assertEqual(len(docs), 2, "")
+        self.assertEqual(docs[0]['message'], 'connection to db failed', "")
+        self.assertEqual(docs[0]['count'], 5, "")
+        self.assertEqual(docs[0]['first_created'], records[0].created, "")
+        self.assertEqual(docs[0]['last_created'], records[-1].created, "")
+        self.assertTrue('count' not in docs[1], "")
+        handler.close()
+
+    def test_released_after_window(self):
+        handler = CouchDBBulkLogHandler(flush_interval=0.01, deduplicate=0.01)
+        handler.emit(make_record())
+        for _ in range(100):
+            if self.post.called:
+                break
+            time.sleep(0.01)
+        self.assertTrue(self.post.called, "")
+        handler.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
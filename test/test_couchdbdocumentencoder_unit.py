@@ -0,0 +1,90 @@
+'''
+    File: test_couchdbdocumentencoder_unit.py
+    Description: Tests - CouchDBDocumentEncoder
+'''
+import unittest
+import json
+
+
+import sys, os
+sys.path.insert(0, os.path.abspath("../src"))
+
+from couchdblogger import CouchDBDocumentEncoder, CouchDBLogHandler, logging
+
+
+class CouchDBDocumentEncoderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.record = logging.makeLogRecord(dict(
+            msg='log to %s é "quoted"\n', args=('couchdb',), name='process_name',
+            levelno=logging.INFO, levelname='INFO', lineno=42, custom={'a': [1, 2]}))
+
+    def test_default_fields(self):
+        encoder = CouchDBDocumentEncoder()
+        self.assertEqual(json.loads(encoder.encode(self.record)), dict(
+            message='log to couchdb é "quoted"\n',
+            level='INFO',
+            created=self.record.created,
+            logger='process_name'), "")
+
+    def test_same_document_as_stdlib(self):
+        encoder = CouchDBDocumentEncoder()
+        self.assertEqual(encoder.encode(self.record), json.dumps(dict(
+            message=self.record.getMessage(),
+            level=self.record.levelname,
+            created=self.record.created,
+            logger=self.record.name
+        ), separators=(',', ':')), "")
+
+    def test_none_attributes(self):
+        record = logging.makeLogRecord(dict(msg='no name', name=None, pathname=None, lineno=None))
+        encoder = CouchDBDocumentEncoder(['message', ('logger', 'name'), 'pathname', 'lineno', 'levelno'])
+        self.assertEqual(json.loads(encoder.encode(record)), dict(
+            message='no name', logger=None, pathname=None, lineno=None, levelno=None), "")
+
+    def test_fields_and_static_fields(self):
+        encoder = CouchDBDocumentEncoder(
+            fields=['message', ('line', 'lineno'), 'custom', 'missing', ('weird key "', 'funcName')],
+            static_fields={'host': 'web-1', 'env': 'prod', 'tags': ['a']})
+        self.assertEqual(json.loads(encoder.encode(self.record)), {
+            'host': 'web-1', 'env': 'prod', 'tags': ['a'],
+            'message': 'log to couchdb é "quoted"\n',
+            'line': 42,
+            'custom': {'a': [1, 2]},
+            'missing': None,
+            'weird key "': None}, "")
+
+    def test_only_static_fields(self):
+        encoder = CouchDBDocumentEncoder(fields=[], static_fields={'app': 'api'})
+        self.assertEqual(json.loads(encoder.encode(self.record)), {'app': 'api'}, "")
+
+    def test_unserializable_value(self):
+        self.record.custom = object()
+        encoder = CouchDBDocumentEncoder(fields=['custom'])
+        self.assertTrue(json.loads(encoder.encode(self.record))['custom'].startswith('<object'), "")
+
+    def test_encode_batch(self):
+        encoder = CouchDBDocumentEncoder(static_fields={'app': 'api'})
+        body = encoder.encode_batch([self.record, self.record])
+        self.assertEqual(json.loads(body), {'docs': [json.loads(encoder.encode(self.record))] * 2}, "")
+
+    def test_encode_batch_empty(self):
+        self.assertEqual(json.loads(CouchDBDocumentEncoder().encode_batch([])), {'docs': []}, "")
+
+    def test_encode_id(self):
+        for fields, static_fields in ((None, None), ([], {'app': 'api'}), ([], None)):
+            encoder = CouchDBDocumentEncoder(fields, static_fields)
+            doc = encoder.encode_id(self.record, '0123ABCD')
+            self.assertTrue(doc.startswith('{"_id":"0123ABCD"'), "id first")
+            expected = json.loads(encoder.encode(self.record))
+            expected['_id'] = '0123ABCD'
+            self.assertEqual(json.loads(doc), expected, "")
+
+    def test_handler_fields(self):
+        handler = CouchDBLogHandler(fields=['message'], static_fields={'app': 'api'})
+        self.assertEqual(json.loads(handler.format(self.record)),
+                         {'app': 'api', 'message': 'log to couchdb é "quoted"\n'}, "")
+
+
+if __name__ == '__main__':
+    unittest.main()
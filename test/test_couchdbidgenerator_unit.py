@@ -0,0 +1,105 @@
+'''
+    File: test_couchdbidgenerator_unit.py
+    Description: Tests - CouchDBIdGenerator, CouchDBLogHandler document ids
+'''
+from mock import Mock, patch
+import unittest
+import json
+
+
+import sys, os
+sys.path.insert(0, os.path.abspath("../src"))
+
+from couchdblogger import CouchDBIdGenerator, CouchDBLogHandler, CouchDBBulkLogHandler, CouchDBSession, logging, _base32
+from logrecords import make_record
+
+
+class CouchDBIdGeneratorTest(unittest.TestCase):
+
+    def test_format(self):
+        generator = CouchDBIdGenerator(node=1)
+        doc_id = generator(0)
+        self.assertEqual(len(doc_id), 20, "")
+        self.assertEqual(doc_id[:14], '0000000000' + '0001', "")
+
+    def test_time_key(self):
+        generator = CouchDBIdGenerator()
+        self.assertTrue(generator(1700000000.5).startswith(CouchDBIdGenerator.time_key(1700000000.5)), "")
+        self.assertTrue(CouchDBIdGenerator.time_key(1) < CouchDBIdGenerator.time_key(2), "")
+
+    def test_monotonic(self):
+        generator = CouchDBIdGenerator()
+        ids = [generator(1700000000.0) for _ in range(1000)]
+        ids.append(generator(1699999999.0))  # clock going backwards
+        ids.append(generator(1700000001.0))
+        self.assertEqual(ids, sorted(ids), "")
+        self.assertEqual(len(set(ids)), len(ids), "")
+
+    def test_sequence_overflow(self):
+        generator = CouchDBIdGenerator()
+        first = generator(1.0)
+        generator._sequence = (1 << CouchDBIdGenerator.SEQUENCE_BITS) - 1
+        second = generator(1.0)
+        self.assertTrue(first < second, "")
+        self.assertEqual((first[:10], second[:10]), ('00000000Z8', '00000000Z9'), "")
+
+    def test_sequence_digits(self):
+        generator = CouchDBIdGenerator(node=1)
+        generator(1.0)
+        for sequence in (0, 1, 1023, 1024, (1 << CouchDBIdGenerator.SEQUENCE_BITS) - 2):
+            generator._sequence = sequence
+            self.assertEqual(generator(1.0)[14:], _base32(sequence + 1, 6), "")
+        self.assertEqual(_base32(32 ** 5 + 31, 6), '10000Z', "")
+
+    def test_node_per_process(self):
+        generator = CouchDBIdGenerator()
+        first = generator(1.0)
+        with patch('os.getpid', return_value=os.getpid() + 1):
+            second = generator(1.0)
+        self.assertNotEqual(first[10:14], second[10:14], "")
+
+
+class CouchDBLogHandlerIdTest(unittest.TestCase):
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_emit_with_id(self):
+        post = patch.object(CouchDBSession, 'post').start()
+        handler = CouchDBLogHandler(id_generator=lambda created: 'doc-1')
+        handler.emit(make_record())
+        self.assertEqual(json.loads(post.call_args[1]['data'])['_id'], 'doc-1', "")
+
+    def test_emit_without_id(self):
+        post = patch.object(CouchDBSession, 'post').start()
+        handler = CouchDBLogHandler(id_generator=False)
+        handler.emit(make_record())
+        self.assertFalse('_id' in json.loads(post.call_args[1]['data']), "")
+
+    def test_emit_new_format_with_id(self):
+        post = patch.object(CouchDBSession, 'post').start()
+        handler = CouchDBLogHandler(id_generator=lambda created: 'doc-1')
+        handler.new_format(lambda record: json.dumps({'text': record.getMessage()}))
+        handler.emit(make_record())
+        self.assertEqual(json.loads(post.call_args[1]['data']), {'text': 'log to couchdb', '_id': 'doc-1'}, "")
+
+    def test_emit_conflict_is_written(self):
+        patch.object(CouchDBSession, 'post',
+                     side_effect=CouchDBSession.CouchDBException('conflict', 409)).start()
+        handler = CouchDBLogHandler()
+        handler.handleError = Mock()
+        handler.emit(make_record())
+        self.assertFalse(handler.handleError.called, "")
+
+    def test_bulk_ids(self):
+        post = patch.object(CouchDBSession, 'post').start()
+        handler = CouchDBBulkLogHandler(flush_interval=60)
+        for _ in range(3):
+            handler.emit(make_record())
+        handler.close()
+        ids = [doc['_id'] for doc in json.loads(post.call_args[1]['data'])['docs']]
+        self.assertEqual(ids, sorted(set(ids)), "")
+
+
+if __name__ == '__main__':
+    unittest.main()
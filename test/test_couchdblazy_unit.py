@@ -0,0 +1,80 @@
+'''
+    File: test_couchdblazy_unit.py
+    Description: Tests - CouchDBLogHandler lazy initialization
+'''
+from mock import Mock, patch
+import unittest
+import threading
+import time
+
+
+import sys, os
+sys.path.insert(0, os.path.abspath("../src"))
+
+from couchdblogger import CouchDBLogHandler, CouchDBBulkLogHandler, CouchDBSession, logging, requests
+from logrecords import make_record
+
+
+class CouchDBLazyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.post = patch.object(CouchDBSession, 'post').start()
+        self.get = patch.object(CouchDBSession, 'get').start()
+        self.put = patch.object(CouchDBSession, 'put').start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_no_io_in_constructor(self):
+        release = threading.Event()
+        self.post.side_effect = lambda *args, **kwargs: release.wait(5)
+        start = time.time()
+        handler = CouchDBLogHandler(username='user', password='secret', create_database=True, lazy=True)
+        self.assertTrue(time.time() - start < 1, "")
+        self.assertFalse(handler._connected, "")
+        release.set()
+        for _ in range(100):
+            if handler._connected:
+                break
+            time.sleep(0.01)
+        self.assertTrue(handler._connected, "connected in the background")
+        self.assertEqual(self.post.call_args[0][0], 'http://localhost:5984/_session', "")
+        self.assertEqual(self.get.call_args[0][0], 'http://localhost:5984/logs', "")
+
+    def test_unreachable_at_startup(self):
+        self.post.side_effect = requests.ConnectionError()
+        handler = CouchDBLogHandler(username='user', password='secret', lazy=True)
+        handler.handleError = Mock()
+        for _ in range(100):
+            if self.post.called:
+                break
+            time.sleep(0.01)
+        self.assertFalse(handler._connected, "")
+
+        self.post.side_effect = None
+        handler.emit(make_record())
+        self.assertTrue(handler._connected, "connected by the first request")
+        self.assertEqual([call[0][0] for call in self.post.call_args_list[-2:]],
+                         ['http://localhost:5984/_session', 'http://localhost:5984/logs'], "")
+        self.assertFalse(handler.handleError.called, "")
+
+    def test_bulk_emit_does_not_wait(self):
+        self.post.side_effect = requests.ConnectionError()
+        handler = CouchDBBulkLogHandler(username='user', password='secret', lazy=True)
+        handler.handleError = Mock()
+        start = time.time()
+        handler.emit(make_record())
+        self.assertTrue(time.time() - start < 1, "")
+        handler.close()
+        self.assertTrue(handler.handleError.called, "the worker failed to connect")
+
+    def test_connect_once(self):
+        handler = CouchDBLogHandler(username='user', password='secret')
+        handler.emit(make_record())
+        handler.emit(make_record())
+        logins = [call for call in self.post.call_args_list if call[0][0].endswith('/_session')]
+        self.assertEqual(len(logins), 1, "")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,17 @@
+'''
+    File: test_couchdblogger_asyncio_unit.py
+    Description: Tests - AsyncCouchDBLogHandler, skipped before Python 3.8
+'''
+import unittest
+
+
+import sys
+
+if sys.version_info >= (3, 8):
+    # async def does not even compile on the older versions tested by CI,
+    # IsolatedAsyncioTestCase is new in 3.8
+    from couchdblogger_asyncio_cases import *  # noqa
+
+
+if __name__ == '__main__':
+    unittest.main()
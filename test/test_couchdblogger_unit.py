@@ -6,6 +6,7 @@
 from mock import Mock, patch
 import unittest
 import json
+import gzip
 
 
 import sys, os
@@ -23,6 +24,7 @@ class CouchDBLogHandlerTest(unittest.TestCase):
         self.record.getMessage.return_value = 'log to couchdb'
         self.record.levelname = 'level INFO'
         self.record.created = 1396988156
+        self.record.exc_info = self.record.exc_text = self.record.stack_info = None
 
     def test_is_instance(self):
         self.assertTrue(isinstance(self.couchdb_handler, CouchDBLogHandler), "Is instance of CouchDBLogHandler")
@@ -134,12 +136,37 @@ class CouchDBLogHandlerTest(unittest.TestCase):
         self.assertTrue(CouchDBSession.post.call_args[1]['headers'] is not None, "")
 
         left_data = json.loads(CouchDBSession.post.call_args[1]['data'])
+        self.assertEqual(len(left_data.pop('_id')), 20, "")
         right_data = json.loads('{"logger": "process_name", "created": 1396988156, "message": "log to couchdb", "level": "level INFO"}')
 
         self.assertEqual(left_data, right_data, "")
 
         self.assertEqual(CouchDBSession.post.call_args[1]['headers']['Content-type'], 'application/json', "")
 
+    @patch.object(CouchDBSession, 'post')
+    def test_emit_compress(self, *args):
+        self.couchdb_handler = CouchDBLogHandler(compress=True, compress_min_size=0)
+        self.assertTrue(self.couchdb_handler.compression_ratio is None, "")
+        self.couchdb_handler.emit(self.record)
+
+        self.assertEqual(CouchDBSession.post.call_args[1]['headers']['Content-Encoding'], 'gzip', "")
+        data = b''.join(CouchDBSession.post.call_args[1]['data'])
+        left_data = json.loads(gzip.decompress(data).decode('utf-8'))
+        left_data.pop('_id')
+        right_data = json.loads('{"logger": "process_name", "created": 1396988156, "message": "log to couchdb", "level": "level INFO"}')
+        self.assertEqual(left_data, right_data, "")
+        self.assertEqual(self.couchdb_handler.compressed_bytes, len(data), "")
+        self.assertTrue(self.couchdb_handler.uncompressed_bytes > 0, "")
+        self.assertTrue(self.couchdb_handler.compression_ratio is not None, "")
+
+    @patch.object(CouchDBSession, 'post')
+    def test_emit_compress_min_size(self, *args):
+        self.couchdb_handler = CouchDBLogHandler(compress=True, compress_min_size=1024)
+        self.couchdb_handler.emit(self.record)
+
+        self.assertTrue('Content-Encoding' not in CouchDBSession.post.call_args[1]['headers'], "")
+        self.assertTrue(isinstance(CouchDBSession.post.call_args[1]['data'], str), "")
+
     def test_new_format(self):
 
         def format_function(record):
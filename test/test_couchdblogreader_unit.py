@@ -0,0 +1,158 @@
+'''
+    File: test_couchdblogreader_unit.py
+    Description: Tests - CouchDBLogReader, design document
+'''
+from mock import Mock, patch
+import unittest
+import json
+
+
+import sys, os
+sys.path.insert(0, os.path.abspath("../src"))
+sys.path.insert(0, os.path.abspath("../benchmarks"))
+
+from couchdblogger import CouchDBLogReader, CouchDBLogHandler, CouchDBSession, logging, requests
+from fakecouchdb import FakeCouchDB
+from logrecords import make_record
+
+
+def response(body, chunk_size):
+    data = body.encode('utf-8')
+    resp = Mock()
+    resp.iter_content.return_value = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    return resp
+
+
+class CouchDBLogReaderParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reader = CouchDBLogReader()
+        self.get = patch.object(CouchDBSession, 'get').start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_rows_split_anywhere(self):
+        rows = [{'id': 'a', 'key': ['INFO', 1.5], 'value': None, 'doc': {'message': u'caf\xe9 ]}, "rows"'}},
+                {'id': 'b', 'key': ['INFO', 2.5], 'value': None}]
+        body = json.dumps({'total_rows': 2, 'offset': 0, 'rows': rows}, indent=1)
+        for chunk_size in (1, 2, 3, 7, 64, len(body)):
+            self.get.return_value = resp = response(body, chunk_size)
+            self.assertEqual(list(self.reader._stream_rows('url', {})), rows, "chunks of %d" % chunk_size)
+            self.assertTrue(resp.close.called, "")
+
+    def test_no_rows(self):
+        self.get.return_value = response('{"total_rows":0,"offset":0,"rows":[\r\n\r\n]}', 5)
+        self.assertEqual(list(self.reader._stream_rows('url', {})), [], "")
+
+    def test_truncated(self):
+        self.get.return_value = response('{"total_rows":2,"rows":[{"id":"a"},{"id":', 4)
+        rows = self.reader._stream_rows('url', {})
+        self.assertEqual(next(rows), {'id': 'a'}, "")
+        self.assertRaises(ValueError, next, rows)
+
+    def test_pagination(self):
+        pages = [
+            '{"rows":[{"id":"a","key":1,"doc":{"n":1}},{"id":"b","key":2,"doc":{"n":2}},'
+            '{"id":"c","key":2,"doc":{"n":3}}]}',
+            '{"rows":[{"id":"c","key":2,"doc":{"n":3}}]}',
+        ]
+        self.get.side_effect = [response(page, 10) for page in pages]
+        self.reader.page_size = 2
+        self.assertEqual(list(self.reader.by_time(1)), [{'n': 1}, {'n': 2}, {'n': 3}], "")
+        params = [call[1]['params'] for call in self.get.call_args_list]
+        self.assertEqual(params[0]['limit'], 3, "one more row to start the next page")
+        self.assertEqual((params[1]['startkey'], params[1]['startkey_docid']), ('2', 'c'), "")
+        self.assertTrue(self.get.call_args[1]['stream'], "")
+
+
+class CouchDBLogReaderInstallTest(unittest.TestCase):
+
+    def setUp(self):
+        self.session = Mock()
+
+    def test_missing(self):
+        self.session.get.side_effect = CouchDBSession.CouchDBException('not_found', 404)
+        CouchDBLogReader.install(self.session, 'http://localhost:5984/logs')
+        url, = self.session.put.call_args[0]
+        self.assertEqual(url, 'http://localhost:5984/logs/_design/couchdblogger', "")
+        doc = json.loads(self.session.put.call_args[1]['data'])
+        self.assertEqual(sorted(doc['views']), ['by_level', 'by_logger', 'by_time'], "")
+        self.assertFalse('_rev' in doc, "")
+
+    def test_up_to_date(self):
+        self.session.get.return_value.json.return_value = {'_rev': '1-a', 'version': 1}
+        CouchDBLogReader.install(self.session, 'http://localhost:5984/logs')
+        self.assertFalse(self.session.put.called, "idempotent")
+
+    def test_upgrade(self):
+        self.session.get.return_value.json.return_value = {'_rev': '3-a'}
+        CouchDBLogReader.install(self.session, 'http://localhost:5984/logs')
+        self.assertEqual(json.loads(self.session.put.call_args[1]['data'])['_rev'], '3-a', "")
+
+    def test_installed_meanwhile(self):
+        self.session.get.side_effect = CouchDBSession.CouchDBException('not_found', 404)
+        self.session.put.side_effect = CouchDBSession.CouchDBException('conflict', 409)
+        CouchDBLogReader.install(self.session, 'http://localhost:5984/logs')
+
+
+class CouchDBLogReaderFakeCouchDBTest(unittest.TestCase):
+
+    def setUp(self):
+        # other tests replace CouchDBSession.get for good
+        patch.object(CouchDBSession, 'get', requests.Session.get).start()
+        self.couchdb = FakeCouchDB().start()
+        self.handler = CouchDBLogHandler(host=self.couchdb.host, port=self.couchdb.port,
+                                         create_database=True, install_views=True)
+        self.reader = CouchDBLogReader(self.couchdb.url, page_size=2)
+
+    def tearDown(self):
+        self.couchdb.stop()
+        patch.stopall()
+
+    def emit(self, records):
+        for message, level, name, created in records:
+            self.handler.emit(make_record(message, level, name, created))
+
+    def messages(self, docs):
+        return [doc['message'] for doc in docs]
+
+    def test_views_installed_once(self):
+        self.assertTrue('_design/couchdblogger' in self.couchdb.databases['logs'], "")
+        CouchDBLogHandler(host=self.couchdb.host, port=self.couchdb.port, install_views=True)
+        self.assertEqual(self.couchdb.databases['logs']['_design/couchdblogger']['_rev'], '1-1', "")
+
+    def test_by_level(self):
+        self.emit([('e%d' % i, logging.ERROR, 'app', 100.0 + i) for i in range(5)] +
+                  [('i%d' % i, logging.INFO, 'app', 100.5 + i) for i in range(5)])
+        self.assertEqual(self.messages(self.reader.by_level('ERROR')), ['e0', 'e1', 'e2', 'e3', 'e4'], "")
+        self.assertEqual(self.messages(self.reader.by_level('ERROR', start=101, end=103)), ['e1', 'e2', 'e3'], "")
+        self.assertEqual(self.messages(self.reader.by_level('INFO', descending=True, limit=3)),
+                         ['i4', 'i3', 'i2'], "")
+
+    def test_by_logger(self):
+        self.emit([('a', logging.INFO, 'app.db', 1.0), ('b', logging.INFO, 'app', 2.0),
+                   ('c', logging.WARNING, 'app.db', 3.0)])
+        self.assertEqual(self.messages(self.reader.by_logger('app.db')), ['a', 'c'], "")
+
+    def test_by_time_with_equal_keys(self):
+        self.emit([('m%d' % i, logging.INFO, 'app', 10.0 + i // 3) for i in range(9)])
+        self.assertEqual(sorted(self.messages(self.reader.by_time())), ['m%d' % i for i in range(9)],
+                         "rows with the same key span the pages")
+        self.assertEqual(sorted(self.messages(self.reader.by_time(11.0, 11.0))), ['m3', 'm4', 'm5'], "")
+
+    def test_all_docs(self):
+        self.emit([('m%d' % i, logging.INFO, 'app', 10.0 + i) for i in range(5)])
+        docs = [doc for doc in self.reader.all_docs() if not doc['_id'].startswith('_design/')]
+        self.assertEqual(self.messages(docs), ['m0', 'm1', 'm2', 'm3', 'm4'], "ids sorted by time")
+        self.assertEqual(len(list(self.reader.all_docs(include_docs=False, limit=3))), 3, "")
+
+    def test_partitions(self):
+        handler = CouchDBLogHandler(host=self.couchdb.host, port=self.couchdb.port,
+                                    database='logs-%Y', install_views=True)
+        handler.emit(make_record(created=0.0))
+        self.assertTrue('_design/couchdblogger' in self.couchdb.databases['logs-1970'], "")
+
+
+if __name__ == '__main__':
+    unittest.main()
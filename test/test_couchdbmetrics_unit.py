@@ -0,0 +1,144 @@
+'''
+    File: test_couchdbmetrics_unit.py
+    Description: Tests - CouchDBMetrics, handler instrumentation
+'''
+from mock import Mock, patch
+import unittest
+import threading
+import json
+
+
+import sys, os
+sys.path.insert(0, os.path.abspath("../src"))
+
+from couchdblogger import CouchDBMetrics, CouchDBLogHandler, CouchDBBulkLogHandler, CouchDBSession, logging, requests
+from logrecords import make_record
+
+
+class CouchDBMetricsTest(unittest.TestCase):
+
+    def test_counters_per_thread(self):
+        metrics = CouchDBMetrics()
+
+        def work():
+            for _ in range(1000):
+                metrics.incr('emitted')
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        metrics.incr('bytes_sent', 10)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['emitted'], 4000, "")
+        self.assertEqual(snapshot['bytes_sent'], 10, "")
+        self.assertEqual(snapshot['failed'], 0, "")
+        self.assertEqual(len(metrics._shards), 1, "shards of the finished threads folded")
+
+    def test_short_lived_threads(self):
+        metrics = CouchDBMetrics()
+        for _ in range(200):
+            thread = threading.Thread(target=metrics.observe, args=('emit', 0.001))
+            thread.start()
+            thread.join()
+        self.assertTrue(len(metrics._shards) < 64, "swept without snapshot()")
+        self.assertEqual(metrics.snapshot()['emit']['count'], 200, "")
+        self.assertEqual(len(metrics._shards), 0, "")
+
+    def test_histogram(self):
+        metrics = CouchDBMetrics()
+        for _ in range(98):
+            metrics.observe('request', 0.001)
+        metrics.observe('request', 0.5)
+        metrics.observe('request', 1000.0)
+
+        request = metrics.snapshot()['request']
+        self.assertEqual(request['count'], 100, "")
+        self.assertAlmostEqual(request['sum'], 1000.598, 6)
+        self.assertEqual(request['max'], 1000.0, "")
+        self.assertTrue(0.001 <= request['p50'] < 0.002, "")
+        self.assertTrue(0.5 <= request['p99'] < 1.0, "")
+        self.assertEqual(metrics.snapshot()['emit']['p50'], 0.0, "")
+
+    def test_gauges(self):
+        metrics = CouchDBMetrics()
+        metrics.gauges['queue_depth'] = lambda: 7
+        self.assertEqual(metrics.snapshot()['queue_depth'], 7, "")
+
+
+class CouchDBHandlerMetricsTest(unittest.TestCase):
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_emit(self):
+        patch.object(CouchDBSession, 'post').start()
+        handler = CouchDBLogHandler()
+        handler.emit(make_record())
+        snapshot = handler.metrics.snapshot()
+        self.assertEqual((snapshot['emitted'], snapshot['documents_sent'], snapshot['requests']), (1, 1, 1), "")
+        self.assertTrue(snapshot['bytes_sent'] > 0, "")
+        self.assertEqual(snapshot['emit']['count'], 1, "")
+        self.assertEqual(snapshot['serialize']['count'], 1, "")
+        self.assertEqual(snapshot['request']['count'], 1, "")
+
+    def test_emit_failed(self):
+        patch.object(CouchDBSession, 'post', side_effect=CouchDBSession.CouchDBException('bad', 400)).start()
+        handler = CouchDBLogHandler()
+        handler.handleError = Mock()
+        handler.emit(make_record())
+        snapshot = handler.metrics.snapshot()
+        self.assertEqual((snapshot['failed'], snapshot['documents_sent']), (1, 0), "")
+
+    def test_bulk(self):
+        patch.object(CouchDBSession, 'post').start()
+        handler = CouchDBBulkLogHandler(flush_interval=60)
+        handler.emit(make_record())
+        handler.emit(make_record())
+        handler.flush()
+        handler.queue.dropped_newest = 3
+        snapshot = handler.metrics.snapshot()
+        self.assertEqual((snapshot['emitted'], snapshot['documents_sent'], snapshot['requests']), (2, 2, 1), "")
+        self.assertEqual((snapshot['queue_depth'], snapshot['dropped']), (0, 3), "")
+        self.assertEqual(snapshot['serialize']['count'], 1, "one batch")
+        handler.close()
+
+    def test_bulk_failed(self):
+        patch.object(CouchDBSession, 'post', side_effect=requests.ConnectionError()).start()
+        handler = CouchDBBulkLogHandler(flush_interval=60)
+        handler.handleError = Mock()
+        handler.emit(make_record())
+        handler.emit(make_record())
+        handler.close()
+        self.assertEqual(handler.metrics.snapshot()['failed'], 2, "")
+
+    def test_write_stats(self):
+        put = patch.object(CouchDBSession, 'put').start()
+        put.return_value.json.return_value = {'ok': True, 'rev': '0-1'}
+        handler = CouchDBLogHandler()
+        handler.databases.add('logs')
+        handler.write_stats()
+        handler.write_stats()
+
+        url = put.call_args[0][0]
+        self.assertTrue(url.startswith('http://localhost:5984/logs/_local/couchdblogger-'), "")
+        self.assertTrue(url.endswith('-%d' % os.getpid()), "")
+        doc = json.loads(put.call_args[1]['data'])
+        self.assertEqual(doc['_rev'], '0-1', "")
+        self.assertEqual(doc['emitted'], 0, "")
+        self.assertTrue('request' in doc, "")
+
+    def test_write_stats_conflict(self):
+        put = patch.object(CouchDBSession, 'put').start()
+        get = patch.object(CouchDBSession, 'get').start()
+        put.side_effect = [CouchDBSession.CouchDBException('conflict', 409), Mock()]
+        get.return_value.json.return_value = {'_rev': '0-7'}
+        handler = CouchDBLogHandler()
+        handler.databases.add('logs')
+        handler.write_stats()
+        self.assertEqual(json.loads(put.call_args[1]['data'])['_rev'], '0-7', "")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+'''
+    File: test_couchdbnodepool_unit.py
+    Description: Tests - CouchDBNodePool, CouchDBLogHandler with nodes
+'''
+from mock import Mock, patch
+import unittest
+import json
+
+
+import sys, os
+sys.path.insert(0, os.path.abspath("../src"))
+
+from couchdblogger import CouchDBNode, CouchDBNodePool, CouchDBLogHandler, CouchDBBulkLogHandler, CouchDBSession, logging, requests
+from logrecords import make_record
+
+
+class CouchDBNodePoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.nodes = [CouchDBNode('http://db%d:5984' % i, 'logs') for i in range(3)]
+
+    def make_pool(self, **kwargs):
+        return CouchDBNodePool(self.nodes, health_check_interval=None, **kwargs)
+
+    def test_node(self):
+        self.assertEqual(self.nodes[0].db_url, 'http://db0:5984/logs', "")
+        self.assertFalse(self.nodes[0].session is self.nodes[1].session, "one session per node")
+
+    def test_invalid_balance(self):
+        self.assertRaises(ValueError, self.make_pool, balance='random')
+
+    def test_round_robin(self):
+        pool = self.make_pool()
+        firsts = [pool.candidates()[0] for _ in range(6)]
+        self.assertEqual(firsts, self.nodes * 2, "")
+
+    def test_round_robin_skips_ejected_nodes(self):
+        pool = self.make_pool()
+        self.nodes[1].healthy = False
+        firsts = [pool.candidates()[0] for _ in range(4)]
+        self.assertEqual(firsts, [self.nodes[0], self.nodes[2]] * 2, "")
+        self.assertEqual(pool.candidates()[-1], self.nodes[1], "ejected nodes are tried last")
+
+    def test_least_latency(self):
+        pool = self.make_pool(balance='least_latency')
+        pool.report(self.nodes[0], 0.5)
+        pool.report(self.nodes[1], 0.1)
+        pool.report(self.nodes[2], 0.3)
+        self.assertEqual(pool.candidates(), [self.nodes[1], self.nodes[2], self.nodes[0]], "")
+
+    def test_report_moving_average(self):
+        pool = self.make_pool(latency_decay=0.5)
+        pool.report(self.nodes[0], 1.0)
+        pool.report(self.nodes[0], 0.0)
+        self.assertEqual(self.nodes[0].latency, 0.5, "")
+        pool.report(self.nodes[0])
+        self.assertFalse(self.nodes[0].healthy, "")
+
+    @patch.object(CouchDBSession, 'post')
+    def test_post_failover(self, post):
+        def unreachable(url, **kwargs):
+            if url.startswith('http://db0'):
+                raise requests.ConnectionError()
+        post.side_effect = unreachable
+        pool = self.make_pool()
+
+        pool.post('/logs/_bulk_docs', lambda: '{"docs":[]}', {})
+
+        self.assertEqual([call[0][0] for call in post.call_args_list],
+                         ['http://db0:5984/logs/_bulk_docs', 'http://db1:5984/logs/_bulk_docs'], "")
+        self.assertFalse(self.nodes[0].healthy, "")
+        self.assertTrue(self.nodes[1].latency is not None, "")
+
+    @patch.object(CouchDBSession, 'post')
+    def test_post_all_unreachable(self, post):
+        post.side_effect = requests.ConnectionError()
+        pool = self.make_pool()
+        self.assertRaises(requests.ConnectionError, pool.post, '/logs', lambda: '{}', {})
+        self.assertEqual(post.call_count, 3, "")
+
+    @patch.object(CouchDBSession, 'post')
+    def test_post_rejected_no_failover(self, post):
+        post.side_effect = CouchDBSession.CouchDBException('bad', 400)
+        pool = self.make_pool()
+        self.assertRaises(CouchDBSession.CouchDBException, pool.post, '/logs', lambda: '{}', {})
+        self.assertEqual(post.call_count, 1, "")
+        self.assertTrue(self.nodes[0].healthy, "")
+
+    @patch.object(CouchDBSession, 'get')
+    def test_check(self, get):
+        def health(url, **kwargs):
+            if url == 'http://db2:5984/_up':
+                raise requests.Timeout()
+        get.side_effect = health
+        pool = self.make_pool()
+        self.nodes[0].healthy = False
+
+        pool.check()
+
+        self.assertEqual([node.healthy for node in self.nodes], [True, True, False], "")
+        self.assertEqual(get.call_args[1]['timeout'], pool.health_check_timeout, "")
+
+    @patch.object(CouchDBSession, 'get')
+    def test_check_slow_node(self, get):
+        pool = self.make_pool(slow_threshold=-1)
+        pool.check()
+        self.assertEqual(pool.healthy(), [], "")
+
+
+class CouchDBLogHandlerNodesTest(unittest.TestCase):
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_init_nodes(self):
+        post = patch.object(CouchDBSession, 'post').start()
+        handler = CouchDBLogHandler(nodes=['db0', 'db1:6984', ('db2', 7984)], username='user', password='secret',
+                                    health_check_interval=None)
+
+        self.assertEqual([node.db_url for node in handler.nodes.nodes],
+                         ['http://db0:5984/logs', 'http://db1:6984/logs', 'http://db2:7984/logs'], "")
+        self.assertEqual(handler.url, 'http://db0:5984', "")
+        self.assertEqual([call[0][0] for call in post.call_args_list],
+                         ['http://db0:5984/_session', 'http://db1:6984/_session', 'http://db2:7984/_session'], "")
+        handler.close()
+
+    def node_down(self, url, **kwargs):
+        if url.startswith('http://db1'):
+            raise requests.ConnectionError()
+
+    def test_login_node_down(self):
+        for lazy in (False, True):
+            post = patch.object(CouchDBSession, 'post', side_effect=self.node_down).start()
+            handler = CouchDBLogHandler(nodes=['db0', 'db1'], username='user', password='secret',
+                                        health_check_interval=None, lazy=lazy)
+            handler.handleError = Mock()
+            for _ in range(3):
+                handler.emit(make_record())
+
+            self.assertFalse(handler.handleError.called, "lazy=%s" % lazy)
+            self.assertEqual([node.healthy for node in handler.nodes.nodes], [True, False], "")
+            self.assertEqual([call[0][0] for call in post.call_args_list].count('http://db0:5984/logs'), 3, "")
+            handler.close()
+            patch.stopall()
+
+    def test_login_after_recovery(self):
+        post = patch.object(CouchDBSession, 'post', side_effect=self.node_down).start()
+        get = patch.object(CouchDBSession, 'get').start()
+        handler = CouchDBLogHandler(nodes=['db0', 'db1'], username='user', password='secret',
+                                    health_check_interval=None)
+        post.side_effect = None
+        handler.nodes.check()
+
+        self.assertEqual([node.healthy for node in handler.nodes.nodes], [True, True], "")
+        self.assertEqual(post.call_args[0][0], 'http://db1:5984/_session', "")
+        self.assertTrue(handler.nodes.nodes[1].logged_in, "")
+        handler.close()
+
+    def test_login_all_nodes_down(self):
+        patch.object(CouchDBSession, 'post', side_effect=requests.ConnectionError()).start()
+        self.assertRaises(requests.ConnectionError, CouchDBLogHandler, nodes=['db0', 'db1'], username='user',
+                          password='secret', health_check_interval=None)
+
+    def test_emit_round_robin(self):
+        post = patch.object(CouchDBSession, 'post').start()
+        handler = CouchDBLogHandler(nodes=['db0', 'db1'], health_check_interval=None)
+        for _ in range(4):
+            handler.emit(make_record())
+
+        self.assertEqual([call[0][0] for call in post.call_args_list],
+                         ['http://db0:5984/logs', 'http://db1:5984/logs'] * 2, "")
+        handler.close()
+
+    def test_bulk_failover(self):
+        def unreachable(url, **kwargs):
+            if url.startswith('http://db0'):
+                raise requests.ConnectionError()
+        post = patch.object(CouchDBSession, 'post', side_effect=unreachable).start()
+        handler = CouchDBBulkLogHandler(nodes=['db0', 'db1'], health_check_interval=None, flush_interval=60)
+        handler.handleError = Mock()
+        handler.emit(make_record())
+        handler.flush()
+        handler.close()
+
+        self.assertFalse(handler.handleError.called, "")
+        self.assertEqual(post.call_args[0][0], 'http://db1:5984/logs/_bulk_docs', "")
+        self.assertEqual(json.loads(post.call_args[1]['data'])['docs'][0]['message'], 'log to couchdb', "")
+
+
+if __name__ == '__main__':
+    unittest.main()
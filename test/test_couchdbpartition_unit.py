@@ -0,0 +1,128 @@
+'''
+    File: test_couchdbpartition_unit.py
+    Description: Tests - CouchDBLogHandler with time-partitioned databases
+'''
+from mock import Mock, patch
+import unittest
+import calendar
+import datetime
+import json
+import time
+
+
+import sys, os
+sys.path.insert(0, os.path.abspath("../src"))
+
+from couchdblogger import CouchDBLogHandler, CouchDBBulkLogHandler, CouchDBSession, logging
+from logrecords import make_record as make_log_record
+
+
+def make_record(created):
+    return make_log_record(created=calendar.timegm(created.timetuple()))
+
+
+def not_found(url, **kwargs):
+    raise CouchDBSession.CouchDBException('not_found', 404)
+
+
+class CouchDBPartitionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.post = patch.object(CouchDBSession, 'post').start()
+        self.get = patch.object(CouchDBSession, 'get', side_effect=not_found).start()
+        self.put = patch.object(CouchDBSession, 'put').start()
+        self.delete = patch.object(CouchDBSession, 'delete').start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_not_partitioned(self):
+        handler = CouchDBLogHandler()
+        self.assertFalse(handler.partitioned, "")
+        self.assertEqual(handler._partition(0), None, "")
+
+    def test_partition(self):
+        handler = CouchDBLogHandler(database='logs-%Y-%m-%d', create_database=True)
+        self.assertTrue(handler.partitioned, "")
+        self.assertFalse(self.get.called, "no probe of the pattern itself")
+        self.assertEqual(handler._partition(86400 * 365), 'logs-1971-01-01', "")
+
+    def test_emit_creates_database_once(self):
+        handler = CouchDBLogHandler(database='logs-%Y-%m-%d')
+        handler.emit(make_record(datetime.datetime(2024, 5, 1, 10)))
+        handler.emit(make_record(datetime.datetime(2024, 5, 1, 11)))
+        handler.emit(make_record(datetime.datetime(2024, 5, 2)))
+
+        self.assertEqual([call[0][0] for call in self.put.call_args_list],
+                         ['http://localhost:5984/logs-2024-05-01',
+                          'http://localhost:5984/logs-2024-05-02'], "")
+        self.assertEqual(self.get.call_count, 2, "existence is cached")
+        self.assertEqual([call[0][0] for call in self.post.call_args_list],
+                         ['http://localhost:5984/logs-2024-05-01'] * 2 +
+                         ['http://localhost:5984/logs-2024-05-02'], "")
+        self.assertEqual(handler.databases, set(['logs-2024-05-01', 'logs-2024-05-02']), "")
+
+    def test_created_meanwhile(self):
+        self.put.side_effect = CouchDBSession.CouchDBException('file_exists', 412)
+        handler = CouchDBLogHandler(database='logs-%Y-%m-%d')
+        handler.handleError = Mock()
+        handler.emit(make_record(datetime.datetime(2024, 5, 1)))
+        self.assertFalse(handler.handleError.called, "")
+        self.assertEqual(self.post.call_count, 1, "")
+
+    def test_bulk_one_request_per_partition(self):
+        handler = CouchDBBulkLogHandler(database='logs-%Y-%m', flush_interval=60)
+        for day in (30, 31):
+            handler.emit(make_record(datetime.datetime(2024, 5, day)))
+        handler.emit(make_record(datetime.datetime(2024, 6, 1)))
+        handler.close()
+
+        self.assertEqual([call[0][0] for call in self.post.call_args_list],
+                         ['http://localhost:5984/logs-2024-05/_bulk_docs',
+                          'http://localhost:5984/logs-2024-06/_bulk_docs'], "")
+        self.assertEqual([len(json.loads(call[1]['data'])['docs'])
+                          for call in self.post.call_args_list], [2, 1], "")
+
+    def test_expired_databases(self):
+        handler = CouchDBLogHandler(database='logs-%Y-%m-%d', retention=datetime.timedelta(days=7),
+                                    retention_interval=3600)
+        now = calendar.timegm(datetime.datetime(2024, 5, 10, 12).timetuple())
+        names = ['_users', 'logs-2024-05-01', 'logs-2024-05-02', 'logs-2024-05-03',
+                 'logs-2024-05-10', 'logs-archive']
+        self.assertEqual(handler.expired_databases(names, now),
+                         ['logs-2024-05-01', 'logs-2024-05-02'], "")
+        handler.close()
+
+    def test_expired_databases_monthly(self):
+        handler = CouchDBLogHandler(database='logs-%Y-%m', retention=86400)
+        now = calendar.timegm(datetime.datetime(2024, 5, 1, 12).timetuple())
+        self.assertEqual(handler.expired_databases(['logs-2024-03', 'logs-2024-04'], now),
+                         ['logs-2024-03'], "the current month is still written")
+        handler.close()
+
+    def test_expired_databases_weekly(self):
+        now = calendar.timegm(datetime.datetime(2026, 10, 18, 12).timetuple())
+        for database, names, expired in (
+                ('logs-%Y-%U', ['logs-2026-36', 'logs-2026-37', 'logs-2026-42'], ['logs-2026-36']),
+                ('logs-%Y-%W', ['logs-2026-36', 'logs-2026-37', 'logs-2026-41'], ['logs-2026-36'])):
+            handler = CouchDBLogHandler(database=database, retention=datetime.timedelta(days=30))
+            self.assertEqual(handler.expired_databases(names, now), expired, database)
+            self.assertTrue(time.strftime(database, time.gmtime(now)) in names, "current week kept")
+            handler.close()
+
+    def test_apply_retention(self):
+        self.get.side_effect = None
+        self.get.return_value.json.return_value = ['logs-2000-01-01', 'logs']
+        handler = CouchDBLogHandler(database='logs-%Y-%m-%d', retention=86400)
+        handler.databases.add('logs-2000-01-01')
+
+        handler.apply_retention()
+        handler.close()
+
+        self.assertEqual(self.get.call_args[0][0], 'http://localhost:5984/_all_dbs', "")
+        self.delete.assert_called_once_with('http://localhost:5984/logs-2000-01-01')
+        self.assertEqual(handler.databases, set(), "")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+'''
+    File: test_couchdbpayloads_unit.py
+    Description: Tests - CouchDBPayloads, exception capture
+'''
+from mock import Mock, patch
+import unittest
+import base64
+import gzip
+import hashlib
+import json
+import sys
+
+
+import os
+sys.path.insert(0, os.path.abspath("../src"))
+
+from couchdblogger import CouchDBPayloads, CouchDBLogHandler, CouchDBBulkLogHandler, CouchDBSession, logging
+from logrecords import make_record
+
+
+def exc_info():
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        return sys.exc_info()
+
+
+class CouchDBPayloadsTest(unittest.TestCase):
+
+    def test_invalid_mode(self):
+        self.assertRaises(ValueError, CouchDBPayloads, mode='drop')
+
+    def test_truncate(self):
+        payloads = CouchDBPayloads(threshold=4, mode='truncate')
+        fields, docs = payloads.compact('message', 'abcdefgh')
+        self.assertEqual(fields, [('message', 'abcd'), ('message_size', 8),
+                                  ('message_sha1', hashlib.sha1(b'abcdefgh').hexdigest())], "")
+        self.assertEqual(docs, [], "")
+
+    def test_attach(self):
+        payloads = CouchDBPayloads(threshold=4)
+        fields, docs = payloads.compact('exception', 'abcdefgh')
+        digest = hashlib.sha1(b'abcdefgh').hexdigest()
+        self.assertEqual(fields[-1], ('exception_payload', 'payload-' + digest), "")
+
+        doc = json.loads(docs[0])
+        self.assertEqual(doc['_id'], 'payload-' + digest, "")
+        attachment = doc['_attachments']['payload.gz']
+        self.assertEqual(attachment['content_type'], 'application/gzip', "")
+        self.assertEqual(gzip.decompress(base64.b64decode(attachment['data'])), b'abcdefgh', "")
+
+    def test_uploaded_once(self):
+        payloads = CouchDBPayloads(threshold=4, cache_size=2)
+        self.assertEqual(len(payloads.compact('exception', 'aaaaaaa')[1]), 1, "")
+        self.assertEqual(len(payloads.compact('stack', 'aaaaaaa')[1]), 0, "")
+        payloads.compact('exception', 'bbbbbbb')
+        payloads.compact('exception', 'ccccccc')
+        self.assertEqual(len(payloads.compact('exception', 'aaaaaaa')[1]), 1, "evicted from the cache")
+
+
+class CouchDBHandlerPayloadsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.post = patch.object(CouchDBSession, 'post').start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def posted(self):
+        return json.loads(self.post.call_args[1]['data'])
+
+    def test_exception(self):
+        handler = CouchDBLogHandler()
+        handler.emit(make_record(exc_info=exc_info(), stack_info='Stack (most recent call last):'))
+        doc = self.posted()
+        self.assertTrue(doc['exception'].startswith('Traceback'), "")
+        self.assertTrue(doc['exception'].endswith('ValueError: boom'), "")
+        self.assertEqual(doc['stack'], 'Stack (most recent call last):', "")
+
+    def test_no_exception(self):
+        handler = CouchDBLogHandler()
+        handler.emit(make_record())
+        self.assertFalse('exception' in self.posted(), "")
+        self.assertFalse('stack' in self.posted(), "")
+
+    def test_capture_exceptions_off(self):
+        handler = CouchDBLogHandler(capture_exceptions=False)
+        handler.emit(make_record(exc_info=exc_info()))
+        self.assertFalse('exception' in self.posted(), "")
+
+    def test_large_exception_goes_to_payload(self):
+        handler = CouchDBLogHandler(payloads=CouchDBPayloads(threshold=20))
+        record = make_record(exc_info=exc_info())
+        handler.emit(record)
+        self.assertEqual(self.post.call_args[0][0], 'http://localhost:5984/logs/_bulk_docs', "")
+        payload, doc = self.posted()['docs']
+        self.assertEqual(len(doc['exception']), 20, "")
+        self.assertEqual(doc['exception_payload'], payload['_id'], "")
+
+        handler.emit(record)
+        self.assertEqual(self.post.call_args[0][0], 'http://localhost:5984/logs', "uploaded once")
+        self.assertEqual(self.posted()['exception_payload'], payload['_id'], "")
+
+    def test_uploaded_again_after_failure(self):
+        handler = CouchDBLogHandler(payloads=CouchDBPayloads(threshold=20))
+        handler.handleError = Mock()
+        record = make_record(exc_info=exc_info())
+        self.post.side_effect = CouchDBSession.CouchDBException('', 503)
+        handler.emit(record)
+        self.assertTrue(handler.handleError.called, "")
+        self.post.side_effect = None
+        handler.emit(record)
+        payload, doc = self.posted()['docs']
+        self.assertEqual(doc['exception_payload'], payload['_id'], "")
+
+    def test_forget(self):
+        payloads = CouchDBPayloads(threshold=4)
+        docs = payloads.compact('exception', 'aaaaaaa')[1]
+        payloads.forget(['{"message": "\\"_id\\": \\"%s\\""}' % json.loads(docs[0])['_id']])
+        self.assertEqual(payloads.compact('exception', 'aaaaaaa')[1], [], "not a payload document")
+        payloads.forget(docs)
+        self.assertEqual(payloads.compact('exception', 'aaaaaaa')[1], docs, "")
+
+    def test_large_message(self):
+        handler = CouchDBLogHandler(payloads=CouchDBPayloads(threshold=10, mode='truncate'))
+        handler.emit(make_record('x' * 100))
+        doc = self.posted()
+        self.assertEqual((doc['message'], doc['message_size']), ('x' * 10, 100), "")
+        self.assertEqual(doc['logger'], 'process_name', "")
+
+    def test_payloads_off(self):
+        handler = CouchDBLogHandler(payloads=False)
+        handler.emit(make_record('x' * 100000))
+        self.assertEqual(len(self.posted()['message']), 100000, "")
+
+    def test_bulk(self):
+        handler = CouchDBBulkLogHandler(flush_interval=60, payloads=CouchDBPayloads(threshold=20))
+        for _ in range(3):
+            handler.emit(make_record(exc_info=exc_info()))
+        handler.close()
+        docs = self.posted()['docs']
+        self.assertEqual(len(docs), 4, "one payload document, three log documents")
+        self.assertEqual(docs[0]['type'], 'payload', "")
+        self.assertEqual(set(doc['exception_payload'] for doc in docs[1:]), set([docs[0]['_id']]), "")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,211 @@
+'''
+    File: test_couchdbrecordbuffer_unit.py
+    Description: Tests - CouchDBRecord, CouchDBRecordBuffer
+'''
+from mock import patch
+import unittest
+import functools
+import threading
+import json
+import time
+
+
+import sys, os
+sys.path.insert(0, os.path.abspath("../src"))
+
+from couchdblogger import CouchDBRecord, CouchDBRecordBuffer, CouchDBBulkLogHandler, CouchDBSession, logging, queue, _Flush
+from logrecords import make_record as make_log_record
+
+
+make_record = functools.partial(make_log_record, message='log to %s', args=('couchdb',))
+
+
+def snapshot(message='x', level=logging.INFO):
+    return CouchDBRecord(make_record(message=message, args=(), level=level))
+
+
+class CouchDBRecordTest(unittest.TestCase):
+
+    def test_snapshot(self):
+        record = make_record(lineno=42, custom='value')
+        snap = CouchDBRecord(record)
+
+        self.assertFalse(hasattr(snap, '__dict__'), "")
+        self.assertEqual(snap.getMessage(), 'log to couchdb', "")
+        self.assertEqual(snap.msg, 'log to couchdb', "")
+        self.assertTrue(snap.args is None, "")
+        self.assertEqual(snap.name, 'process_name', "")
+        self.assertEqual(snap.levelno, logging.INFO, "")
+        self.assertEqual(snap.lineno, 42, "")
+        self.assertEqual(snap.created, record.created, "")
+        self.assertFalse(hasattr(snap, 'custom'), "")
+        self.assertEqual(snap.size, snap.OVERHEAD + len('log to couchdb'), "")
+
+    def test_snapshot_extra(self):
+        snap = CouchDBRecord(make_record(custom='value'), extra=('custom', 'missing'))
+        self.assertEqual(snap.custom, 'value', "")
+        self.assertFalse(hasattr(snap, 'missing'), "")
+
+    def test_snapshot_exception(self):
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            record = make_record(exc_info=sys.exc_info())
+        snap = CouchDBRecord(record)
+        self.assertTrue(snap.exc_info is None, "")
+        self.assertTrue('ValueError: boom' in snap.exc_text, "")
+        self.assertTrue(snap.size > snap.OVERHEAD + len(snap.exc_text), "")
+
+    def test_capturing(self):
+        record_class = CouchDBRecord.capturing(['levelname', 'custom'])
+        self.assertTrue(record_class is CouchDBRecord.capturing(('custom', 'levelname')), "one class per set")
+        self.assertEqual(record_class.CAPTURED, ('name', 'levelno', 'levelname', 'created'), "")
+        snap = record_class(make_record(lineno=42, stack_info='stack'))
+        self.assertTrue(isinstance(snap, CouchDBRecord), "")
+        self.assertEqual(snap.levelname, 'INFO', "")
+        self.assertFalse(hasattr(snap, 'lineno'), "")
+        self.assertTrue(snap.stack_info is None, "")
+        self.assertTrue(snap.size < CouchDBRecord(make_record()).size, "")
+
+
+class CouchDBRecordBufferTest(unittest.TestCase):
+
+    def make_buffer(self, records=2, **kwargs):
+        return CouchDBRecordBuffer(max_bytes=records * snapshot().size, **kwargs)
+
+    def messages(self, buffer):
+        result = []
+        while buffer.qsize():
+            result.append(buffer.get().message)
+        return result
+
+    def test_invalid_overflow(self):
+        self.assertRaises(ValueError, CouchDBRecordBuffer, overflow='drop_random')
+
+    def test_put_get(self):
+        buffer = self.make_buffer()
+        self.assertTrue(buffer.put(snapshot('a')), "")
+        self.assertEqual(buffer.bytes, snapshot().size, "")
+        self.assertEqual(buffer.get().message, 'a', "")
+        self.assertEqual((buffer.bytes, buffer.records), (0, 0), "")
+        self.assertRaises(queue.Empty, buffer.get, timeout=0.01)
+        self.assertRaises(queue.Empty, buffer.get, block=False)
+
+    def test_record_bigger_than_budget(self):
+        buffer = CouchDBRecordBuffer(max_bytes=1)
+        self.assertTrue(buffer.put(snapshot()), "an empty buffer takes any record")
+        self.assertFalse(buffer.put(snapshot()), "")
+
+    def test_max_records(self):
+        buffer = CouchDBRecordBuffer(max_records=1)
+        buffer.put(snapshot('a'))
+        buffer.put(snapshot('b'))
+        self.assertEqual(self.messages(buffer), ['a'], "")
+
+    def test_markers_are_never_dropped(self):
+        buffer = self.make_buffer(records=1)
+        buffer.put(snapshot())
+        marker = _Flush()
+        self.assertTrue(buffer.put(marker), "")
+        self.assertEqual(buffer.qsize(), 2, "")
+
+    def test_drop_newest(self):
+        buffer = self.make_buffer()
+        for message in 'abc':
+            buffer.put(snapshot(message))
+        self.assertEqual(self.messages(buffer), ['a', 'b'], "")
+        self.assertEqual(buffer.dropped_newest, 1, "")
+
+    def test_drop_oldest(self):
+        buffer = self.make_buffer(overflow='drop_oldest')
+        buffer.put(_Flush())
+        for message in 'abcd':
+            buffer.put(snapshot(message))
+        self.assertTrue(isinstance(buffer.get(), _Flush), "")
+        self.assertEqual(self.messages(buffer), ['c', 'd'], "")
+        self.assertEqual(buffer.dropped_oldest, 2, "")
+
+    def test_drop_level(self):
+        buffer = CouchDBRecordBuffer(max_records=3, overflow='drop_level', level=logging.WARNING)
+        buffer.put(snapshot('error', logging.ERROR))
+        buffer.put(snapshot('info', logging.INFO))
+        buffer.put(snapshot('warning', logging.WARNING))
+        buffer.put(snapshot('critical', logging.CRITICAL))
+        buffer.put(snapshot('debug', logging.DEBUG))
+        self.assertEqual(buffer.dropped_level, 2, "")
+
+        buffer.put(snapshot('error 2', logging.ERROR))
+        self.assertEqual(buffer.dropped_oldest, 1, "")
+        self.assertEqual(self.messages(buffer), ['warning', 'critical', 'error 2'], "")
+
+    def test_block_timeout(self):
+        buffer = self.make_buffer(records=1, overflow='block', timeout=0.01)
+        buffer.put(snapshot('a'))
+        self.assertFalse(buffer.put(snapshot('b')), "")
+        self.assertEqual(buffer.dropped_newest, 1, "")
+
+    def test_block_until_room(self):
+        buffer = self.make_buffer(records=1, overflow='block', timeout=5)
+        buffer.put(snapshot('a'))
+        threading.Timer(0.05, buffer.get).start()
+        self.assertTrue(buffer.put(snapshot('b')), "")
+        self.assertEqual(self.messages(buffer), ['b'], "")
+
+
+class CouchDBBulkLogHandlerBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        self.post = patch.object(CouchDBSession, 'post').start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_emit_queues_snapshot(self):
+        handler = CouchDBBulkLogHandler(flush_interval=60, fields=['message', 'custom'])
+        handler.flush()
+        with patch.object(handler.queue, 'put') as put:
+            handler.emit(make_record(custom='value'))
+        snap = put.call_args[0][0]
+        self.assertTrue(isinstance(snap, CouchDBRecord), "")
+        self.assertEqual(snap.custom, 'value', "")
+        handler.close()
+
+    def test_emit_captures_document_attributes(self):
+        handler = CouchDBBulkLogHandler(flush_interval=60, fields=['message', 'lineno'], capture_exceptions=False)
+        handler.flush()
+        with patch.object(handler.queue, 'put') as put:
+            handler.emit(make_record(lineno=42))
+            handler.new_format(lambda record: json.dumps({'path': record.pathname}))
+            handler.emit(make_record(pathname='app.py'))
+        fields, formatted = [call[0][0] for call in put.call_args_list]
+        self.assertEqual(fields.CAPTURED, ('name', 'levelno', 'lineno', 'created'), "")
+        self.assertEqual(formatted.CAPTURED, CouchDBRecord.ATTRIBUTES, "any attribute of a format function")
+        handler.close()
+
+    def test_shipped_documents(self):
+        handler = CouchDBBulkLogHandler(flush_interval=60, fields=['message', 'custom'],
+                                        id_generator=False)
+        handler.emit(make_record(custom='value'))
+        handler.close()
+        self.assertEqual(json.loads(self.post.call_args[1]['data'])['docs'],
+                         [{'message': 'log to couchdb', 'custom': 'value'}], "")
+
+    def test_dropped(self):
+        handler = CouchDBBulkLogHandler(flush_interval=60, buffer_bytes=1, overflow='drop_newest')
+        shipping, stop = threading.Event(), threading.Event()
+
+        def ship(docs):
+            shipping.set()
+            stop.wait(5)
+        with patch.object(handler, '_ship', side_effect=ship):
+            # keep the worker busy so the records stay in the buffer
+            handler.queue.put(_Flush())
+            shipping.wait(5)
+            for _ in range(3):
+                handler.emit(make_record())
+            stop.set()
+        self.assertEqual(handler.dropped, dict(newest=2, oldest=0, level=0), "")
+        handler.close()
+
+if __name__ == '__main__':
+    unittest.main()
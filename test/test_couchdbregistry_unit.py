@@ -0,0 +1,135 @@
+'''
+    File: test_couchdbregistry_unit.py
+    Description: Tests - CouchDBWriterRegistry, CouchDBSharedLogHandler
+'''
+from mock import Mock, patch
+import unittest
+import json
+import threading
+import time
+
+
+import sys, os
+sys.path.insert(0, os.path.abspath("../src"))
+
+from couchdblogger import (CouchDBWriterRegistry, CouchDBSharedLogHandler, CouchDBBulkLogHandler,
+                           CouchDBSession, logging)
+from logrecords import make_record
+
+
+class CouchDBWriterRegistryTest(unittest.TestCase):
+
+    def test_key(self):
+        key = CouchDBWriterRegistry.key
+        self.assertEqual(key(), ('http', ('localhost:5984',), 'logs', None, None), "")
+        self.assertEqual(key(host='LocalHost:5984'), key(), "")
+        self.assertEqual(key(host=('localhost', 5984)), key(), "")
+        self.assertEqual(key(batch_size=10, compress=True), key(), "other arguments ignored")
+        self.assertNotEqual(key(ssl=True), key(), "")
+        self.assertNotEqual(key(database='audit'), key(), "")
+        self.assertNotEqual(key(username='user', password='secret'), key(), "")
+        self.assertEqual(key(nodes=['a', 'b:5985'])[1], ('a:5984', 'b:5985'), "")
+
+
+class CouchDBSharedLogHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.post = patch.object(CouchDBSession, 'post').start()
+        self.login = patch.object(CouchDBSession, 'login').start()
+        self.registry = CouchDBWriterRegistry()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def make_handler(self, **kwargs):
+        kwargs.setdefault('flush_interval', 60)
+        return CouchDBSharedLogHandler(registry=self.registry, username='user', password='secret', **kwargs)
+
+    def test_one_writer(self):
+        first, second = self.make_handler(), self.make_handler(batch_size=1)
+        self.assertTrue(first.writer is second.writer, "")
+        self.assertTrue(isinstance(first.writer, CouchDBBulkLogHandler), "")
+        self.assertEqual(first.writer.batch_size, 500, "arguments of the first handler")
+        self.assertEqual(self.login.call_count, 1, "one login")
+        first.handle(make_record('first', name='app'))
+        second.handle(make_record('second', name='app.db'))
+        first.flush()
+        self.assertEqual(self.post.call_count, 1, "one batch")
+        docs = json.loads(self.post.call_args[1]['data'])['docs']
+        self.assertEqual([doc['message'] for doc in docs], ['first', 'second'], "")
+        self.assertEqual(first.metrics.snapshot()['emitted'], 2, "")
+        first.close()
+        second.close()
+
+    def test_other_database(self):
+        first, second = self.make_handler(), self.make_handler(database='audit')
+        self.assertFalse(first.writer is second.writer, "")
+        self.assertEqual(len(self.registry.writers()), 2, "")
+        first.close()
+        second.close()
+
+    def test_last_close(self):
+        first, second = self.make_handler(), self.make_handler()
+        writer = first.writer
+        writer.close = Mock(side_effect=writer.close)
+        first.handle(make_record())
+        first.close()
+        first.close()
+        self.assertFalse(writer.close.called, "")
+        self.assertEqual(list(self.registry.writers().values()), [(writer, 1)], "closed once")
+        second.close()
+        self.assertTrue(writer.close.called, "")
+        self.assertEqual(self.post.call_count, 1, "queue shipped")
+        self.assertEqual(self.registry.writers(), {}, "")
+        third = self.make_handler()
+        self.assertFalse(third.writer is writer, "new writer")
+        third.close()
+
+    def test_loggers(self):
+        handler, quiet = self.make_handler(), self.make_handler()
+        quiet.setLevel(logging.WARNING)
+        for name, each in (('test.registry.app', handler), ('test.registry.db', quiet)):
+            logger = logging.getLogger(name)
+            logger.propagate = False
+            logger.setLevel(logging.DEBUG)
+            logger.addHandler(each)
+            self.addCleanup(logger.removeHandler, each)
+            logger.warning('warning of %s', name)
+            logger.info('info of %s', name)
+        handler.close()
+        quiet.close()
+        docs = json.loads(self.post.call_args[1]['data'])['docs']
+        self.assertEqual([doc['message'] for doc in docs],
+                         ['warning of test.registry.app', 'info of test.registry.app',
+                          'warning of test.registry.db'], "level of each handler")
+
+    def test_forked_child(self):
+        handlers = [self.make_handler() for _ in range(4)]
+        writer = handlers[0].writer
+        after_fork = writer._after_fork
+
+        def slow_after_fork():
+            time.sleep(0.05)
+            after_fork()
+        writer._after_fork = Mock(side_effect=slow_after_fork)
+        writer._pid = -1
+        threads = [threading.Thread(target=handler.handle, args=(make_record(),)) for handler in handlers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(writer._after_fork.call_count, 1, "")
+        for handler in handlers:
+            handler.close()
+        self.assertEqual(len(json.loads(self.post.call_args[1]['data'])['docs']), 4, "no record lost")
+
+    def test_process_registry(self):
+        handler = CouchDBSharedLogHandler(flush_interval=60)
+        other = CouchDBSharedLogHandler(flush_interval=60)
+        self.assertTrue(handler.writer is other.writer, "")
+        handler.close()
+        other.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
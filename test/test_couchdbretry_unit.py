@@ -0,0 +1,222 @@
+'''
+    File: test_couchdbretry_unit.py
+    Description: Tests - CouchDBRetry, CouchDBCircuitBreaker, partial failures of _bulk_docs
+'''
+from mock import Mock, patch
+import unittest
+import json
+import shutil
+import tempfile
+
+
+import sys, os
+sys.path.insert(0, os.path.abspath("../src"))
+
+from couchdblogger import (CouchDBRetry, CouchDBCircuitBreaker, CouchDBLogHandler, CouchDBBulkLogHandler,
+                           CouchDBSession, logging, requests)
+from logrecords import make_record
+
+
+def response(results):
+    resp = Mock()
+    resp.json.return_value = results
+    return resp
+
+
+class CouchDBRetryTest(unittest.TestCase):
+
+    def test_backoff(self):
+        retry = CouchDBRetry(attempts=5, backoff=1.0, max_backoff=5.0, jitter=0)
+        self.assertEqual(list(retry.delays()), [1.0, 2.0, 4.0, 5.0], "")
+
+    def test_jitter(self):
+        retry = CouchDBRetry(attempts=3, backoff=1.0, jitter=0.5)
+        with patch('random.random', return_value=1.0):
+            self.assertEqual(list(retry.delays()), [0.5, 1.0], "")
+        with patch('random.random', return_value=0.0):
+            self.assertEqual(list(retry.delays()), [1.0, 2.0], "")
+
+    def test_once(self):
+        self.assertEqual(list(CouchDBRetry(attempts=1).delays()), [], "")
+
+    def test_transient(self):
+        self.assertTrue(CouchDBRetry.transient(requests.ConnectionError()), "")
+        self.assertTrue(CouchDBRetry.transient(CouchDBSession.CouchDBException('', 503)), "")
+        self.assertTrue(CouchDBRetry.transient(CouchDBSession.CouchDBException('', 429)), "")
+        self.assertFalse(CouchDBRetry.transient(CouchDBSession.CouchDBException('', 400)), "")
+        self.assertFalse(CouchDBRetry.transient(ValueError()), "")
+
+
+class CouchDBCircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patch('time.time', lambda: self.now).start()
+        self.breaker = CouchDBCircuitBreaker(threshold=3, reset_timeout=10.0)
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_opens(self):
+        for _ in range(2):
+            self.breaker.failure()
+        self.assertTrue(self.breaker.allow(), "")
+        self.breaker.success()
+        for _ in range(2):
+            self.breaker.failure()
+        self.assertTrue(self.breaker.allow(), "failures in a row only")
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, 'open', "")
+        self.assertFalse(self.breaker.allow(), "")
+
+    def test_half_open(self):
+        for _ in range(3):
+            self.breaker.failure()
+        self.now += 10.0
+        self.assertTrue(self.breaker.allow(), "probe")
+        self.assertEqual(self.breaker.state, 'half_open', "")
+        self.assertFalse(self.breaker.allow(), "one probe at a time")
+        self.breaker.success()
+        self.assertEqual(self.breaker.state, 'closed', "")
+        self.assertTrue(self.breaker.allow(), "")
+
+    def test_probe_fails(self):
+        for _ in range(3):
+            self.breaker.failure()
+        self.now += 10.0
+        self.breaker.allow()
+        self.breaker.failure()
+        self.assertEqual((self.breaker.state, self.breaker.opened), ('open', 2), "")
+        self.now += 5.0
+        self.assertFalse(self.breaker.allow(), "open for reset_timeout again")
+
+
+class CouchDBHandlerRetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.post = patch.object(CouchDBSession, 'post').start()
+        self.sleep = patch('time.sleep').start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def make_handler(self, handler_class=CouchDBLogHandler, **kwargs):
+        handler = handler_class(**kwargs)
+        handler.handleError = Mock()
+        return handler
+
+    def test_emit_retried(self):
+        self.post.side_effect = [requests.ConnectionError(), CouchDBSession.CouchDBException('', 503), Mock()]
+        handler = self.make_handler(retry=3)
+        handler.emit(make_record())
+        self.assertEqual(self.post.call_count, 3, "")
+        self.assertEqual(self.sleep.call_count, 2, "")
+        self.assertFalse(handler.handleError.called, "")
+        first, last = [json.loads(call[1]['data']) for call in (self.post.call_args_list[0],
+                                                                self.post.call_args_list[-1])]
+        self.assertEqual(first['_id'], last['_id'], "same document")
+
+    def test_emit_retries_exhausted(self):
+        self.post.side_effect = requests.ConnectionError()
+        handler = self.make_handler(retry=CouchDBRetry(attempts=2))
+        handler.emit(make_record())
+        self.assertEqual(self.post.call_count, 2, "")
+        self.assertTrue(handler.handleError.called, "")
+
+    def test_rejected_not_retried(self):
+        self.post.side_effect = CouchDBSession.CouchDBException('{"error":"forbidden"}', 403)
+        handler = self.make_handler(retry=3)
+        handler.emit(make_record())
+        self.assertEqual(self.post.call_count, 1, "")
+        self.assertTrue(handler.handleError.called, "")
+
+    def test_bulk_resends_failed_documents(self):
+        handler = self.make_handler(CouchDBBulkLogHandler, flush_interval=60, retry=3)
+        self.post.side_effect = [
+            response([{'id': 'a', 'rev': '1-a'}, {'id': 'b', 'error': 'unknown_error'},
+                      {'id': 'c', 'error': 'conflict'}, {'id': 'd', 'error': 'forbidden'}]),
+            response([{'id': 'b', 'rev': '1-b'}]),
+        ]
+        for i in range(4):
+            handler.emit(make_record('record %d' % i))
+        handler.close()
+        batches = [json.loads(call[1]['data'])['docs'] for call in self.post.call_args_list]
+        self.assertEqual([doc['message'] for doc in batches[1]], ['record 1'], "")
+        self.assertEqual(handler.handleError.call_count, 1, "forbidden reported")
+        self.assertEqual(handler.metrics.snapshot()['failed'], 1, "")
+
+    def test_bulk_partial_failure_exhausted(self):
+        handler = self.make_handler(CouchDBBulkLogHandler, flush_interval=60, retry=2)
+        self.post.side_effect = [response([{'id': 'a', 'rev': '1-a'}, {'id': 'b', 'error': 'unknown_error'}]),
+                                 response([{'id': 'b', 'error': 'unknown_error'}])]
+        for i in range(2):
+            handler.emit(make_record('record %d' % i))
+        handler.close()
+        self.assertEqual(self.post.call_count, 2, "")
+        record = handler.handleError.call_args[0][0]
+        self.assertEqual(record.getMessage(), 'CouchDB rejected 1 of 2 records to logs: unknown_error', "")
+
+    def test_bulk_partial_failure_spooled(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        handler = self.make_handler(CouchDBBulkLogHandler, flush_interval=60, spool=directory,
+                                    spool_retry_interval=60)
+        self.post.return_value = response([{'id': 'a', 'rev': '1-a'}, {'id': 'b', 'error': 'unknown_error'}])
+        for i in range(2):
+            handler.emit(make_record('record %d' % i))
+        handler.flush()
+        self.assertEqual(handler.spool.pending(), True, "")
+        self.assertEqual(handler.metrics.snapshot()['spooled'], 1, "")
+        handler.close()
+
+
+class CouchDBHandlerCircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.post = patch.object(CouchDBSession, 'post').start()
+        self.post.side_effect = requests.ConnectionError()
+        self.now = 1000.0
+        patch('time.time', lambda: self.now).start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_fails_fast(self):
+        handler = CouchDBLogHandler(circuit_breaker=CouchDBCircuitBreaker(threshold=2, reset_timeout=30))
+        handler.handleError = Mock()
+        for _ in range(5):
+            handler.emit(make_record())
+        self.assertEqual(self.post.call_count, 2, "")
+        self.assertEqual(handler.handleError.call_count, 2, "")
+        snapshot = handler.metrics.snapshot()
+        self.assertEqual((snapshot['dropped'], snapshot['circuit_open']), (3, 1), "")
+
+        self.now += 30
+        self.post.side_effect = None
+        handler.emit(make_record())
+        handler.emit(make_record())
+        self.assertEqual(self.post.call_count, 4, "probe, then closed")
+        self.assertEqual(handler.metrics.snapshot()['circuit_open'], 0, "")
+
+    def test_opened_during_retries(self):
+        handler = CouchDBLogHandler(retry=CouchDBRetry(attempts=10, backoff=0), circuit_breaker=3)
+        handler.handleError = Mock()
+        with patch('time.sleep'):
+            handler.emit(make_record())
+        self.assertEqual(self.post.call_count, 3, "")
+        self.assertEqual(handler.metrics.snapshot()['dropped'], 1, "")
+
+    def test_spooled_while_open(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        handler = CouchDBLogHandler(circuit_breaker=1, spool=directory, spool_retry_interval=60)
+        handler.emit(make_record())
+        handler.spool.pending = Mock(return_value=False)
+        handler.emit(make_record())
+        self.assertEqual(self.post.call_count, 1, "")
+        self.assertEqual(handler.metrics.snapshot()['spooled'], 2, "")
+        handler.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
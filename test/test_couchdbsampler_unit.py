@@ -0,0 +1,145 @@
+'''
+    File: test_couchdbsampler_unit.py
+    Description: Tests - CouchDBSampler, sampling of the handlers
+'''
+from mock import Mock, patch
+import unittest
+import itertools
+import json
+
+
+import sys, os
+sys.path.insert(0, os.path.abspath("../src"))
+
+from couchdblogger import CouchDBSampler, CouchDBLogHandler, CouchDBBulkLogHandler, CouchDBSession, logging
+from logrecords import make_record
+
+
+class CouchDBSamplerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patch('time.time', lambda: self.now).start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def sample(self, sampler, count, **kwargs):
+        return [sampler.sample(make_record(**kwargs)) for _ in range(count)]
+
+    def test_rate(self):
+        sampler = CouchDBSampler(rate=2)
+        self.assertEqual(self.sample(sampler, 4), [1, 1, None, None], "burst of rate records")
+        self.now += 1.0
+        self.assertEqual(self.sample(sampler, 3), [3, 1, None], "weight of the dropped records")
+        self.assertEqual(sampler.sampled, 3, "")
+
+    def test_sum_of_weights(self):
+        sampler = CouchDBSampler(rate=10, burst=5)
+        weights = []
+        for _ in range(100):
+            weights.extend(self.sample(sampler, 10))
+            self.now += 0.1
+        kept = [weight for weight in weights if weight is not None]
+        self.assertTrue(len(kept) < 200, "")
+        self.assertTrue(sum(kept) > 990, "estimates the 1000 records")
+
+    def test_buckets(self):
+        sampler = CouchDBSampler(rate=1)
+        self.assertEqual(self.sample(sampler, 2, name='a'), [1, None], "")
+        self.assertEqual(self.sample(sampler, 1, name='b'), [1], "one bucket per logger")
+        self.assertEqual(self.sample(sampler, 1, name='a', level=logging.DEBUG), [1], "and per level")
+
+    def test_warnings_kept(self):
+        sampler = CouchDBSampler(rate=1)
+        self.assertEqual(self.sample(sampler, 5, level=logging.WARNING), [1] * 5, "")
+        self.assertEqual(self.sample(sampler, 5, level=logging.CRITICAL), [1] * 5, "")
+
+    def test_rates(self):
+        sampler = CouchDBSampler(rate=1, rates={'audit': None, 'db': 3, ('web', 'DEBUG'): 2})
+        self.assertEqual(self.sample(sampler, 5, name='audit'), [1] * 5, "never dropped")
+        self.assertEqual(self.sample(sampler, 4, name='db').count(None), 1, "")
+        self.assertEqual(self.sample(sampler, 3, name='web', level=logging.DEBUG).count(None), 1, "")
+        self.assertEqual(self.sample(sampler, 2, name='web').count(None), 1, "")
+
+    def test_adapt(self):
+        sampler = CouchDBSampler(rate=100, latency_target=0.5, queue_target=0.5, min_factor=0.05)
+        sampler.adapt(0.1, 0.1)
+        self.assertEqual(sampler.factor, 1.0, "")
+        sampler.adapt(2.0, 0.1)
+        self.assertEqual(sampler.factor, 0.25, "")
+        sampler.adapt(0.0, 0.75)
+        self.assertAlmostEqual(sampler.factor, 2 / 3.0)
+        sampler.adapt(100.0, 1.0)
+        self.assertEqual(sampler.factor, 0.05, "")
+
+    def test_load_under_pressure(self):
+        sampler = CouchDBSampler(rate=100, latency_target=0.5, adapt_interval=1.0)
+        load = Mock(return_value=(5.0, 0.0))
+        kept = [sampler.sample(make_record(), load) for _ in range(100)]
+        self.assertEqual(len([weight for weight in kept if weight]), 10, "burst lowered with the rate")
+        self.assertEqual(load.call_count, 1, "read once per adapt_interval")
+        self.now += 1.0
+        sampler.sample(make_record(), load)
+        self.assertEqual(load.call_count, 2, "")
+
+    def test_max_keys(self):
+        sampler = CouchDBSampler(rate=1, max_keys=2)
+        for name in ('a', 'b', 'c'):
+            self.sample(sampler, 1, name=name)
+        self.assertEqual(len(sampler._buckets), 2, "")
+
+
+class CouchDBHandlerSamplingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.post = patch.object(CouchDBSession, 'post').start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_emit(self):
+        handler = CouchDBLogHandler(sample=1)
+        handler.emit(make_record())
+        handler.emit(make_record())
+        handler.emit(make_record(level=logging.ERROR))
+        docs = [json.loads(call[1]['data']) for call in self.post.call_args_list]
+        self.assertEqual([(doc['level'], doc['sample_weight']) for doc in docs],
+                         [('INFO', 1), ('ERROR', 1)], "")
+        snapshot = handler.metrics.snapshot()
+        self.assertEqual((snapshot['sampled'], snapshot['sample_factor']), (1, 1.0), "")
+
+    def test_not_sampled(self):
+        handler = CouchDBLogHandler()
+        handler.emit(make_record())
+        self.assertFalse('sample_weight' in json.loads(self.post.call_args[1]['data']), "")
+
+    def test_bulk(self):
+        handler = CouchDBBulkLogHandler(flush_interval=60, sample=CouchDBSampler(rate=2, burst=2),
+                                        deduplicate=60)
+        for i in range(5):
+            handler.emit(make_record('record %d' % i))
+        handler.close()
+        docs = json.loads(self.post.call_args[1]['data'])['docs']
+        self.assertEqual([(doc['message'], doc['sample_weight']) for doc in docs],
+                         [('record 0', 1), ('record 1', 1)], "")
+        self.assertEqual(handler.metrics.snapshot()['sampled'], 3, "")
+
+    def test_bulk_load(self):
+        handler = CouchDBBulkLogHandler(flush_interval=60, buffer_bytes=10000, queue_size=10)
+        handler.queue.bytes, handler.queue.records = 2000, 1
+        self.assertEqual(handler._load(), (0.0, 0.2), "")
+        handler.queue.records = 5
+        self.assertEqual(handler._load(), (0.0, 0.5), "")
+        handler.queue.bytes = handler.queue.records = 0
+        handler.close()
+
+    def test_latency(self):
+        handler = CouchDBLogHandler(sample=10)
+        with patch('time.time', Mock(side_effect=itertools.count())):
+            handler._post('', lambda: '{}', {})
+        self.assertEqual(handler._load(), (0.2, 0.0), "")
+
+
+if __name__ == '__main__':
+    unittest.main()
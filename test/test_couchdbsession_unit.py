@@ -5,6 +5,8 @@
 '''
 from mock import Mock, patch
 import unittest
+import threading
+import time
 
 import os, sys
 sys.path.insert(0, os.path.abspath("../src"))
@@ -97,5 +99,111 @@ class CouchDBSessionTest(unittest.TestCase):
             self.assertEqual(requests_mock.call_args[1]['data']['password'], 'password', "")
             self.assertEqual(len(requests_mock.call_args_list), 1, "")
 
+
+def make_response(status_code, cookie=None):
+    resp = Mock()
+    resp.status_code = status_code
+    resp.headers = {'Set-Cookie': cookie} if cookie else {}
+    return resp
+
+
+class CouchDBSessionLoginTest(unittest.TestCase):
+
+    def setUp(self):
+        self.couchdb_session = CouchDBSession(session_timeout=600)
+        self.request = patch('requests.Session.request').start()
+        self.request.return_value = make_response(200)
+        self.couchdb_session.login('http://localhost:5984', 'user', 'secret')
+
+    def tearDown(self):
+        patch.stopall()
+
+    def urls(self):
+        return [call[0][1] for call in self.request.call_args_list]
+
+    def test_pool_settings(self):
+        session = CouchDBSession(pool_connections=2, pool_maxsize=50)
+        adapter = session.get_adapter('http://localhost:5984')
+        self.assertEqual(adapter._pool_maxsize, 50, "")
+        self.assertEqual(adapter._pool_connections, 2, "")
+        self.assertEqual(session.clone().pool_maxsize, 50, "")
+
+    def test_login(self):
+        self.assertEqual(self.urls(), ['http://localhost:5984/_session'], "")
+        self.assertEqual(self.request.call_args[1]['data'], {'name': 'user', 'password': 'secret'}, "")
+
+    def test_401_renews_and_replays_once(self):
+        self.request.side_effect = [make_response(401), make_response(200), make_response(201)]
+        resp = self.couchdb_session.post('http://localhost:5984/logs', data='{}')
+        self.assertEqual(resp.status_code, 201, "")
+        self.assertEqual(self.urls()[1:], ['http://localhost:5984/logs', 'http://localhost:5984/_session',
+                                           'http://localhost:5984/logs'], "")
+
+    def test_401_twice_raises(self):
+        self.request.side_effect = [make_response(401), make_response(200), make_response(401)]
+        self.assertRaises(CouchDBSession.CouchDBException,
+                          self.couchdb_session.post, 'http://localhost:5984/logs', data='{}')
+        self.assertEqual(len(self.urls()), 4, "")
+
+    def test_401_streamed_body_is_not_replayed(self):
+        self.request.side_effect = [make_response(401), make_response(200)]
+        self.assertRaises(CouchDBSession.CouchDBException,
+                          self.couchdb_session.post, 'http://localhost:5984/logs', data=iter([b'{}']))
+        self.assertEqual(self.urls()[1:], ['http://localhost:5984/logs', 'http://localhost:5984/_session'], "")
+
+    def test_401_post_body_replays_streamed_body(self):
+        self.request.side_effect = [make_response(401), make_response(200), make_response(201)]
+        bodies = []
+
+        def body():
+            bodies.append(iter([b'{}']))
+            return bodies[-1]
+        resp = self.couchdb_session.post_body('http://localhost:5984/logs', body)
+        self.assertEqual(resp.status_code, 201, "")
+        self.assertEqual(len(bodies), 2, "")
+        self.assertTrue(self.request.call_args[1]['data'] is bodies[1], "a new stream")
+        self.assertEqual(self.urls()[1:], ['http://localhost:5984/logs', 'http://localhost:5984/_session',
+                                           'http://localhost:5984/logs'], "")
+
+    def test_401_post_body_replays_once(self):
+        self.request.side_effect = [make_response(401), make_response(200), make_response(401)]
+        self.assertRaises(CouchDBSession.CouchDBException,
+                          self.couchdb_session.post_body, 'http://localhost:5984/logs', lambda: '{}')
+        self.assertEqual(len(self.urls()), 4, "replayed by request only")
+
+    def test_renew_before_expiry(self):
+        self.couchdb_session._login_time -= 550
+        self.couchdb_session.post('http://localhost:5984/logs', data='{}')
+        self.assertEqual(self.urls()[1:], ['http://localhost:5984/_session', 'http://localhost:5984/logs'], "")
+
+    def test_refreshed_cookie(self):
+        self.couchdb_session._login_time -= 500
+        self.request.return_value = make_response(200, 'AuthSession=abc; Version=1; Path=/')
+        self.couchdb_session.post('http://localhost:5984/logs', data='{}')
+        self.assertTrue(time.time() - self.couchdb_session._login_time < 10, "")
+        self.couchdb_session._login_time -= 100
+        self.couchdb_session.post('http://localhost:5984/logs', data='{}')
+        self.assertFalse('http://localhost:5984/_session' in self.urls()[1:], "")
+
+    def test_single_flight(self):
+        renewals = []
+
+        def request(method, url, **kwargs):
+            if url.endswith('/_session'):
+                time.sleep(0.05)  # let the other threads get their 401
+                renewals.append(url)
+                return make_response(200)
+            return make_response(201 if renewals else 401)
+        self.request.side_effect = request
+
+        threads = [threading.Thread(target=self.couchdb_session.post,
+                                    args=('http://localhost:5984/logs',), kwargs={'data': '{}'})
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(renewals), 1, "one thread logs in, the others wait for it")
+
 if __name__ == '__main__':
     unittest.TextTestRunner(verbosity=2).run(unittest.TestLoader().loadTestsFromTestCase(CouchDBSessionTest))
@@ -0,0 +1,195 @@
+'''
+    File: test_couchdbshipper_unit.py
+    Description: Tests - CouchDBShipper, CouchDBShipperHandler
+'''
+from mock import Mock, patch
+import unittest
+import functools
+import shutil
+import tempfile
+import threading
+import json
+import time
+
+
+import sys, os
+sys.path.insert(0, os.path.abspath("../src"))
+
+from couchdblogger import CouchDBShipper, CouchDBShipperHandler, CouchDBBulkLogHandler, CouchDBLogHandler, CouchDBSession, logging, _Flush
+from logrecords import make_record as make_log_record
+
+
+make_record = functools.partial(make_log_record, message='log to %s', args=('couchdb',))
+
+
+class CouchDBShipperHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = CouchDBShipperHandler('/nonexistent/shipper.sock')
+
+    def test_serialize(self):
+        record = make_record()
+        data = json.loads(self.handler.serialize(record).decode('utf-8'))
+        self.assertEqual(data['msg'], 'log to couchdb', "")
+        self.assertEqual(data['name'], 'process_name', "")
+        self.assertEqual(data['created'], record.created, "")
+        self.assertTrue('args' not in data, "")
+
+        rebuilt = logging.makeLogRecord(data)
+        couchdb_handler = CouchDBLogHandler()
+        self.assertEqual(json.loads(couchdb_handler.format(rebuilt)),
+                         json.loads(couchdb_handler.format(record)), "")
+
+    def test_serialize_exception(self):
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            record = logging.makeLogRecord(dict(msg='failed', exc_info=sys.exc_info()))
+        data = json.loads(self.handler.serialize(record).decode('utf-8'))
+        self.assertTrue('ValueError: boom' in data['exc_text'], "")
+
+    def test_serialize_stack_and_attributes(self):
+        handler = CouchDBShipperHandler('/nonexistent/shipper.sock', attributes=['request_id', 'user'])
+        record = make_record()
+        record.stack_info = 'Stack (most recent call last):'
+        record.request_id, record.user = 'r-1', object()
+        rebuilt = logging.makeLogRecord(json.loads(handler.serialize(record).decode('utf-8')))
+        self.assertEqual((rebuilt.stack_info, rebuilt.request_id), ('Stack (most recent call last):', 'r-1'), "")
+        self.assertTrue(rebuilt.user.startswith('<object'), "")
+
+        couchdb_handler = CouchDBLogHandler(fields=['message', 'request_id'])
+        self.assertEqual(json.loads(couchdb_handler._documents(rebuilt)[-1])['stack'],
+                         'Stack (most recent call last):', "")
+        self.assertEqual(json.loads(couchdb_handler.format(rebuilt))['request_id'], 'r-1', "")
+
+    def test_emit_shipper_down(self):
+        self.handler.handleError = Mock()
+        record = make_record()
+        self.handler.emit(record)
+        self.handler.handleError.assert_called_with(record)
+        self.assertTrue(self.handler._socket is None, "")
+
+    @patch('socket.socket')
+    def test_emit_after_fork_reconnects(self, socket_class):
+        self.handler.emit(make_record())
+        inherited = self.handler._socket
+        self.handler._pid = -1
+        self.handler.emit(make_record())
+
+        self.assertTrue(inherited.close.called, "")
+        self.assertEqual(socket_class.call_count, 2, "")
+        self.assertEqual(self.handler._pid, os.getpid(), "")
+
+
+class CouchDBShipperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.address = os.path.join(self.directory, 'shipper.sock')
+        self.post = patch.object(CouchDBSession, 'post').start()
+
+    def tearDown(self):
+        patch.stopall()
+        shutil.rmtree(self.directory)
+
+    def test_ship_records_of_many_clients(self):
+        shipper = CouchDBShipper(self.address, flush_interval=60)
+        ready = threading.Event()
+        thread = threading.Thread(target=shipper.serve_forever, args=(ready,))
+        thread.start()
+        ready.wait(5)
+
+        clients = [CouchDBShipperHandler(self.address) for _ in range(3)]
+        for i, client in enumerate(clients):
+            client.emit(make_record(message='worker %d', args=(i,)))
+            client.close()
+        for _ in range(100):
+            if shipper.server.handler.queue.qsize() == 3:
+                break
+            time.sleep(0.01)
+        shipper.server.shutdown()
+        thread.join(5)
+
+        self.assertEqual(self.post.call_count, 1, "one session, one batch for all clients")
+        self.assertEqual(self.post.call_args[0][0], 'http://localhost:5984/logs/_bulk_docs', "")
+        docs = json.loads(self.post.call_args[1]['data'])['docs']
+        self.assertEqual(sorted(doc['message'] for doc in docs), ['worker 0', 'worker 1', 'worker 2'], "")
+        self.assertFalse(os.path.exists(self.address), "")
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "needs fork")
+    def test_start_stop(self):
+        shipper = CouchDBShipper(self.address)
+        shipper.start()
+        self.assertTrue(os.path.exists(self.address), "")
+        shipper.stop()
+        self.assertFalse(shipper.process.is_alive(), "")
+        self.assertFalse(os.path.exists(self.address), "")
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "needs fork")
+    def test_start_exited(self):
+        shipper = CouchDBShipper(os.path.join(self.address, 'missing', 'shipper.sock'))
+        self.assertRaises(RuntimeError, shipper.start, 5)
+        self.assertFalse(shipper.process.is_alive(), "")
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "needs fork")
+    @patch.object(CouchDBShipper, 'serve_forever', lambda self, ready: time.sleep(10))
+    def test_start_timeout(self):
+        shipper = CouchDBShipper(self.address)
+        start = time.time()
+        self.assertRaises(RuntimeError, shipper.start, 0.2)
+        self.assertTrue(time.time() - start < 5, "")
+        self.assertFalse(shipper.process.is_alive(), "")
+
+
+class CouchDBLogHandlerForkTest(unittest.TestCase):
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_emit_after_fork_new_session(self):
+        post = patch.object(CouchDBSession, 'post').start()
+        handler = CouchDBLogHandler(username='user', password='secret')
+        inherited = handler.session
+        handler._pid = -1
+        handler.emit(make_record())
+
+        self.assertFalse(handler.session is inherited, "")
+        self.assertEqual(post.call_args_list[-2][0][0], 'http://localhost:5984/_session', "")
+        self.assertEqual(post.call_args_list[-1][0][0], 'http://localhost:5984/logs', "")
+
+    def test_bulk_emit_after_fork_new_worker(self):
+        patch.object(CouchDBSession, 'post').start()
+        handler = CouchDBBulkLogHandler()
+        inherited_queue, inherited_thread = handler.queue, handler._thread
+        handler._pid = -1
+        handler.emit(make_record())
+
+        self.assertFalse(handler.queue is inherited_queue, "")
+        self.assertFalse(handler._thread is inherited_thread, "")
+        self.assertEqual(handler.queue.qsize(), 1, "")
+        handler.close()
+        inherited_queue.put(_Flush(stop=True))
+
+    def test_bulk_emit_after_fork_new_locks(self):
+        patch.object(CouchDBSession, 'post').start()
+        handler = CouchDBBulkLogHandler(sample=100, circuit_breaker=3, deduplicate=1.0)
+        inherited_queue = handler.queue
+        owners = (handler.id_generator, handler.metrics, handler.payloads, handler.sampler,
+                  handler.circuit_breaker, handler.deduplicator)
+        locks = [owner._lock for owner in owners] + [handler._databases_lock]
+        for lock in locks:
+            lock.acquire()  # held by threads of the parent
+        handler._pid = -1
+        thread = threading.Thread(target=handler.emit, args=(make_record(),))
+        thread.start()
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive(), "")
+        self.assertFalse(any(owner._lock in locks for owner in owners), "")
+        self.assertEqual(handler.metrics.snapshot()['emitted'], 1, "")
+        handler.close()
+        inherited_queue.put(_Flush(stop=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
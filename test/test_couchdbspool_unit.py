@@ -0,0 +1,227 @@
+'''
+    File: test_couchdbspool_unit.py
+    Description: Tests - CouchDBSpool
+'''
+from mock import Mock, patch
+import unittest
+import shutil
+import tempfile
+import json
+import time
+
+
+import sys, os
+sys.path.insert(0, os.path.abspath("../src"))
+
+from couchdblogger import CouchDBSpool, CouchDBRetry, CouchDBLogHandler, CouchDBBulkLogHandler, CouchDBSession, logging, requests
+
+
+class CouchDBSpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = CouchDBSpool(self.directory)
+
+    def tearDown(self):
+        self.spool.close()
+        shutil.rmtree(self.directory)
+
+    def replayed(self, spool=None, batch_size=500):
+        batches = []
+        (spool or self.spool).replay(lambda docs, database: batches.append(list(docs)), batch_size)
+        return batches
+
+    def test_empty(self):
+        self.assertFalse(self.spool.pending(), "")
+        self.assertEqual(self.replayed(), [], "")
+
+    def test_append_replay_in_order(self):
+        self.spool.append(['{"n": 1}', '{"n": 2}'])
+        self.spool.append(['{"n": 3}'])
+        self.assertTrue(self.spool.pending(), "")
+
+        self.assertEqual(self.replayed(batch_size=2), [['{"n": 1}', '{"n": 2}'], ['{"n": 3}']], "")
+        self.assertFalse(self.spool.pending(), "")
+        self.assertEqual(os.listdir(self.directory), [], "")
+
+    def test_segments_rotate(self):
+        self.spool.segment_bytes = 10
+        for i in range(3):
+            self.spool.append(['{"n": %d}' % i])
+        self.assertEqual(len([name for name in os.listdir(self.directory) if name.endswith('.spool')]), 3, "")
+        self.assertEqual(sum(self.replayed(), []), ['{"n": 0}', '{"n": 1}', '{"n": 2}'], "")
+
+    def test_reopen_keeps_segments(self):
+        self.spool.append(['{"n": 1}'])
+        self.spool.close()
+
+        spool = CouchDBSpool(self.directory)
+        self.assertTrue(spool.pending(), "")
+        spool.append(['{"n": 2}'])
+        self.assertEqual(self.replayed(spool), [['{"n": 1}'], ['{"n": 2}']], "")
+
+    def test_replay_resumes_from_checkpoint(self):
+        self.spool.append(['{"n": %d}' % i for i in range(4)])
+        sent = []
+
+        def send(docs, database):
+            if len(sent) == 1:
+                raise requests.ConnectionError()
+            sent.append(list(docs))
+
+        self.assertRaises(requests.ConnectionError, self.spool.replay, send, 2)
+        self.assertTrue(self.spool.pending(), "")
+        self.assertEqual(self.replayed(batch_size=2), [['{"n": 2}', '{"n": 3}']], "")
+
+    def test_database(self):
+        self.spool.append(['{"n": 1}'], 'logs-2026-10-17')
+        self.spool.append(['{"n": 2}', '{"n": 3}'], 'logs-2026-10-18')
+        self.spool.append(['{"n": 4}'])
+        batches = []
+        self.spool.replay(lambda docs, database: batches.append((database, list(docs))))
+        self.assertEqual(batches, [('logs-2026-10-17', ['{"n": 1}']),
+                                   ('logs-2026-10-18', ['{"n": 2}', '{"n": 3}']),
+                                   (None, ['{"n": 4}'])], "")
+
+    def test_max_bytes_drops_oldest_segment(self):
+        self.spool.segment_bytes = 1
+        self.spool.max_bytes = 30
+        for i in range(4):
+            self.spool.append(['{"n": %d}' % i])
+
+        self.assertEqual(self.spool.dropped_segments, 2, "")
+        self.assertEqual(self.spool.dropped_bytes, 24, "")
+        self.assertEqual(sum(self.replayed(), []), ['{"n": 2}', '{"n": 3}'], "")
+
+    def test_torn_write_is_ignored(self):
+        self.spool.append(['{"n": 1}'])
+        self.spool.close()
+        name = os.listdir(self.directory)[0]
+        with open(os.path.join(self.directory, name), 'ab') as segment:
+            segment.write(b'\x00\x00\x00\x10{"n"')
+        self.assertEqual(self.replayed(), [['{"n": 1}']], "")
+
+
+class CouchDBLogHandlerSpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.record = logging.makeLogRecord(dict(msg='log to couchdb', name='process_name'))
+
+    def tearDown(self):
+        patch.stopall()
+        shutil.rmtree(self.directory)
+
+    def test_spool_path(self):
+        handler = CouchDBLogHandler(spool=self.directory)
+        self.assertTrue(isinstance(handler.spool, CouchDBSpool), "")
+        self.assertEqual(handler.bulk_url, 'http://localhost:5984/logs/_bulk_docs', "")
+        handler.close()
+
+    def test_emit_unreachable_goes_to_spool(self):
+        post = patch.object(CouchDBSession, 'post', side_effect=requests.ConnectionError()).start()
+        patch.object(CouchDBSession, 'get', side_effect=requests.ConnectionError()).start()
+        handler = CouchDBLogHandler(spool=self.directory)
+        handler.handleError = Mock()
+
+        handler.emit(self.record)
+        handler.emit(self.record)
+        handler.close()
+
+        self.assertEqual(post.call_count, 1, "no request once the spool has documents")
+        self.assertFalse(handler.handleError.called, "")
+        self.assertEqual(len(sum(self.replayed_docs(), [])), 2, "")
+
+    def test_emit_rejected_is_not_spooled(self):
+        patch.object(CouchDBSession, 'post', side_effect=CouchDBSession.CouchDBException('bad', 400)).start()
+        handler = CouchDBLogHandler(spool=self.directory)
+        handler.handleError = Mock()
+        handler.emit(self.record)
+        handler.close()
+
+        handler.handleError.assert_called_with(self.record)
+        self.assertFalse(handler.spool.pending(), "")
+
+    def test_replay_when_reachable(self):
+        spool = CouchDBSpool(self.directory)
+        spool.append(['{"n": 1}'])
+        post = patch.object(CouchDBSession, 'post').start()
+        patch.object(CouchDBSession, 'get').start()
+
+        handler = CouchDBLogHandler(spool=spool, spool_retry_interval=0.01)
+        for _ in range(100):
+            if not spool.pending():
+                break
+            time.sleep(0.01)
+        handler.close()
+
+        self.assertFalse(spool.pending(), "")
+        self.assertEqual(post.call_args[0][0], 'http://localhost:5984/logs/_bulk_docs', "")
+        self.assertEqual(json.loads(post.call_args[1]['data']), {'docs': [{'n': 1}]}, "")
+
+    def replay_results(self, *results):
+        spool = CouchDBSpool(self.directory)
+        post = patch.object(CouchDBSession, 'post').start()
+        post.return_value.json.side_effect = results
+        patch.object(CouchDBSession, 'get').start()
+        handler = CouchDBLogHandler(spool=spool, spool_retry_interval=60)
+        handler.handleError = Mock()
+        spool.append(['{"n": 1}', '{"n": 2}'])
+        return spool, post, handler
+
+    def test_replay_document_errors_stay_in_spool(self):
+        spool, post, handler = self.replay_results([{'ok': True}, {'error': 'unknown_error'}],
+                                                   [{'error': 'conflict'}, {'ok': True}])
+        self.assertRaises(CouchDBSession.CouchDBException, spool.replay, handler._replay_send)
+        self.assertTrue(spool.pending(), "checkpoint before the batch")
+
+        spool.replay(handler._replay_send)
+        self.assertFalse(spool.pending(), "")
+        self.assertEqual(post.call_count, 2, "")
+        self.assertFalse(handler.handleError.called, "")
+        handler.close()
+
+    def test_replay_document_errors_retried(self):
+        spool, post, handler = self.replay_results([{'ok': True}, {'error': 'unknown_error'}], [{'ok': True}])
+        handler.retry = CouchDBRetry(attempts=2, backoff=0, jitter=0)
+        spool.replay(handler._replay_send)
+        self.assertFalse(spool.pending(), "")
+        self.assertEqual(json.loads(post.call_args[1]['data']), {'docs': [{'n': 2}]}, "")
+        handler.close()
+
+    def test_replay_document_rejected(self):
+        spool, post, handler = self.replay_results([{'ok': True}, {'error': 'forbidden'}])
+        spool.replay(handler._replay_send)
+        self.assertFalse(spool.pending(), "not replayed again")
+        self.assertEqual(post.call_count, 1, "")
+        self.assertTrue(handler.handleError.called, "")
+        self.assertEqual(handler.metrics.snapshot()['failed'], 1, "")
+        handler.close()
+
+    def test_replay_circuit_open(self):
+        spool, post, handler = self.replay_results()
+        handler.circuit_breaker = Mock(**{'allow.return_value': False})
+        self.assertRaises(CouchDBSession.CouchDBException, spool.replay, handler._replay_send)
+        self.assertTrue(spool.pending(), "")
+        self.assertFalse(post.called, "")
+        handler.close()
+
+    def test_bulk_ship_unreachable_goes_to_spool(self):
+        patch.object(CouchDBSession, 'post', side_effect=requests.Timeout()).start()
+        patch.object(CouchDBSession, 'get', side_effect=requests.Timeout()).start()
+        handler = CouchDBBulkLogHandler(spool=self.directory)
+        handler.handleError = Mock()
+        handler.emit(self.record)
+        handler.close()
+
+        self.assertFalse(handler.handleError.called, "")
+        self.assertEqual(len(sum(self.replayed_docs(), [])), 1, "")
+
+    def replayed_docs(self):
+        batches = []
+        CouchDBSpool(self.directory).replay(lambda docs, database: batches.append(docs))
+        return batches
+
+
+if __name__ == '__main__':
+    unittest.main()
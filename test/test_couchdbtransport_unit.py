@@ -0,0 +1,159 @@
+'''
+    File: test_couchdbtransport_unit.py
+    Description: Tests - CouchDBHTTPTransport, http.client transport of CouchDBSession
+'''
+from mock import Mock, patch
+import unittest
+import json
+import socket
+
+
+import sys, os
+sys.path.insert(0, os.path.abspath("../src"))
+sys.path.insert(0, os.path.abspath("../benchmarks"))
+
+from couchdblogger import (CouchDBHTTPTransport, CouchDBLogHandler, CouchDBBulkLogHandler, CouchDBLogReader,
+                           CouchDBSession, logging, requests)
+from fakecouchdb import FakeCouchDB
+from logrecords import make_record
+
+
+class CouchDBHTTPTransportTest(unittest.TestCase):
+
+    def setUp(self):
+        # other tests replace CouchDBSession.get for good
+        patch.object(CouchDBSession, 'get', requests.Session.get).start()
+        self.couchdb = FakeCouchDB().start()
+        self.session = CouchDBSession(transport='http.client')
+
+    def tearDown(self):
+        self.couchdb.stop()
+        patch.stopall()
+
+    def host(self):
+        return self.session.transport._host('http', '%s:%d' % (self.couchdb.host, self.couchdb.port),
+                                            True, None)
+
+    def test_session_transport(self):
+        self.assertTrue(isinstance(self.session.transport, CouchDBHTTPTransport), "")
+        self.assertEqual(CouchDBSession(transport='requests').transport, None, "")
+        clone = self.session.clone().transport
+        self.assertTrue(isinstance(clone, CouchDBHTTPTransport), "")
+        self.assertFalse(clone is self.session.transport, "")
+
+    def test_requests(self):
+        self.session.put(self.couchdb.url + '/logs')
+        resp = self.session.post(self.couchdb.url + '/logs', data='{"message": "log"}',
+                                 headers={'Content-type': 'application/json'})
+        self.assertEqual(resp.status_code, 201, "")
+        doc_id = resp.json()['id']
+        doc = self.session.get(self.couchdb.url + '/logs/' + doc_id).json()
+        self.assertEqual(doc['message'], 'log', "")
+        self.assertEqual(resp.headers.get('content-type'), 'application/json', "")
+
+    def test_error(self):
+        with self.assertRaises(CouchDBSession.CouchDBException) as raised:
+            self.session.get(self.couchdb.url + '/missing')
+        self.assertEqual(raised.exception.status_code, 404, "")
+
+    def test_keep_alive(self):
+        self.session.put(self.couchdb.url + '/logs')
+        connect = Mock(side_effect=self.host().connect)
+        self.host().connect = connect
+        for _ in range(5):
+            self.session.get(self.couchdb.url + '/logs')
+        self.assertEqual(connect.call_count, 0, "the connection of the put is reused")
+        self.assertEqual(len(self.host().idle), 1, "")
+
+    def test_closed_while_idle(self):
+        self.session.put(self.couchdb.url + '/logs')
+        self.host().idle[0].sock.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(self.session.get(self.couchdb.url + '/logs').json()['db_name'], 'logs', "")
+
+    def test_unreachable(self):
+        self.couchdb.stop()
+        self.assertRaises(requests.ConnectionError, self.session.get, self.couchdb.url + '/logs')
+
+    def test_login_cookie(self):
+        self.session.login(self.couchdb.url, 'user', 'secret')
+        self.assertTrue(self.host().cookie.startswith('AuthSession='), "")
+
+    def test_basic_auth(self):
+        host = self.session.transport._host('http', 'user:p%40ss@localhost:5984', True, None)
+        self.assertEqual(dict(host.headers)['Authorization'], 'Basic dXNlcjpwQHNz', "")
+        self.assertEqual(dict(host.headers)['Host'], 'localhost:5984', "")
+
+    def test_bodies(self):
+        transport = self.session.transport
+        self.assertEqual(transport._body({'name': 'user'}, None),
+                         (b'name=user', 'application/x-www-form-urlencoded'), "")
+        self.assertEqual(transport._body(None, {'a': 1}), (b'{"a": 1}', 'application/json'), "")
+        body, _ = transport._body(iter(['{"docs":', b'[]}']), None)
+        self.assertEqual(bytes(body), b'{"docs":[]}', "")
+        self.assertTrue(transport._body(iter(['x']), None)[0] is body, "buffer reused")
+
+    def test_stream(self):
+        self.session.put(self.couchdb.url + '/logs')
+        resp = self.session.get(self.couchdb.url + '/logs/_changes',
+                                params={'feed': 'continuous', 'timeout': 0}, stream=True)
+        self.assertEqual(json.loads(list(resp.iter_lines())[-1])['last_seq'], '0-fake', "")
+        resp.close()
+        self.assertEqual(len(self.host().idle), 1, "read to the end, reusable")
+
+    def test_stream_closed_early(self):
+        self.session.put(self.couchdb.url + '/logs')
+        resp = self.session.get(self.couchdb.url + '/logs/_changes',
+                                params={'feed': 'continuous', 'heartbeat': 10}, stream=True)
+        next(resp.iter_content(1))
+        resp.close()
+        self.assertEqual(len(self.host().idle), 0, "")
+
+
+class CouchDBHandlerTransportTest(unittest.TestCase):
+
+    def setUp(self):
+        patch.object(CouchDBSession, 'get', requests.Session.get).start()
+        self.couchdb = FakeCouchDB().start()
+
+    def tearDown(self):
+        self.couchdb.stop()
+        patch.stopall()
+
+    def make_handler(self, handler_class=CouchDBLogHandler, **kwargs):
+        handler = handler_class(host=self.couchdb.host, port=self.couchdb.port, create_database=True,
+                                username='user', password='secret', transport='http.client', **kwargs)
+        handler.handleError = Mock()
+        return handler
+
+    def test_emit(self):
+        handler = self.make_handler()
+        handler.emit(make_record())
+        self.assertEqual([doc['message'] for doc in self.couchdb.databases['logs'].values()],
+                         ['log to couchdb'], "")
+        self.assertFalse(handler.handleError.called, "")
+
+    def test_bulk_gzip(self):
+        handler = self.make_handler(CouchDBBulkLogHandler, compress=True, compress_min_size=0)
+        for i in range(50):
+            handler.emit(make_record('record %d' % i))
+        handler.close()
+        self.assertEqual(self.couchdb.documents, 50, "")
+        self.assertFalse(handler.handleError.called, "")
+
+    def test_nodes(self):
+        handler = self.make_handler(nodes=['%s:%d' % (self.couchdb.host, self.couchdb.port)] * 2)
+        self.assertTrue(all(isinstance(node.session.transport, CouchDBHTTPTransport)
+                            for node in handler.nodes.nodes), "")
+        handler.close()
+
+    def test_reader(self):
+        handler = self.make_handler(install_views=True)
+        for i in range(5):
+            handler.emit(make_record('record %d' % i))
+        reader = CouchDBLogReader(self.couchdb.url, page_size=2, transport='http.client')
+        self.assertEqual(len(list(reader.by_time())), 5, "")
+        self.assertEqual(len(list(reader.changes(since=0, follow=False))), 6, "")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+'''
+    File: test_fakecouchdb.py
+    Description: Tests - handlers against the fake couchdb of the benchmarks
+'''
+from mock import Mock, patch
+import unittest
+import shutil
+import tempfile
+import time
+
+
+import sys, os
+sys.path.insert(0, os.path.abspath("../src"))
+sys.path.insert(0, os.path.abspath("../benchmarks"))
+
+from couchdblogger import CouchDBLogHandler, CouchDBBulkLogHandler, CouchDBSession, logging, requests
+from fakecouchdb import FakeCouchDB
+from logrecords import make_record
+
+
+class FakeCouchDBTest(unittest.TestCase):
+
+    def setUp(self):
+        # other tests replace CouchDBSession.get for good
+        patch.object(CouchDBSession, 'get', requests.Session.get).start()
+        self.couchdb = FakeCouchDB().start()
+
+    def tearDown(self):
+        self.couchdb.stop()
+        patch.stopall()
+
+    def make_handler(self, handler_class=CouchDBLogHandler, **kwargs):
+        handler = handler_class(host=self.couchdb.host, port=self.couchdb.port, create_database=True,
+                                username='user', password='secret', **kwargs)
+        handler.handleError = Mock()
+        return handler
+
+    def test_emit(self):
+        handler = self.make_handler()
+        handler.emit(make_record())
+        docs = list(self.couchdb.databases['logs'].values())
+        self.assertEqual([doc['message'] for doc in docs], ['log to couchdb'], "")
+        self.assertFalse(handler.handleError.called, "")
+
+    def test_bulk_gzip(self):
+        handler = self.make_handler(CouchDBBulkLogHandler, compress=True, compress_min_size=0)
+        for i in range(50):
+            handler.emit(make_record('record %d' % i))
+        handler.close()
+        self.assertEqual(self.couchdb.documents, 50, "")
+        self.assertFalse(handler.handleError.called, "")
+
+    def test_failure_is_reported(self):
+        handler = self.make_handler()
+        self.couchdb.fail_next(1, 400)
+        handler.emit(make_record())
+        self.assertTrue(handler.handleError.called, "")
+        self.assertEqual(handler.metrics.snapshot()['failed'], 1, "")
+
+    def test_spool_replay_is_idempotent(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        handler = self.make_handler(spool=directory, spool_retry_interval=0.01)
+        self.couchdb.fail_next(1)
+        handler.emit(make_record())
+        for _ in range(200):
+            if not handler.spool.pending():
+                break
+            time.sleep(0.01)
+        handler.close()
+        self.assertEqual(self.couchdb.documents, 1, "")
+
+    def test_latency(self):
+        self.couchdb.latency = 0.05
+        handler = self.make_handler()
+        handler.emit(make_record())
+        self.assertTrue(handler.metrics.snapshot()['request']['max'] >= 0.05, "")
+
+    def test_partitions_and_retention(self):
+        handler = self.make_handler(database='logs-%Y', retention=86400)
+        record = make_record()
+        record.created = 0.0
+        handler.emit(record)
+        handler.emit(make_record())
+        self.assertTrue('logs-1970' in self.couchdb.databases, "")
+
+        handler.apply_retention()
+        self.assertFalse('logs-1970' in self.couchdb.databases, "")
+        self.assertEqual(len(self.couchdb.databases), 1, "")
+
+
+if __name__ == '__main__':
+    unittest.main()